@@ -8,6 +8,8 @@ Created on 2021-03-15
 @author: cook
 """
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List
 
 from astropy.time import Time, TimeDelta
 import joblib
@@ -55,6 +57,39 @@ def tqdm_module(use_tqdm: bool = True, verbose: int = 2):
     return _tqdm
 
 
+def cpu_count() -> int:
+    """
+    Get the number of cpus this process is allowed to use
+
+    :return: int, the number of cpus
+    """
+    # the cpus this process is allowed to run on (linux only)
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    # otherwise the number of cpus on the machine
+    return os.cpu_count() or 1
+
+
+def thread_map(func: Callable, iterable: Iterable, nthreads: int = 1
+               ) -> List[Any]:
+    """
+    Map a function over an iterable using a pool of threads (only useful
+    when func releases the GIL, e.g. numpy / scipy)
+
+    :param func: function, the function to call on each element
+    :param iterable: iterable, the elements to pass to func
+    :param nthreads: int, the number of threads (1 means no threads)
+
+    :return: list, the outputs of func (in the order of iterable)
+    """
+    # without threads just loop
+    if nthreads <= 1:
+        return [func(element) for element in iterable]
+    # with threads (re-raises any exception from func)
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        return list(pool.map(func, iterable))
+
+
 class ProgressParallel(joblib.Parallel):
     def __call__(self, *args, **kwargs):
         tqdm = tqdm_module()
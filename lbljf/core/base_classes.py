@@ -7,7 +7,10 @@ Created on 2021-03-15
 
 @author: cook
 """
+import threading
+import time
 from collections import UserDict
+from contextlib import nullcontext
 from copy import deepcopy
 from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
@@ -495,6 +498,138 @@ class HeaderTranslate:
         return header
 
 
+class StageTimer:
+    def __init__(self, enabled: bool = False):
+        """
+        Accumulate the time spent in named stages (monotonic clock). When
+        disabled stage() returns a shared no-op context so the cost is a
+        single function call.
+
+        Stages are exclusive: the time of a stage timed inside another stage
+        (in the same thread) is removed from the outer stage, so the stages
+        do not double count. Stages run in threads (e.g. over orders) are
+        summed over threads, so these can add up to more than the wall time.
+
+        :param enabled: bool, if False nothing is timed
+        """
+        self.enabled = enabled
+        # the accumulated time and number of calls for each stage
+        self.durations: Dict[str, float] = dict()
+        self.counts: Dict[str, int] = dict()
+        # lock (stages may be timed from several threads)
+        self._lock = threading.Lock()
+        # the stages currently being timed in each thread (the time spent
+        #    in their nested stages)
+        self._local = threading.local()
+        # the no-op context used when disabled
+        self._null = nullcontext()
+
+    def stage(self, name: str) -> Any:
+        """
+        Context manager timing one call of a stage
+
+        :param name: str, the stage name
+
+        :return: context manager
+        """
+        if not self.enabled:
+            return self._null
+        return _TimedStage(self, name)
+
+    def start(self) -> float:
+        """
+        Start timing a stage (for blocks too long for a with statement)
+
+        :return: float, the start time (0 if disabled)
+        """
+        if not self.enabled:
+            return 0.0
+        self._push()
+        return time.perf_counter()
+
+    def stop(self, name: str, start: float):
+        """
+        Stop timing a stage started with start()
+
+        :param name: str, the stage name
+        :param start: float, the value returned by start()
+
+        :return: None, updates the StageTimer
+        """
+        if self.enabled:
+            self._pop(name, time.perf_counter() - start)
+
+    def _push(self):
+        """
+        Open a stage in this thread (its nested stages are added to it)
+
+        :return: None, updates the stage stack of this thread
+        """
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        self._local.stack.append(0.0)
+
+    def _pop(self, name: str, elapsed: float):
+        """
+        Close the last stage opened in this thread and add its time
+        (without the time of its nested stages)
+
+        :param name: str, the stage name
+        :param elapsed: float, the wall time of the stage in seconds
+
+        :return: None, updates the StageTimer
+        """
+        stack = self._local.stack
+        # the time spent in nested stages
+        nested = stack.pop()
+        self.add(name, elapsed - nested)
+        # this stage is nested in the enclosing stage (if any)
+        if len(stack) > 0:
+            stack[-1] += elapsed
+
+    def add(self, name: str, duration: float):
+        """
+        Add a duration to a stage
+
+        :param name: str, the stage name
+        :param duration: float, the duration in seconds
+
+        :return: None, updates the StageTimer
+        """
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + duration
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def as_dict(self) -> Dict[str, float]:
+        """
+        The accumulated durations (seconds) for each stage
+
+        :return: dict, stage name --> duration
+        """
+        return dict(self.durations)
+
+
+class _TimedStage:
+    def __init__(self, timer: StageTimer, name: str):
+        """
+        A single timed call of a StageTimer stage (see StageTimer.stage)
+
+        :param timer: StageTimer, the timer to add the duration to
+        :param name: str, the stage name
+        """
+        self.timer = timer
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.timer._push()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.timer._pop(self.name, time.perf_counter() - self.start)
+
+
 # =============================================================================
 # Start of code
 # =============================================================================
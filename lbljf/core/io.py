@@ -10,8 +10,14 @@ Created on 2021-03-15
 @author: cook
 """
 import copy
+import getpass
 import itertools
+import json
 import os
+import shutil
+import socket
+import tempfile
+import time
 import warnings
 from collections import UserDict
 from pathlib import Path
@@ -26,6 +32,16 @@ from astropy.table import Table
 from lbljf.core import base
 from lbljf.core import base_classes
 
+# try to import fcntl module (not available on windows)
+# noinspection PyBroadException
+try:
+    import fcntl
+
+    HAS_FCNTL = True
+except Exception as _:
+    fcntl = None
+    HAS_FCNTL = False
+
 # =============================================================================
 # Define variables
 # =============================================================================
@@ -42,6 +58,11 @@ FORBIDDEN_KEYS = ['SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2',
                   'CRVAL2', 'CRPIX2', 'CDELT2', 'BSCALE', 'BZERO',
                   'PHOT_IM', 'FRAC_OBJ', 'FRAC_SKY', 'FRAC_BB',
                   'NEXTEND', '', 'HISTORY', 'XTENSION']
+# the lock file that marks a scratch run directory as in use
+SCRATCH_LOCK_FILE = 'scratch.lock'
+# age (in seconds) after which a scratch run directory without a lock file
+#    is considered stale
+SCRATCH_STALE_AGE = 24 * 3600
 
 
 # =============================================================================
@@ -352,6 +373,134 @@ class LBLHeader(UserDict):
         return False
 
 
+class FileLock:
+    def __init__(self, filename: str):
+        """
+        Advisory lock (fcntl.flock) on "filename.lock", used so that only one
+        process creates a file that others are waiting for. Blocks until the
+        lock is free. The lock is released by the system if the process
+        dies. Without fcntl (e.g. windows) no lock is taken.
+
+        :param filename: str, the file to protect (the lock file is
+                         filename + '.lock')
+        """
+        self.filename = filename
+        self.lockfile = filename + '.lock'
+        self.fd = None
+
+    def __enter__(self) -> 'FileLock':
+        """
+        Acquire the lock (blocking)
+
+        :return: the FileLock instance
+        """
+        # without fcntl we cannot lock
+        if not HAS_FCNTL:
+            return self
+        # open (or create) the lock file
+        self.fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o666)
+        # try to get the lock without waiting
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # log that we are waiting
+            msg = 'Waiting for another process to release lock: {0}'
+            log.general(msg.format(self.lockfile))
+            # block until we get the lock
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        # return the lock
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Release the lock (the lock file is kept, deleting it would let
+        another process lock a different file)
+        """
+        # nothing to do if we did not lock
+        if self.fd is None:
+            return
+        # release the lock and close the lock file
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+class ScratchDirectory:
+    def __init__(self, scratch_dir: Optional[str], prefix: str):
+        """
+        A unique scratch directory for one run (e.g. for memmaps), inside
+        "scratch_dir/lbl_scratch_<user>". It is created on entering the
+        context and removed (with everything in it) on leaving it, even if
+        an exception was raised.
+
+        The run directory holds a lock file (with the host and process id)
+        that is locked (fcntl.flock) for the life of the run, so directories
+        left behind by dead runs can be found and removed (see
+        sweep_scratch, called when a new scratch directory is made)
+
+        :param scratch_dir: str or None, the scratch directory (if None the
+                            system temporary directory is used)
+        :param prefix: str, prefix of the run directory name (e.g. recipe)
+        """
+        # deal with no scratch directory (use the node-local temp dir)
+        if scratch_dir is None:
+            scratch_dir = tempfile.gettempdir()
+        # one root per user (so users do not share permissions)
+        try:
+            user = getpass.getuser()
+        except Exception as _:
+            user = 'user'
+        self.root = os.path.join(str(scratch_dir), 'lbl_scratch_' + user)
+        self.prefix = prefix
+        self.path = None
+        self.fd = None
+
+    def __enter__(self) -> str:
+        """
+        Create the run directory (removing stale run directories first)
+
+        :return: str, the absolute path of the run directory
+        """
+        # make the scratch root
+        os.makedirs(self.root, exist_ok=True)
+        # remove directories left by dead runs
+        sweep_scratch(self.root)
+        # make a unique run directory
+        self.path = tempfile.mkdtemp(prefix=self.prefix + '_', dir=self.root)
+        # lock the lock file for the life of the run (it is locked before
+        #    it gets its name, so a sweep never sees it unlocked)
+        lockfile = os.path.join(self.path, SCRATCH_LOCK_FILE)
+        self.fd = os.open(lockfile + '.tmp', os.O_RDWR | os.O_CREAT, 0o666)
+        if HAS_FCNTL:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # write the owner of the run directory into the lock file
+        owner = dict(host=socket.gethostname(), pid=os.getpid())
+        os.write(self.fd, json.dumps(owner).encode())
+        os.rename(lockfile + '.tmp', lockfile)
+        # log the scratch directory
+        log.general('Scratch directory: {0}'.format(self.path))
+        # return the run directory
+        return self.path
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Remove the run directory (and release its lock)
+        """
+        # release the lock and close the lock file
+        if self.fd is not None:
+            if HAS_FCNTL:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        # remove the run directory
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            if os.path.exists(self.path):
+                msg = 'Could not remove scratch directory: {0}'
+                log.warning(msg.format(self.path))
+            self.path = None
+
+
 # =============================================================================
 # Define functions
 # =============================================================================
@@ -373,6 +522,71 @@ def check_file_exists(filename: str, required: bool = True) -> bool:
         return False
 
 
+def scratch_in_use(path: str) -> bool:
+    """
+    Check whether a scratch run directory (see ScratchDirectory) is still
+    used by a running process
+
+    :param path: str, the absolute path of the run directory
+
+    :return: bool, True if the run directory is (or may be) in use
+    """
+    # get the lock file
+    lockfile = os.path.join(path, SCRATCH_LOCK_FILE)
+    # without a lock file the directory is being created (or its run died
+    #    while creating it) - only stale if old
+    if not os.path.exists(lockfile):
+        return time.time() - os.path.getmtime(path) < SCRATCH_STALE_AGE
+    # with fcntl the lock is held while the run is alive
+    if HAS_FCNTL:
+        fd = os.open(lockfile, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+    # otherwise check the process id (only possible on the same host)
+    with open(lockfile, 'r') as lfile:
+        owner = json.loads(lfile.read() or '{}')
+    if owner.get('host') != socket.gethostname() or 'pid' not in owner:
+        return True
+    try:
+        os.kill(owner['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def sweep_scratch(root: str):
+    """
+    Remove the scratch run directories (see ScratchDirectory) left behind
+    by runs that are no longer running (e.g. crashed or killed runs)
+
+    :param root: str, the scratch root directory
+
+    :return: None, removes stale run directories
+    """
+    # loop around run directories
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        # only look at directories
+        if not os.path.isdir(path):
+            continue
+        # skip directories in use (or that we cannot check)
+        try:
+            if scratch_in_use(path):
+                continue
+        except (OSError, ValueError) as _:
+            continue
+        # remove the stale directory
+        shutil.rmtree(path, ignore_errors=True)
+        log.general('Removed stale scratch directory: {0}'.format(path))
+
+
 def check_directory(directory: str) -> str:
     """
     Checks 1. if directory exists 2. if directory is a directory
@@ -927,7 +1141,7 @@ def load_table(filename: str, kind: Union[str, None] = None,
 
 
 def write_table(filename: str, table: Table, fmt: str = 'fits',
-                overwrite: bool = True):
+                overwrite: bool = True, atomic: bool = False):
     """
     Standard way to write a table to disk
 
@@ -935,12 +1149,27 @@ def write_table(filename: str, table: Table, fmt: str = 'fits',
     :param table: astropy.table.Table, the table to write
     :param fmt: str, astropy.table format
     :param overwrite: bool, if True overwrites existing file
+    :param atomic: bool, if True write to a temporary file (in the same
+                   directory) and rename it over filename, so other
+                   processes never see a partially written file
 
     :return: None
     """
+    # write directly to the file
+    if not atomic:
+        outfile = filename
+    # or to a temporary file in the same directory (rename is atomic)
+    else:
+        outfile = '{0}.{1}.tmp'.format(filename, os.getpid())
     try:
-        table.write(filename, format=fmt, overwrite=overwrite)
+        table.write(outfile, format=fmt, overwrite=overwrite)
+        # publish the file
+        if atomic:
+            os.replace(outfile, filename)
     except Exception as e:
+        # remove the temporary file
+        if atomic and os.path.exists(outfile):
+            os.remove(outfile)
         emsg = 'Cannot write table {0} to disk \n\t{1}: {2}'
         eargs = [filename, type(e), str(e)]
         raise LblException(emsg.format(*eargs))
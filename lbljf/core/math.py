@@ -11,12 +11,13 @@ Created on 2021-03-16
 """
 import copy
 import warnings
-from typing import List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 from astropy import constants
 from scipy import optimize
 from scipy import signal
+from scipy.interpolate import BSpline
 from scipy.interpolate import InterpolatedUnivariateSpline as IUVSpline
 from scipy.special import erf
 
@@ -34,11 +35,17 @@ except Exception as e:
 # try to import numba module
 # noinspection PyBroadException
 try:
+    from numba import config as numba_config
     from numba import jit
+    from numba import prange
+    from numba import set_num_threads as numba_set_num_threads
 
     HAS_NUMBA = True
 except Exception as _:
+    numba_config = None
     jit = None
+    prange = range
+    numba_set_num_threads = None
     HAS_NUMBA = False
 
 # =============================================================================
@@ -51,6 +58,8 @@ __authors__ = base.__authors__
 # get speed of light
 speed_of_light_ms = constants.c.value
 speed_of_light = speed_of_light_ms / 1000.0
+# kernel length above which convolutions are done with an overlap-add FFT
+CONV_DIRECT_MAX = 128
 
 
 # =============================================================================
@@ -457,6 +466,383 @@ def odd_ratio_mean(value: np.ndarray, error: np.ndarray,
     return guess, bulk_error
 
 
+def odd_ratio_mean_nd(values: np.ndarray, errors: np.ndarray, axis: int = -1,
+                      odd_ratio: float = 2e-4, nmax: int = 10,
+                      conv_cut: float = 1e-2) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the odd ratio mean (see odd_ratio_mean) of every vector along an
+    axis of an N-D array in one call (each vector has its own convergence)
+
+    Uses a parallel numba kernel if numba is installed, otherwise all vectors
+    are iterated together with numpy
+
+    :param values: np.array (N-D), value array
+    :param errors: np.array (N-D), uncertainties for value array (same shape
+                   as values)
+    :param axis: int, the axis along which to compute the mean
+    :param odd_ratio: float, the probability that the point is bad
+    :param nmax: int, maximum number of iterations to pass through
+    :param conv_cut: float, the convergence cut criteria - how precise we have
+                     to get
+
+    :return: tuple, 1. the weighted means, 2. the errors on the weighted means
+             (both with the shape of values without axis)
+    """
+    # move the axis to the end
+    values = np.moveaxis(np.asarray(values, dtype=float), axis, -1)
+    errors = np.moveaxis(np.asarray(errors, dtype=float), axis, -1)
+    # get the output shape
+    shape = values.shape[:-1]
+    # flatten to one vector per row
+    values = np.ascontiguousarray(values.reshape(-1, values.shape[-1]))
+    errors = np.ascontiguousarray(errors.reshape(-1, errors.shape[-1]))
+    # compute the odd ratio mean of each row
+    if HAS_NUMBA:
+        guess, bulk_error = odd_ratio_mean_rows(values, errors, odd_ratio,
+                                                nmax, conv_cut)
+    else:
+        guess, bulk_error = _odd_ratio_mean_rows_numpy(values, errors,
+                                                       odd_ratio, nmax,
+                                                       conv_cut)
+    # return the means and errors in the output shape
+    return guess.reshape(shape), bulk_error.reshape(shape)
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def odd_ratio_mean_rows(values: np.ndarray, errors: np.ndarray,
+                        odd_ratio: float, nmax: int, conv_cut: float
+                        ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compiled odd ratio mean of each row of a 2D array (rows in parallel)
+
+    :param values: np.array (2D), value array [nrows, nvalues]
+    :param errors: np.array (2D), uncertainties for value array
+    :param odd_ratio: float, the probability that the point is bad
+    :param nmax: int, maximum number of iterations to pass through
+    :param conv_cut: float, the convergence cut criteria
+
+    :return: tuple, 1. the weighted mean of each row, 2. the error on the
+             weighted mean of each row
+    """
+    # storage for outputs
+    guess = np.full(values.shape[0], np.nan)
+    bulk_error = np.full(values.shape[0], np.nan)
+    # loop around rows (in parallel)
+    for row in prange(values.shape[0]):
+        out = odd_ratio_mean(values[row], errors[row], odd_ratio, nmax,
+                             conv_cut)
+        guess[row] = out[0]
+        bulk_error[row] = out[1]
+    # return the weighted means and errors
+    return guess, bulk_error
+
+
+def _odd_ratio_mean_rows_numpy(values: np.ndarray, errors: np.ndarray,
+                               odd_ratio: float, nmax: int, conv_cut: float
+                               ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Odd ratio mean of each row of a 2D array with numpy (all rows are
+    iterated together, rows stop updating once they have converged)
+
+    :param values: np.array (2D), value array [nrows, nvalues]
+    :param errors: np.array (2D), uncertainties for value array
+    :param odd_ratio: float, the probability that the point is bad
+    :param nmax: int, maximum number of iterations to pass through
+    :param conv_cut: float, the convergence cut criteria
+
+    :return: tuple, 1. the weighted mean of each row, 2. the error on the
+             weighted mean of each row
+    """
+    # deal with NaNs in value or error (set both to NaN)
+    keep = np.isfinite(values) & np.isfinite(errors)
+    values = np.where(keep, values, np.nan)
+    error2 = np.where(keep, errors, np.nan) ** 2
+    # rows with no finite values are not computed
+    active = np.any(keep, axis=1)
+    # placeholders for the iterations (start from the median)
+    guess_prev = np.full(len(values), np.inf)
+    with warnings.catch_warnings(record=True) as _:
+        guess = nanmedian(values, axis=1)
+    bulk_error = np.where(active, 1.0, np.nan)
+    # loop around until all rows have converged or we reach nmax
+    for _ite in range(nmax):
+        # only iterate rows that have not converged
+        with warnings.catch_warnings(record=True) as _:
+            active &= np.abs(guess - guess_prev) / bulk_error > conv_cut
+        if not np.any(active):
+            break
+        # store the previous guess
+        guess_prev[active] = guess[active]
+        value, err2 = values[active], error2[active]
+        # model points as gaussian weighted by likelihood of being a valid
+        #   point
+        diff2 = (value - guess[active][:, None]) ** 2
+        gfit = (1 - odd_ratio) * np.exp(-0.5 * (diff2 / err2))
+        # find the probability that a point is good
+        odd_good = 1 - odd_ratio / (gfit + odd_ratio)
+        # calculate the weights based on the probability of being good
+        weights = odd_good / err2
+        # rows without any finite weights become NaN
+        valid = np.any(np.isfinite(weights), axis=1)
+        # update the guess and bulk error based on the weights
+        with warnings.catch_warnings(record=True) as _:
+            new_guess = np.nansum(value * weights, axis=1)
+            new_guess = new_guess / np.nansum(weights, axis=1)
+            new_error = np.sqrt(1.0 / np.nansum(odd_good / err2, axis=1))
+        guess[active] = np.where(valid, new_guess, np.nan)
+        bulk_error[active] = np.where(valid, new_error, bulk_error[active])
+    # return the weighted means and errors
+    return guess, bulk_error
+
+
+# error_model="numpy" gives inf/nan on zero division (as numpy would)
+@jit(nopython=True, parallel=True, cache=True, error_model='numpy')
+def bouchy_lines_kernel(orders: np.ndarray, x_start: np.ndarray,
+                        x_end: np.ndarray, wave_start: np.ndarray,
+                        wave_end: np.ndarray, wavegrid: np.ndarray,
+                        sci_data: np.ndarray, model: np.ndarray,
+                        dmodel: np.ndarray, d2model: np.ndarray,
+                        d3model: np.ndarray, proj_models: np.ndarray,
+                        rms: np.ndarray, blaze: np.ndarray,
+                        last_iter: bool) -> Tuple[np.ndarray, ...]:
+    """
+    Compiled line-by-line kernel: for every line (given by its order and
+    pixel span) weight the edge pixels by their overlap with the line and
+    apply the Bouchy 2001 equation to the derivative models. Sums are
+    accumulated in float64 one pixel at a time.
+
+    :param orders: np.ndarray (int), the order of each line [nlines]
+    :param x_start: np.ndarray (int), the first pixel of each line [nlines]
+    :param x_end: np.ndarray (int), the last pixel of each line [nlines]
+    :param wave_start: np.ndarray, the start wavelength of each line
+    :param wave_end: np.ndarray, the end wavelength of each line
+    :param wavegrid: np.ndarray, the (shifted) wave grid [norder, npix]
+    :param sci_data: np.ndarray, the science data [norder, npix]
+    :param model: np.ndarray, the model [norder, npix]
+    :param dmodel: np.ndarray, the 1st derivative model [norder, npix]
+    :param d2model: np.ndarray, the 2nd derivative model [norder, npix]
+    :param d3model: np.ndarray, the 3rd derivative model [norder, npix]
+    :param proj_models: np.ndarray, the residual projection models
+                        [nproj, norder, npix] (nproj can be zero)
+    :param rms: np.ndarray, the rms [norder, npix]
+    :param blaze: np.ndarray, the blaze [norder, npix]
+    :param last_iter: bool, if True also compute the 0th, 2nd, 3rd
+                      derivative and projection values and the line stats
+
+    :return: tuple of per-line arrays: meanxpix, meanblaze, frac_valid, dv,
+             sdv, d0v, sd0v, d0v_valid, d2v, sd2v, d3v, sd3v, proj, sproj,
+             rmsratio, chi2
+    """
+    # get the number of lines and projections
+    nlines = len(orders)
+    nproj = proj_models.shape[0]
+    # storage for outputs
+    meanxpix = np.full(nlines, np.nan)
+    meanblaze = np.full(nlines, np.nan)
+    frac_valid = np.full(nlines, np.nan)
+    dv = np.full(nlines, np.nan)
+    sdv = np.full(nlines, np.nan)
+    d0v = np.full(nlines, np.nan)
+    sd0v = np.full(nlines, np.nan)
+    d0v_valid = np.zeros(nlines, dtype=np.bool_)
+    d2v = np.full(nlines, np.nan)
+    sd2v = np.full(nlines, np.nan)
+    d3v = np.full(nlines, np.nan)
+    sd3v = np.full(nlines, np.nan)
+    proj = np.full((nproj, nlines), np.nan)
+    sproj = np.full((nproj, nlines), np.nan)
+    rmsratio = np.full(nlines, np.nan)
+    chi2 = np.full(nlines, np.nan)
+    # loop around lines (in parallel)
+    for it in prange(nlines):
+        # get this lines values
+        onum, xs, xe = orders[it], x_start[it], x_end[it]
+        npix = xe - xs + 1
+        # ---------------------------------------------------------------------
+        # get weights at the edge of the domain. Pixels inside have a
+        # weight of 1, at the edge, it's proportional to the overlap
+        first = wavegrid[onum, xs] < wave_start[it]
+        w_first = 1.0
+        if first:
+            refdiff = wavegrid[onum, xs + 1] - wave_start[it]
+            wavediff = wavegrid[onum, xs + 1] - wavegrid[onum, xs]
+            w_first = 1 - refdiff / wavediff
+        last = wavegrid[onum, xe + 1] > wave_end[it]
+        w_last = 1.0
+        if last:
+            refdiff = wave_end[it] - wavegrid[onum, xe]
+            wavediff = wavegrid[onum, xe] - wavegrid[onum, xe - 1]
+            w_last = 1 - refdiff / wavediff
+        weights = np.ones(npix)
+        if first:
+            weights[0] = w_first
+        if last:
+            weights[npix - 1] = w_last
+        # ---------------------------------------------------------------------
+        # first pass: weights, mean pixel position, valid fraction and rms
+        sum_w, nsum_w, nsum_wx, sum_rms, num_valid = 0.0, 0.0, 0.0, 0.0, 0
+        for ipix in range(npix):
+            pix = xs + ipix
+            sum_w += weights[ipix]
+            if not np.isnan(weights[ipix]):
+                nsum_w += weights[ipix]
+                nsum_wx += weights[ipix] * pix
+            if np.isfinite(sci_data[onum, pix]):
+                num_valid += 1
+            sum_rms += rms[onum, pix] * weights[ipix]
+        meanxpix[it] = nsum_wx / nsum_w
+        meanblaze[it] = blaze[onum, (xs + xe) // 2]
+        frac_valid[it] = num_valid / npix
+        mean_rms = sum_rms / sum_w
+        # ---------------------------------------------------------------------
+        # work out the 1st derivative (Bouchy 2001 equation)
+        sum_inv, sum_dd, sum_d2 = 0.0, 0.0, 0.0
+        for ipix in range(npix):
+            pix = xs + ipix
+            dval = dmodel[onum, pix] * weights[ipix]
+            diff = (sci_data[onum, pix] - model[onum, pix]) * weights[ipix]
+            sum_inv += 1 / (mean_rms / dval) ** 2
+            sum_dd += diff * dval
+            sum_d2 += dval ** 2
+        dv[it] = sum_dd / sum_d2
+        sdv[it] = 1 / np.sqrt(sum_inv)
+        # the rest is only done on the last iteration
+        if not last_iter:
+            continue
+        # ---------------------------------------------------------------------
+        # work out the mean of the model (0th derivative) and the mean of the
+        #   residuals (for the rms ratio)
+        num_fmodel, num_nmodel, nsum_model = 0, 0, 0.0
+        num_ndiff, nsum_diff = 0, 0.0
+        for ipix in range(npix):
+            pix = xs + ipix
+            mval = model[onum, pix]
+            diff = (sci_data[onum, pix] - mval) * weights[ipix]
+            if np.isfinite(mval):
+                num_fmodel += 1
+            if not np.isnan(mval):
+                num_nmodel += 1
+                nsum_model += mval
+            if not np.isnan(diff):
+                num_ndiff += 1
+                nsum_diff += diff
+        mean_model = nsum_model / num_nmodel
+        mean_diff = nsum_diff / num_ndiff
+        # ---------------------------------------------------------------------
+        # work out the 0th, 2nd and 3rd derivative and projections
+        #    (Bouchy 2001 equation), the residual std and the chi2
+        sum0 = np.zeros(3)
+        sum2 = np.zeros(3)
+        sum3 = np.zeros(3)
+        sump = np.zeros((nproj, 3))
+        nsum_sq, nsum_chi2 = 0.0, 0.0
+        for ipix in range(npix):
+            pix = xs + ipix
+            diff = (sci_data[onum, pix] - model[onum, pix]) * weights[ipix]
+            # 0th derivative (not weighted)
+            dval = model[onum, pix] - mean_model
+            sum0[0] += 1 / (mean_rms / dval) ** 2
+            sum0[1] += diff * dval
+            sum0[2] += dval ** 2
+            # 2nd derivative
+            dval = d2model[onum, pix] * weights[ipix]
+            sum2[0] += 1 / (mean_rms / dval) ** 2
+            sum2[1] += diff * dval
+            sum2[2] += dval ** 2
+            # 3rd derivative
+            dval = d3model[onum, pix] * weights[ipix]
+            sum3[0] += 1 / (mean_rms / dval) ** 2
+            sum3[1] += diff * dval
+            sum3[2] += dval ** 2
+            # residual projections
+            for iproj in range(nproj):
+                dval = proj_models[iproj, onum, pix] * weights[ipix]
+                sump[iproj, 0] += 1 / (mean_rms / dval) ** 2
+                sump[iproj, 1] += diff * dval
+                sump[iproj, 2] += dval ** 2
+            # residual std and chi2 (ignoring NaNs)
+            if not np.isnan(diff):
+                nsum_sq += (diff - mean_diff) ** 2
+            if not np.isnan((diff / mean_rms) ** 2):
+                nsum_chi2 += (diff / mean_rms) ** 2
+        # 0th derivative requires at least 2 finite model values
+        d0v_valid[it] = num_fmodel >= 2
+        d0v[it] = sum0[1] / sum0[2]
+        sd0v[it] = 1 / np.sqrt(sum0[0])
+        d2v[it] = sum2[1] / sum2[2]
+        sd2v[it] = 1 / np.sqrt(sum2[0])
+        d3v[it] = sum3[1] / sum3[2]
+        sd3v[it] = 1 / np.sqrt(sum3[0])
+        for iproj in range(nproj):
+            proj[iproj, it] = sump[iproj, 1] / sump[iproj, 2]
+            sproj[iproj, it] = 1 / np.sqrt(sump[iproj, 0])
+        # ratio of expected VS actual RMS in difference of model vs line
+        rmsratio[it] = np.sqrt(nsum_sq / num_ndiff) / mean_rms
+        # likelihood that the line is valid from a chi2 point of view
+        chi2[it] = nsum_chi2
+    # return the per-line values
+    return (meanxpix, meanblaze, frac_valid, dv, sdv, d0v, sd0v, d0v_valid,
+            d2v, sd2v, d3v, sd3v, proj, sproj, rmsratio, chi2)
+
+
+# error_model="numpy" gives inf/nan on zero division (as numpy would)
+@jit(nopython=True, parallel=True, cache=True, error_model='numpy')
+def sigma_clip_kernel(data: np.ndarray, model: np.ndarray, rms: np.ndarray,
+                      threshold: float):
+    """
+    Compiled sigma clip: set data to NaN where |data - model| / rms is
+    above a threshold (updates data in place)
+
+    :param data: np.ndarray, the data to clip [norder, npix]
+    :param model: np.ndarray, the model [norder, npix]
+    :param rms: np.ndarray, the rms [norder, npix]
+    :param threshold: float, the number of sigma to clip at
+
+    :return: None, data is updated in place
+    """
+    # loop around orders (in parallel)
+    for order_num in prange(data.shape[0]):
+        for pix in range(data.shape[1]):
+            nsig = (data[order_num, pix] - model[order_num, pix])
+            nsig = nsig / rms[order_num, pix]
+            if np.abs(nsig) > threshold:
+                data[order_num, pix] = np.nan
+
+
+def use_fork_safe_threading():
+    """
+    Use a numba threading layer that is safe with forked processes (the
+    default may be GNU OpenMP, which hangs a process that forks after it
+    has run a parallel kernel). Must be called before the first parallel
+    kernel is run
+
+    :return: None, updates the numba config
+    """
+    # nothing to do without numba
+    if not HAS_NUMBA:
+        return
+    # the workqueue layer is always available and is fork safe
+    numba_config.THREADING_LAYER = 'workqueue'
+
+
+def set_numba_threads(nthreads: int):
+    """
+    Set the number of threads used by the parallel numba kernels in this
+    process (e.g. so that forked workers share the cpus between them)
+
+    :param nthreads: int, the number of threads (at least 1, at most the
+                     number of threads numba was started with)
+
+    :return: None, updates the numba thread count
+    """
+    # nothing to do without numba
+    if not HAS_NUMBA:
+        return
+    # numba cannot use more threads than it was started with
+    nthreads = min(max(int(nthreads), 1), numba_config.NUMBA_NUM_THREADS)
+    numba_set_num_threads(nthreads)
+
+
 # =============================================================================
 # Define general math functions
 # =============================================================================
@@ -572,6 +958,281 @@ def iuv_spline(x: np.ndarray, y: np.ndarray, **kwargs
     return IUVSpline(x, y, **kwargs)
 
 
+class WavePixelMap:
+    def __init__(self, wavegrid: np.ndarray):
+        """
+        Monotonic wavelength to pixel mapping for every order of a wave
+        solution. The mapping is built once (per order, when first used) and
+        a Doppler shift of the wave grid is applied as a scale factor on the
+        input wavelengths, i.e. for
+
+            nwavegrid = doppler_shift(wavegrid, velocity)
+
+        the pixel position of wave on nwavegrid is the pixel position of
+        wave / doppler_shift(1, velocity) on wavegrid
+
+        :param wavegrid: np.ndarray, the wave grid [norder, npix], must be
+                         increasing within each order
+        """
+        self.wavegrid = np.array(wavegrid)
+        # the pixel grid of each order
+        self.xpix = np.arange(self.wavegrid.shape[1])
+        # the per order wave to pixel splines (filled when required)
+        self.splines = [None] * self.wavegrid.shape[0]
+
+    def __call__(self, order_num: int, wave: Union[list, np.ndarray],
+                 velocity: float = 0.0) -> np.ndarray:
+        """
+        Get the pixel position(s) of wave in an order of the wave grid
+        Doppler shifted by velocity
+
+        :param order_num: int, the order number
+        :param wave: list or np.ndarray, the wavelength(s) to map
+        :param velocity: float, velocity (m/s) of the doppler shift applied
+                         to the wave grid (as in doppler_shift)
+
+        :return: np.ndarray, the (fractional) pixel positions
+        """
+        # build the spline for this order only once
+        if self.splines[order_num] is None:
+            self.splines[order_num] = iuv_spline(self.wavegrid[order_num],
+                                                 self.xpix)
+        # the doppler factor applied to the wave grid
+        factor = doppler_shift(1.0, velocity)
+        # return the pixel positions
+        return self.splines[order_num](np.array(wave) / factor)
+
+
+class LogLambdaSpline:
+    def __init__(self, log_wave0: float, log_step: float, values: np.ndarray,
+                 slopes: np.ndarray):
+        """
+        A function sampled on a uniform log-wavelength grid (with its slope)
+        evaluated with local cubic Hermite interpolation. A Doppler shift of
+        the input wavelengths is a constant offset in grid index.
+
+        Outside the grid the function is zero (as a spline with ext=1).
+
+        :param log_wave0: float, the log of the first wavelength of the grid
+        :param log_step: float, the log-wavelength step of the grid
+        :param values: np.ndarray, the function on the grid
+        :param slopes: np.ndarray, the derivative of the function with
+                       respect to the grid index (d values / d index)
+        """
+        self.log_wave0 = float(log_wave0)
+        self.log_step = float(log_step)
+        self.values = values
+        self.slopes = slopes
+
+    @classmethod
+    def from_spline(cls, spline: Union[IUVSpline, NanSpline],
+                    log_wave0: float, log_step: float,
+                    npoints: int) -> 'LogLambdaSpline':
+        """
+        Sample a spline (and its analytic derivative) on a uniform
+        log-wavelength grid
+
+        :param spline: IUVSpline or NanSpline, the spline to sample
+        :param log_wave0: float, the log of the first wavelength of the grid
+        :param log_step: float, the log-wavelength step of the grid
+        :param npoints: int, the number of points in the grid
+
+        :return: LogLambdaSpline, the sampled spline
+        """
+        # the wavelength grid
+        wavegrid = np.exp(log_wave0 + np.arange(npoints) * log_step)
+        # a nan spline stays NaN everywhere
+        if isinstance(spline, NanSpline):
+            values = np.full(npoints, np.nan)
+            return cls(log_wave0, log_step, values, np.array(values))
+        # sample the spline and its derivative (d/dindex = d/dwave * dwave)
+        values = spline(wavegrid)
+        slopes = spline.derivative()(wavegrid) * wavegrid * log_step
+        # return the sampled spline
+        return cls(log_wave0, log_step, values, slopes)
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        """
+        Evaluate the function at wavelengths x
+
+        :param x: np.ndarray, the wavelengths
+
+        :return: np.ndarray, the function at x
+        """
+        # the fractional grid index of x
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        with warnings.catch_warnings(record=True) as _:
+            index = (np.log(x) - self.log_wave0) / self.log_step
+        # points inside the grid
+        valid = (index >= 0) & (index <= len(self.values) - 1)
+        # lower grid point and fractional offset (last point uses the
+        #   last interval)
+        low = np.clip(np.floor(np.nan_to_num(index)).astype(int), 0,
+                      len(self.values) - 2)
+        frac = index - low
+        # cubic hermite basis functions
+        frac2, frac3 = frac ** 2, frac ** 3
+        h00 = 2 * frac3 - 3 * frac2 + 1
+        h10 = frac3 - 2 * frac2 + frac
+        h01 = -2 * frac3 + 3 * frac2
+        h11 = frac3 - frac2
+        # interpolate
+        out = (h00 * self.values[low] + h10 * self.slopes[low] +
+               h01 * self.values[low + 1] + h11 * self.slopes[low + 1])
+        # outside the grid we return zero (NaN x stays NaN)
+        out[~valid & np.isfinite(index)] = 0.0
+        # return the interpolated values
+        return out
+
+
+class SplineStack:
+    def __init__(self, knots: np.ndarray, coeffs: np.ndarray, k: int,
+                 names: List[str]):
+        """
+        Several splines that share one knot vector (e.g. interpolating
+        splines of different curves on the same x), evaluated together. The
+        interval search and the b-spline basis are computed once per point
+        for all curves.
+
+        Outside the knots the curves are zero (as a spline with ext=1).
+
+        :param knots: np.ndarray, the shared knot vector
+        :param coeffs: np.ndarray, the coefficients [ncoeffs, ncurves]
+        :param k: int, the order of the splines
+        :param names: list of str, the name of each curve
+        """
+        self.knots = knots
+        self.coeffs = coeffs
+        self.k = int(k)
+        self.names = list(names)
+        # the b-spline of all the curves (NaN outside the knots)
+        self.bspline = BSpline(knots, coeffs, self.k, extrapolate=False)
+
+    @classmethod
+    def from_splines(cls, splines: Dict[str, IUVSpline]) -> 'SplineStack':
+        """
+        Stack splines that share the same knots (and order)
+
+        :param splines: dict, the splines to stack (keys are the curve names)
+
+        :return: SplineStack, the stacked splines
+        """
+        # get the names of the curves
+        names = list(splines.keys())
+        # get the knots and order from the first spline
+        knots, _, k_order = splines[names[0]]._eval_args
+        # storage for the coefficients
+        coeffs = np.zeros((len(knots), len(names)))
+        # loop around splines
+        for it, name in enumerate(names):
+            tknots, tcoeffs, tk_order = splines[name]._eval_args
+            # all splines must share the knots and order
+            if tk_order != k_order or not np.array_equal(tknots, knots):
+                emsg = 'SplineStack: spline "{0}" does not share the knots'
+                raise base_classes.LblException(emsg.format(name))
+            coeffs[:len(tcoeffs), it] = tcoeffs
+        # return the stacked splines
+        return cls(knots, coeffs, k_order, names)
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        """
+        Evaluate all the curves at x
+
+        :param x: np.ndarray, the positions
+
+        :return: np.ndarray, the curves at x [len(x), ncurves]
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        # evaluate all curves in one pass
+        out = self.bspline(x)
+        # outside the knots we return zero (NaN x stays NaN)
+        outside = (x < self.knots[self.k]) | (x > self.knots[-self.k - 1])
+        out[outside] = 0.0
+        # return the curves
+        return out
+
+    def curve(self, name: str) -> 'SplineStackCurve':
+        """
+        Get a single curve of the stack (sharing the stack's arrays)
+
+        :param name: str, the name of the curve
+
+        :return: SplineStackCurve, the curve
+        """
+        return SplineStackCurve(self, name)
+
+
+class SplineStackCurve:
+    def __init__(self, stack: SplineStack, name: str):
+        """
+        A single curve of a SplineStack (used as a spline)
+
+        :param stack: SplineStack, the stack the curve belongs to
+        :param name: str, the name of the curve in the stack
+        """
+        self.stack = stack
+        self.name = name
+        self.index = stack.names.index(name)
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        """
+        Evaluate the curve at x
+
+        :param x: np.ndarray, the positions
+
+        :return: np.ndarray, the curve at x
+        """
+        # all curves cost the same as one (the basis is shared)
+        return np.array(self.stack(x)[:, self.index])
+
+    def derivative(self, n: int = 1) -> 'SplineStackCurve':
+        """
+        Get the derivative of the curve
+
+        :param n: int, the order of the derivative
+
+        :return: SplineStackCurve, the derivative (of a single curve stack)
+        """
+        stack = self.stack
+        # differentiate the b-spline of this curve
+        coeffs = np.ascontiguousarray(stack.coeffs[:, self.index])
+        deriv = BSpline(stack.knots, coeffs, stack.k).derivative(n)
+        # push into a single curve stack
+        single = SplineStack(deriv.t, deriv.c[:, None], deriv.k, [self.name])
+        return single.curve(self.name)
+
+
+def evaluate_splines(splines: Dict[str, Any], keys: List[str],
+                     x: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Evaluate several splines at x. Curves of the same SplineStack are
+    evaluated together (all curves of a stack in one pass), any other
+    spline is evaluated on its own.
+
+    :param splines: dict, the splines
+    :param keys: list of str, the keys of the splines to evaluate
+    :param x: np.ndarray, the positions
+
+    :return: dict, the splines evaluated at x (one entry per key)
+    """
+    # storage for the outputs
+    out = dict()
+    # storage for the stacks already evaluated
+    stacks = dict()
+    # loop around splines
+    for key in keys:
+        spline = splines[key]
+        if isinstance(spline, SplineStackCurve):
+            # evaluate each stack only once
+            if id(spline.stack) not in stacks:
+                stacks[id(spline.stack)] = spline.stack(x)
+            out[key] = stacks[id(spline.stack)][:, spline.index]
+        else:
+            out[key] = spline(x)
+    # return the evaluated splines
+    return out
+
+
 def lowpassfilter(input_vect: np.ndarray, width: int = 101,
                   k: int = 2) -> np.ndarray:
     """
@@ -593,60 +1254,153 @@ def lowpassfilter(input_vect: np.ndarray, width: int = 101,
     When there are no valid pixel in a 'width' domain, the value is skipped
     in the creation of xmed and ymed, and the domain is splined over.
 
+    All the running medians are computed in a single pass over a sliding
+    window view of the vector (see lowpassfilter_2d to low pass many vectors
+    in one call)
+
     :param input_vect: numpy 1D vector, vector to low pass
     :param width: int, width (box size) of the low pass filter
     :param k: int, order of the spline used (passed to IUVSpline)
 
     :return:
     """
-    # indices along input vector
-    index = np.arange(len(input_vect))
-    # placeholders for x and y position along vector
-    xmed = []
-    ymed = []
-    # loop through the lenght of the input vector
-    for it in np.arange(-width // 2, len(input_vect) + width // 2, width // 4):
-        # if we are at the start or end of vector, we go 'off the edge' and
-        # define a box that goes beyond it. It will lead to an effectively
-        # smaller 'width' value, but will provide a consistent result at edges.
-        low_bound = it
-        high_bound = it + int(width)
-        # deal with lower bounds out of bounds --> set to zero
-        if low_bound < 0:
-            low_bound = 0
-        # deal with upper bounds out of bounds --> set to max
-        if high_bound > (len(input_vect) - 1):
-            high_bound = (len(input_vect) - 1)
-        # get the pixel bounds
-        pixval = index[low_bound:high_bound]
-        # do not low pass if not enough points
-        if len(pixval) < 3:
-            continue
-        # if no finite value, skip
-        if np.sum(np.isfinite(input_vect[pixval])) < 3:
-            continue
-        # mean position along vector and NaN median value of
-        # points at those positions
-        xmed.append(nanmean(pixval))
-        ymed.append(nanmedian(input_vect[pixval]))
-    # convert to arrays
-    xmed = np.array(xmed, dtype=float)
-    ymed = np.array(ymed, dtype=float)
+    # get the window positions and medians
+    xmed, ymed, valid = _lowpass_medians(np.atleast_2d(input_vect), width)
     # we need at least 3 valid points to return a
     # low-passed vector.
-    if len(xmed) < 3:
+    if np.sum(valid[0]) < 3:
         return np.full_like(input_vect, np.nan)
+    # spline the medians
+    return _lowpass_spline(xmed[valid[0]], ymed[0][valid[0]],
+                           len(input_vect), k)
+
+
+def lowpassfilter_2d(input_array: np.ndarray,
+                     width: Union[int, np.ndarray] = 101, k: int = 2,
+                     chunk_size: int = 2 ** 24) -> np.ndarray:
+    """
+    Computes the low-pass filter (see lowpassfilter) of each row of a 2D
+    array (e.g. every order of an E2DS or every column of a flux cube via its
+    transpose) in one call
+
+    Rows with the same width are filtered together (in chunks of at most
+    chunk_size window pixels), only the final spline is done row by row.
+    The output is the same as calling lowpassfilter on each row.
+
+    :param input_array: numpy 2D array [nrows, npix], rows to low pass
+    :param width: int or numpy 1D array [nrows], width (box size) of the low
+                  pass filter (for all rows or for each row)
+    :param k: int, order of the spline used (passed to IUVSpline)
+    :param chunk_size: int, the maximum number of window pixels held in
+                       memory at once
+
+    :return: numpy 2D array [nrows, npix], the low passed rows
+    """
+    # make sure we have a 2D array
+    input_array = np.atleast_2d(input_array)
+    nrows, npix = input_array.shape
+    # get a width for each row
+    widths = np.zeros(nrows, dtype=int) + np.asarray(width, dtype=int)
+    # storage for the output
+    lowpass = np.full((nrows, npix), np.nan)
+    # loop around the unique widths
+    for row_width in np.unique(widths):
+        # the rows with this width
+        rows = np.where(widths == row_width)[0]
+        # number of rows per chunk (there are ~4 x npix window pixels per row)
+        nchunk = max(1, chunk_size // (4 * (npix + row_width)))
+        # loop around chunks of rows
+        for start in range(0, len(rows), nchunk):
+            chunk = rows[start:start + nchunk]
+            # get the window positions and medians for these rows
+            xmed, ymed, valid = _lowpass_medians(input_array[chunk],
+                                                 row_width)
+            # spline each row
+            for it, row in enumerate(chunk):
+                # we need at least 3 valid points to return a
+                # low-passed vector.
+                if np.sum(valid[it]) < 3:
+                    continue
+                lowpass[row] = _lowpass_spline(xmed[valid[it]],
+                                               ymed[it][valid[it]], npix, k)
+    # return the low pass filtered rows
+    return lowpass
+
+
+def _lowpass_medians(vects: np.ndarray, width: int
+                     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compute the running NaN medians of lowpassfilter for a set of vectors of
+    the same length (same boxes and rules as the original loop over box
+    positions)
+
+    :param vects: numpy 2D array [nrows, npix], the vectors
+    :param width: int, width (box size) of the low pass filter
+
+    :return: tuple, 1. the mean position of each box [nbox], 2. the NaN
+             median of each box [nrows, nbox], 3. whether each box has
+             enough (finite) points [nrows, nbox]
+    """
+    # make sure we have a float array
+    if not np.issubdtype(vects.dtype, np.floating):
+        vects = vects.astype(float)
+    npix = vects.shape[1]
+    # the start of each box (we go 'off the edge' at the start and end of
+    #    the vector, which gives an effectively smaller box at the edges)
+    starts = np.arange(-width // 2, npix + width // 2, width // 4)
+    # the box bounds (the upper bound is capped at the last pixel, which is
+    #    therefore never used)
+    low_bound = np.clip(starts, 0, npix - 1)
+    high_bound = np.clip(starts + int(width), low_bound, npix - 1)
+    # number of pixels and of finite pixels in each box
+    npixval = high_bound - low_bound
+    finite = np.isfinite(vects[:, :npix - 1])
+    cumfinite = np.zeros((len(vects), npix), dtype=int)
+    cumfinite[:, 1:] = np.cumsum(finite, axis=1)
+    nfinite = cumfinite[:, high_bound] - cumfinite[:, low_bound]
+    # do not low pass if not enough points (or not enough finite points)
+    valid = (npixval >= 3) & (nfinite >= 3)
+    # mean position along vector of each box
+    xmed = (low_bound + high_bound - 1) / 2
+    # pad the vectors with NaNs so that every box has the full width (NaNs
+    #    are ignored by the NaN median)
+    pad_low = max(-int(starts[0]), 0)
+    pad_high = max(int(starts[-1]) + int(width) - (npix - 1), 0)
+    padded = np.full((len(vects), pad_low + npix - 1 + pad_high), np.nan,
+                     dtype=vects.dtype)
+    padded[:, pad_low:pad_low + npix - 1] = vects[:, :npix - 1]
+    # a (strided) view of every box
+    windows = np.lib.stride_tricks.sliding_window_view(padded, int(width),
+                                                       axis=1)
+    windows = windows[:, starts + pad_low]
+    # NaN median of each box
+    with warnings.catch_warnings(record=True) as _:
+        ymed = np.array(nanmedian(windows, axis=2), dtype=float)
+    # return the box positions, medians and valid flags
+    return xmed, np.atleast_2d(ymed), valid
+
+
+def _lowpass_spline(xmed: np.ndarray, ymed: np.ndarray, npix: int,
+                    k: int) -> np.ndarray:
+    """
+    Spline the running NaN medians of lowpassfilter back onto all pixels
+
+    :param xmed: numpy 1D array, the mean position of each valid box
+    :param ymed: numpy 1D array, the NaN median of each valid box
+    :param npix: int, the number of pixels in the vector
+    :param k: int, order of the spline used (passed to IUVSpline)
+
+    :return: numpy 1D array, the low pass filtered vector
+    """
     # low pass with a mean
     if len(xmed) != len(np.unique(xmed)):
-        xmed2 = np.unique(xmed)
-        ymed2 = np.zeros_like(xmed2)
-        for i in range(len(xmed2)):
-            ymed2[i] = np.mean(ymed[xmed == xmed2[i]])
+        xmed2, index = np.unique(xmed, return_inverse=True)
+        ymed2 = np.bincount(index, weights=ymed) / np.bincount(index)
         xmed = xmed2
         ymed = ymed2
     # splining the vector
     spline = iuv_spline(xmed, ymed, k=k, ext=3)
-    lowpass = spline(np.arange(len(input_vect)))
+    lowpass = spline(np.arange(npix))
     # return the low pass filtered input vector
     return lowpass
 
@@ -775,6 +1529,137 @@ def estimate_sigma(tmp: np.ndarray, sigma=1.0) -> float:
     return (upper - lower) / 2.0
 
 
+def nanpercentile_rows(values: np.ndarray,
+                       percentiles: Union[List[float], np.ndarray]
+                       ) -> np.ndarray:
+    """
+    NaN percentiles (numpy 'linear' method, same as np.nanpercentile on each
+    row) of every row of a 2D array, with a single sort of all rows
+
+    :param values: np.array (2D), the rows [nrows, nvalues]
+    :param percentiles: list or np.array (1D), the percentiles (0 to 100)
+
+    :return: np.array (2D), the percentiles of each row [npercentiles, nrows]
+             (NaN for rows without any non-NaN values)
+    """
+    # sort each row (NaNs go to the end)
+    svalues = np.sort(np.asarray(values, dtype=float), axis=-1)
+    # the number of non-NaN values in each row
+    count = np.sum(~np.isnan(svalues), axis=-1)
+    # the rows with no values
+    empty = count == 0
+    count = np.maximum(count, 1)
+    rows = np.arange(len(svalues))
+    # storage for the outputs
+    out = np.full((len(percentiles), len(svalues)), np.nan)
+    # loop around percentiles
+    for it, percentile in enumerate(percentiles):
+        # the position of this percentile in each (sorted) row
+        virtual = (count - 1) * np.true_divide(percentile, 100)
+        previous = np.floor(virtual)
+        gamma = virtual - previous
+        previous = np.clip(previous.astype(int), 0, count - 1)
+        following = np.minimum(previous + 1, count - 1)
+        # linear interpolation between the neighbouring values (as numpy)
+        lower = svalues[rows, previous]
+        upper = svalues[rows, following]
+        diff = upper - lower
+        lerp = lower + diff * gamma
+        out[it] = np.where(gamma >= 0.5, upper - diff * (1 - gamma), lerp)
+    # rows without values are NaN
+    out[:, empty] = np.nan
+    # return the percentiles
+    return out
+
+
+def estimate_sigma_rows(values: np.ndarray, sigma=1.0) -> np.ndarray:
+    """
+    Return a robust estimate of N sigma away from the mean (see
+    estimate_sigma) for every row of a 2D array
+
+    :param values: np.array (2D) - the data to estimate N sigma of (per row)
+    :param sigma: float, the number of sigma to calculate for
+
+    :return: np.array (1D), the 1 sigma value of each row (NaN if a row has
+             no finite values)
+    """
+    # get formal definition of N sigma
+    sig1 = normal_fraction(sigma)
+    # get the 1 sigma as a percentile
+    p1 = (1 - (1 - sig1) / 2) * 100
+    # work out the upper and lower percentiles for 1 sigma
+    upper, lower = nanpercentile_rows(values, [p1, 100 - p1])
+    # return the mean of these two bounds
+    return (upper - lower) / 2.0
+
+
+def group_index(labels: np.ndarray
+                ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sort a set of labels into groups once (for grouped_nanmedian, or to get
+    the rows of each group). The rows of group i are
+    order[bounds[i]:bounds[i + 1]] (in their original order).
+
+    :param labels: np.array (1D), the group label of each row
+
+    :return: tuple, 1. the unique labels (sorted), 2. the order of the rows
+             (sorted by group), 3. the bounds of each group in the order
+             [ngroups + 1]
+    """
+    # sort the labels (stable so rows keep their order within a group)
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    slabels = labels[order]
+    # find where the label changes
+    starts = np.flatnonzero(slabels[1:] != slabels[:-1]) + 1
+    bounds = np.concatenate([[0], starts, [len(labels)]]).astype(int)
+    # return the unique labels, the order and the group bounds
+    return slabels[bounds[:-1]], order, bounds
+
+
+def grouped_nanmedian(values: np.ndarray, order: np.ndarray,
+                      bounds: np.ndarray, min_rows: int = 1) -> np.ndarray:
+    """
+    NaN median of the rows of each group (same as np.nanmedian(axis=0) on
+    the rows of each group) for every column of a 2D array. The rows are
+    gathered into group order once, each group is then a contiguous block.
+
+    :param values: np.array (2D), the values [nrows, ncolumns]
+    :param order: np.array (1D), the order of the rows (from group_index)
+    :param bounds: np.array (1D), the bounds of each group (from
+                   group_index)
+    :param min_rows: int, groups with fewer rows than this are not computed
+                     (left as NaN)
+
+    :return: np.array (2D), the median of each group [ngroups, ncolumns]
+             (NaN where a group has no non-NaN values)
+    """
+    # gather the rows in group order (one copy)
+    svalues = np.asarray(values, dtype=float)[order]
+    # storage for the outputs
+    out = np.full((len(bounds) - 1, svalues.shape[1]), np.nan)
+    columns = np.arange(svalues.shape[1])
+    # loop around groups
+    for it in range(len(bounds) - 1):
+        # skip groups with too few rows
+        if bounds[it + 1] - bounds[it] < max(min_rows, 1):
+            continue
+        # sort the block of this group (NaNs go to the end)
+        block = np.sort(svalues[bounds[it]:bounds[it + 1]], axis=0)
+        # the number of non-NaN values in each column
+        count = np.sum(~np.isnan(block), axis=0)
+        # the middle value(s) of each column
+        high = np.minimum(count // 2, len(block) - 1)
+        low = np.maximum(count - 1, 0) // 2
+        lower, upper = block[low, columns], block[high, columns]
+        # mean of the middle values (as numpy)
+        median = np.where(count % 2 == 1, lower, (lower + upper) / 2)
+        # columns without values are NaN
+        out[it] = np.where(count > 0, median, np.nan)
+    # return the medians
+    return out
+
+
 def curve_fit(*args, funcname: Union[str, None] = None, **kwargs):
     """
     Wrapper around curve_fit to catch a curve_fit error
@@ -923,6 +1808,90 @@ def val_cheby(coeffs: np.ndarray, xvector: Union[np.ndarray, int, float],
     return yvector
 
 
+def convolve_same(vector: np.ndarray, kernel: np.ndarray,
+                  normalize: bool = False, min_weight: float = 0.5,
+                  method: str = 'auto') -> np.ndarray:
+    """
+    Convolution in "same" mode (as np.convolve(vector, kernel, mode='same'))
+    that switches to an overlap-add FFT convolution for large kernels
+
+    NaNs are never passed to the FFT (they would spread over a full block):
+
+    - if normalize is False, a NaN makes every output pixel within the
+      kernel support NaN (as with np.convolve)
+    - if normalize is True, this is a normalized convolution: NaNs have zero
+      weight, the result is divided by the valid kernel weight (which also
+      removes edge effects) and pixels with less than min_weight of the
+      kernel weight valid are set to NaN
+
+    :param vector: np.ndarray, the vector to convolve
+    :param kernel: np.ndarray, the convolution kernel
+    :param normalize: bool, if True do a normalized convolution (see above)
+    :param min_weight: float, the minimum fraction of the kernel weight that
+                       must be valid (only used if normalize is True)
+    :param method: str, 'direct' (np.convolve), 'fft' (overlap-add) or
+                   'auto' (fft for kernels longer than CONV_DIRECT_MAX)
+
+    :return: np.ndarray, the convolved vector
+    """
+    # deal with bad method
+    if method not in ['auto', 'direct', 'fft']:
+        emsg = 'convolve_same method={0} is not valid'
+        raise base_classes.LblException(emsg.format(method))
+    # get the arrays
+    vector = np.asarray(vector, dtype=float)
+    kernel = np.asarray(kernel, dtype=float)
+    # choose the method (on the shortest of the two inputs)
+    if method == 'auto':
+        if min(len(vector), len(kernel)) > CONV_DIRECT_MAX:
+            method = 'fft'
+        else:
+            method = 'direct'
+    # find the valid pixels
+    valid = np.isfinite(vector)
+    # convolve the valid data (NaNs set to zero)
+    if np.all(valid):
+        conv = _convolve_same(vector, kernel, method)
+    else:
+        conv = _convolve_same(np.where(valid, vector, 0.0), kernel, method)
+    # deal with the normalized convolution
+    if normalize:
+        # the fraction of the kernel weight on valid pixels
+        weight = _convolve_same(valid.astype(float), kernel, method)
+        weight /= np.sum(kernel)
+        # pixels with too little valid weight are NaN
+        good = weight >= min_weight
+        conv[good] /= weight[good]
+        conv[~good] = np.nan
+    # otherwise NaNs propagate within the kernel support
+    elif not np.all(valid):
+        support = (kernel != 0).astype(float)
+        ninvalid = _convolve_same((~valid).astype(float), support, method)
+        conv[ninvalid > 0.5] = np.nan
+    # return the convolved vector
+    return conv
+
+
+def _convolve_same(vector: np.ndarray, kernel: np.ndarray,
+                   method: str) -> np.ndarray:
+    """
+    Convolution in "same" mode of finite arrays (for convolve_same)
+
+    :param vector: np.ndarray, the vector to convolve
+    :param kernel: np.ndarray, the convolution kernel
+    :param method: str, 'direct' or 'fft'
+
+    :return: np.ndarray, the convolved vector (of the length of the longest
+             input, as np.convolve)
+    """
+    if method == 'direct':
+        return np.convolve(vector, kernel, mode='same')
+    # np.convolve returns the length of the longest input
+    if len(kernel) > len(vector):
+        vector, kernel = kernel, vector
+    return signal.oaconvolve(vector, kernel, mode='same')
+
+
 def rot_broad(wvl: np.ndarray, flux: np.ndarray, epsilon: float, vsini: float,
               eff_wvl: Optional[float] = None) -> np.ndarray:
     """
@@ -937,7 +1906,8 @@ def rot_broad(wvl: np.ndarray, flux: np.ndarray, epsilon: float, vsini: float,
     wavelength dependent, because the Doppler shift depends
     on wavelength. This function neglects this dependence, which
     is weak if the wavelength range is not too large.
-    .. note:: numpy.convolve is used to carry out the convolution
+    .. note:: convolve_same (numpy.convolve or an overlap-add FFT for
+              large kernels) is used to carry out the convolution
               and "mode = same" is used. Therefore, the output
               will be of the same size as the input, but it
               will show edge effects.
@@ -1001,7 +1971,7 @@ def rot_broad(wvl: np.ndarray, flux: np.ndarray, epsilon: float, vsini: float,
     indi = np.where(bprof > 0.0)[0]
     bprof = bprof[indi]
     # -------------------------------------------------------------------------
-    result = np.convolve(flux, bprof, mode="same") * dwl
+    result = convolve_same(flux, bprof) * dwl
     return result
 
 
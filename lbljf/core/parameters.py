@@ -140,6 +140,22 @@ params.set(key='TOTAL', value=-1, source=__NAME__, dtype=int,
                 '-1 means no multiprocessing',
            arg='--total')
 
+# Define the number of cores to use (in-process multiprocessing)
+#     1 means no multiprocessing (files are shared between the workers)
+params.set(key='NCORES', value=1, source=__NAME__, dtype=int,
+           desc='the number of cores to use for in-process multiprocessing '
+                'over science files (1 means no multiprocessing)',
+           arg='--ncores')
+
+# Define the scratch directory for temporary files (e.g. memmaps). Each run
+#     uses its own sub-directory that is removed at the end of the run.
+#     None means the system (node-local) temporary directory
+params.set(key='SCRATCH_DIR', value=None, source=__NAME__, dtype=str,
+           desc='the scratch directory for temporary files such as memmaps '
+                '(None for the system temporary directory). Each run uses '
+                'its own sub-directory that is removed at the end of the run',
+           arg='--scratch_dir')
+
 # =============================================================================
 # Define common parameters (between compute / compil)
 # =============================================================================
@@ -320,6 +336,80 @@ params.set(key='ROTBROAD', value=None, source=__NAME__,
                  'vsini in km/s as defined in the PyAstronomy.pyasl.rotBroad'
                  'function.'), not_none=True)
 
+# define the engine used to compute the line-by-line velocities in compute rv
+#    'numba' uses compiled (parallel) kernels (requires numba),
+#    'numpy' computes all lines at once with segment reductions,
+#    'legacy' loops over the lines one at a time
+params.set(key='COMPUTE_ENGINE', value='numpy', source=__NAME__,
+           desc=('The engine used to compute the line-by-line velocities '
+                 'in compute rv. "numba" uses compiled kernels (requires '
+                 'numba), "numpy" computes all lines at once, "legacy" '
+                 'loops over the lines one at a time'),
+           options=['numba', 'numpy', 'legacy'])
+
+# define how the template model is evaluated in compute rv
+#    'spline' evaluates the template splines directly,
+#    'loglambda' resamples them on an oversampled uniform log-wavelength grid
+#    (a doppler shift is then an index offset plus a local interpolation)
+params.set(key='COMPUTE_MODEL_BACKEND', value='spline', source=__NAME__,
+           desc=('How the template model is evaluated in compute rv. '
+                 '"spline" evaluates the template splines, "loglambda" '
+                 'resamples them on an oversampled log-wavelength grid'),
+           options=['spline', 'loglambda'])
+
+# define the oversampling of the log-wavelength grid (relative to the
+#    template sampling) when COMPUTE_MODEL_BACKEND='loglambda'
+params.set(key='LOGLAMBDA_OVERSAMPLING', value=4, source=__NAME__, dtype=int,
+           desc=('The oversampling of the log-wavelength grid (relative to '
+                 'the template sampling) when '
+                 'COMPUTE_MODEL_BACKEND="loglambda"'))
+
+# define the number of threads used (per process) to update the model and
+#    estimate the noise order by order in compute rv (1 means no threads).
+#    Bounded by the number of cpus divided by NCORES
+params.set(key='COMPUTE_NTHREADS', value=1, source=__NAME__, dtype=int,
+           desc=('The number of threads used per process to update the '
+                 'model and estimate the noise order by order in compute '
+                 'rv (1 means no threads)'))
+
+# define whether to time the stages of compute rv (written to a JSON-lines
+#    file in the lblrv directory and summarised at the end of lbl_compute)
+params.set(key='COMPUTE_PROFILE', value=False, source=__NAME__, dtype=bool,
+           desc=('Whether to time the stages of compute rv (written to '
+                 'a JSON-lines file in the lblrv directory)'),
+           arg='--profile')
+
+# define the precision of the science and model arrays in compute rv
+#    'float32' halves the memory used (line sums are always done in float64)
+params.set(key='COMPUTE_PRECISION', value='float64', source=__NAME__,
+           dtype=str,
+           desc=('The precision of the science and model arrays in compute '
+                 'rv ("float64" or "float32"). Line sums are always done in '
+                 'float64'),
+           options=['float64', 'float32'])
+
+# define whether compute rv starts from the previous (converged) file: the
+#    systemic velocity (corrected for the BERV difference) and the low-pass
+#    ratio (if the blaze and wave solution match). Falls back to a cold start
+#    if the warm started rv does not converge. Not used for the files
+#    processed in parallel (NCORES > 1)
+params.set(key='COMPUTE_WARM_START', value=False, source=__NAME__,
+           dtype=bool,
+           desc=('Whether compute rv starts from the systemic velocity and '
+                 'low-pass ratio of the previous (converged) file'),
+           arg='--warm_start')
+
+# define whether the template splines are cached on disk (in the cache
+#    directory of the data directory). Splines are keyed by the content of
+#    the template (and resproj tables), the systemic velocity and all the
+#    parameters used to build them, so a change of any of these rebuilds them.
+#    Off by default (each cache can take hundreds of MB of disk space)
+params.set(key='SPLINE_CACHE', value=False, source=__NAME__, dtype=bool,
+           desc=('Whether the template splines are cached on disk (and '
+                 'reloaded by memory-mapping when the template, resproj '
+                 'tables, systemic velocity and parameters are unchanged)'),
+           arg='--spline_cache')
+
 # =============================================================================
 # Define compil parameters
 # =============================================================================
@@ -552,6 +642,23 @@ params.set('BERVBIN_MIN_ENTRIES', value=3, source=__NAME__,
 params.set('BERVBIN_SIZE', value=3000, source=__NAME__,
            desc='define the berv bin size in m/s')
 
+# define the maximum number of cube elements (spectra x wavelengths) held in
+#    memory at once when building the template. The cube is processed in
+#    wavelength chunks (and blocks of spectra) of this size so the memory
+#    used does not depend on the number of files
+params.set('TEMPLATE_CHUNK_SIZE', value=2 ** 22, source=__NAME__,
+           desc='the maximum number of cube elements (spectra x '
+                'wavelengths) held in memory at once when building the '
+                'template', dtype=int, arg='--template_chunk_size')
+
+# define whether to keep a persistent S1D cube per object (in the cache
+#    directory) so a template run only computes the S1D of new files
+params.set('TEMPLATE_CUBE', value=False, source=__NAME__,
+           desc='keep a persistent S1D cube per object so a template run '
+                'only computes the S1D of new (or modified) files and only '
+                'rebuilds an existing template when the files have changed',
+           dtype=bool, arg='--template_cube')
+
 # define the wave solution polynomial type (Chebyshev or numpy)
 params.set('WAVE_POLY_TYPE', value='numpy', source=__NAME__,
            desc='define the wave solution polynomial type '
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the compute rv model evaluation backends
+(COMPUTE_MODEL_BACKEND = 'spline' or 'loglambda')
+
+Builds the template splines with both backends and evaluates the model
+(spline0, dspline, d2spline, d3spline) on the wave grid of the first few
+science files over a range of velocities around the systemic velocity.
+Reports the build time, the evaluation time and the difference between the
+two backends (relative to the rms of the spline model).
+
+Usage (same arguments as lbl_compute, e.g. a demo config file):
+
+    python benchmark_model_backend.py --config=spirou_config.yaml
+
+Created on 2026-10-18
+
+@author: cook
+"""
+import time
+
+import numpy as np
+
+from lbljf.core import base
+from lbljf.core import base_classes
+from lbljf.core import math as mp
+from lbljf.instruments import select
+from lbljf.recipes import lbl_compute
+from lbljf.science import general
+
+# =============================================================================
+# Define variables
+# =============================================================================
+__NAME__ = 'benchmark_model_backend.py'
+__version__ = base.__version__
+__date__ = base.__date__
+__authors__ = base.__authors__
+# get classes
+log = base_classes.log
+# the backends to compare (the first is the reference)
+BACKENDS = ['spline', 'loglambda']
+# the template splines used by compute rv
+MODEL_KEYS = ['spline0', 'dspline', 'd2spline', 'd3spline']
+# the number of science files to test
+NUM_FILES = 5
+# the velocity offsets (m/s) to test around the systemic velocity
+VELOCITIES = np.linspace(-5000, 5000, 11)
+
+
+# =============================================================================
+# Define functions
+# =============================================================================
+def main(**kwargs):
+    """
+    Run the model backend benchmark
+
+    :param kwargs: kwargs to parse to instrument (same as lbl_compute)
+
+    :return: dict, for each backend the build time, the evaluation time and
+             for each model spline the maximum relative difference to the
+             reference backend
+    """
+    # deal with parsing arguments
+    args = select.parse_args(lbl_compute.ARGS_COMPUTE, kwargs,
+                             'Benchmark the compute rv model backends')
+    # load instrument
+    inst = select.load_instrument(args, plogger=log)
+    # get the directories and files (as in lbl_compute)
+    dparams = select.make_all_directories(inst)
+    mask_file = inst.mask_file(dparams['MODEL_DIR'], dparams['MASK_DIR'])
+    template_file = inst.template_file(dparams['TEMPLATE_DIR'])
+    science_files = inst.science_files(dparams['SCIENCE_DIR'])
+    # get the systemic velocity properties
+    sys_props = general.get_systemic_vel_props(inst, template_file, mask_file)
+    # get the wave grids and shifts of the science files
+    wavegrids, shifts = [], []
+    for science_file in science_files[:NUM_FILES]:
+        sci_data, sci_hdr = inst.load_science_file(science_file)
+        wavegrids.append(inst.get_wave_solution(science_file, sci_data,
+                                                sci_hdr))
+        shifts.append(inst.get_berv(sci_hdr) - sys_props['VSYS'])
+    # storage for results
+    results, models = dict(), dict()
+    # loop around backends
+    for backend in BACKENDS:
+        inst.params['COMPUTE_MODEL_BACKEND'] = backend
+        # time the construction of the splines
+        start = time.perf_counter()
+        splines = general.spline_template(inst, template_file,
+                                          sys_props['MASK_SYS_VEL'],
+                                          dparams['MODEL_DIR'])
+        build_time = time.perf_counter() - start
+        # time the evaluation of the models
+        models[backend] = dict()
+        start = time.perf_counter()
+        for key in MODEL_KEYS:
+            models[backend][key] = []
+            for it, wavegrid in enumerate(wavegrids):
+                for velocity in VELOCITIES:
+                    wave = mp.doppler_shift(wavegrid, -shifts[it] - velocity)
+                    models[backend][key].append(splines[key](wave))
+        eval_time = time.perf_counter() - start
+        # push into results
+        results[backend] = dict(BUILD_TIME=build_time, EVAL_TIME=eval_time)
+    # compare to the reference backend
+    for backend in BACKENDS:
+        for key in MODEL_KEYS:
+            ref = np.array(models[BACKENDS[0]][key])
+            diff = np.array(models[backend][key]) - ref
+            results[backend][key] = mp.nanmax(np.abs(diff)) / mp.nanstd(ref)
+    # print the results
+    log.info('{0:12s} {1:>10s} {2:>10s} '.format('backend', 'build[s]',
+                                                 'eval[s]') +
+             ' '.join(['{0:>10s}'.format(key) for key in MODEL_KEYS]))
+    for backend in BACKENDS:
+        res = results[backend]
+        msg = '{0:12s} {1:10.2f} {2:10.3f} '.format(backend, res['BUILD_TIME'],
+                                                    res['EVAL_TIME'])
+        msg += ' '.join(['{0:10.2e}'.format(res[key]) for key in MODEL_KEYS])
+        log.info(msg)
+    # return the results
+    return results
+
+
+# =============================================================================
+# Start of code
+# =============================================================================
+if __name__ == "__main__":
+    # run main
+    _ = main()
+
+# =============================================================================
+# End of code
+# =============================================================================
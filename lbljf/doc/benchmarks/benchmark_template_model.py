@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the stacked template model (mp.SplineStack)
+
+The template splines (spline0, spline, dspline, d2spline, d3spline) share
+their knots, so spline_template stacks them and compute rv evaluates the
+model and its (gradient based) derivatives in one pass. This rebuilds the
+individual FITPACK splines from the stacked coefficients (as spline_template
+made them before) and, on the wave grid of the first few science files over
+a range of velocities, reports the evaluation time of both and the
+difference between them (relative to the rms of each curve).
+
+It also reports how far the analytic derivative of the flux spline is from
+the gradient based dspline (the reason the derivatives keep their own
+coefficients).
+
+Usage (same arguments as lbl_compute, e.g. a demo config file):
+
+    python benchmark_template_model.py --config=spirou_config.yaml
+
+Created on 2026-10-18
+
+@author: cook
+"""
+import time
+
+import numpy as np
+
+from lbljf.core import base
+from lbljf.core import base_classes
+from lbljf.core import math as mp
+from lbljf.instruments import select
+from lbljf.recipes import lbl_compute
+from lbljf.science import general
+
+# =============================================================================
+# Define variables
+# =============================================================================
+__NAME__ = 'benchmark_template_model.py'
+__version__ = base.__version__
+__date__ = base.__date__
+__authors__ = base.__authors__
+# get classes
+log = base_classes.log
+# the template splines used by compute rv
+MODEL_KEYS = ['spline0', 'dspline', 'd2spline', 'd3spline']
+# the number of science files to test
+NUM_FILES = 5
+# the velocity offsets (m/s) to test around the systemic velocity
+VELOCITIES = np.linspace(-5000, 5000, 11)
+# speed of light in m/s
+speed_of_light_ms = general.speed_of_light_ms
+
+
+# =============================================================================
+# Define functions
+# =============================================================================
+def main(**kwargs):
+    """
+    Run the stacked template model benchmark
+
+    :param kwargs: kwargs to parse to instrument (same as lbl_compute)
+
+    :return: dict, the evaluation times, for each model spline the maximum
+             relative difference between the stacked and individual splines
+             and the maximum relative difference between the analytic and
+             gradient based first derivative
+    """
+    # deal with parsing arguments
+    args = select.parse_args(lbl_compute.ARGS_COMPUTE, kwargs,
+                             'Benchmark the stacked template model')
+    # load instrument
+    inst = select.load_instrument(args, plogger=log)
+    # the stacked model is only used by the spline backend
+    inst.params['COMPUTE_MODEL_BACKEND'] = 'spline'
+    # get the directories and files (as in lbl_compute)
+    dparams = select.make_all_directories(inst)
+    mask_file = inst.mask_file(dparams['MODEL_DIR'], dparams['MASK_DIR'])
+    template_file = inst.template_file(dparams['TEMPLATE_DIR'])
+    science_files = inst.science_files(dparams['SCIENCE_DIR'])
+    # get the systemic velocity properties and splines
+    sys_props = general.get_systemic_vel_props(inst, template_file, mask_file)
+    splines = general.spline_template(inst, template_file,
+                                      sys_props['MASK_SYS_VEL'],
+                                      dparams['MODEL_DIR'])
+    # rebuild the individual splines from the stacked coefficients
+    stack = splines['spline0'].stack
+    individual = dict()
+    for key in MODEL_KEYS:
+        coeffs = np.array(stack.coeffs[:, stack.names.index(key)])
+        tck = (stack.knots, coeffs, stack.k)
+        individual[key] = mp.IUVSpline._from_tck(tck, ext=1)
+    # get the doppler shifted wave grids of the science files
+    waves = []
+    for science_file in science_files[:NUM_FILES]:
+        sci_data, sci_hdr = inst.load_science_file(science_file)
+        wavegrid = inst.get_wave_solution(science_file, sci_data, sci_hdr)
+        shift = inst.get_berv(sci_hdr) - sys_props['VSYS']
+        for velocity in VELOCITIES:
+            waves.append(mp.doppler_shift(wavegrid, -shift - velocity))
+    # storage for results
+    results = dict()
+    # time the individual splines (order by order, as compute rv)
+    start = time.perf_counter()
+    models_ind = [mp.evaluate_splines(individual, MODEL_KEYS, wave_ord)
+                  for wave in waves for wave_ord in wave]
+    results['INDIVIDUAL_TIME'] = time.perf_counter() - start
+    # time the stacked splines (order by order, as compute rv)
+    start = time.perf_counter()
+    models_stack = [mp.evaluate_splines(splines, MODEL_KEYS, wave_ord)
+                    for wave in waves for wave_ord in wave]
+    results['STACKED_TIME'] = time.perf_counter() - start
+    # compare the stacked to the individual splines
+    for key in MODEL_KEYS:
+        ref = np.concatenate([model[key] for model in models_ind])
+        value = np.concatenate([model[key] for model in models_stack])
+        results[key] = mp.nanmax(np.abs(value - ref)) / mp.nanstd(ref)
+    # compare the analytic derivative of the flux spline to dspline
+    #    (d flux / d v = wave * d flux / d wave / c)
+    wave = np.concatenate([wave_ord for wave in waves for wave_ord in wave])
+    analytic = splines['spline'].derivative()(wave) * wave / speed_of_light_ms
+    gradient = splines['dspline'](wave)
+    diff = mp.nanmax(np.abs(analytic - gradient)) / mp.nanstd(gradient)
+    results['ANALYTIC_DSPLINE'] = diff
+    # log the results
+    msg = 'Evaluation time: individual {0:.3f} s, stacked {1:.3f} s'
+    log.info(msg.format(results['INDIVIDUAL_TIME'], results['STACKED_TIME']))
+    for key in MODEL_KEYS:
+        msg = '{0:10s} max|stacked - individual| / rms = {1:.2e}'
+        log.info(msg.format(key, results[key]))
+    msg = 'max|analytic - gradient| / rms for dspline = {0:.2e}'
+    log.info(msg.format(results['ANALYTIC_DSPLINE']))
+    # return the results
+    return results
+
+
+# =============================================================================
+# Start of code
+# =============================================================================
+if __name__ == "__main__":
+    # run main
+    _ = main()
+
+# =============================================================================
+# End of code
+# =============================================================================
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Validation of the compute rv working precision
+(COMPUTE_PRECISION = 'float64' or 'float32')
+
+Runs compute_rv on the first few science files with both precisions (no
+lblrv files are written) and reports, for each file, the difference in the
+bulk velocity (odd ratio mean of the line velocities), the largest per-line
+velocity difference relative to the line uncertainty and the memory used
+by the science / model arrays.
+
+Usage (same arguments as lbl_compute, e.g. a demo config file):
+
+    python validate_compute_precision.py --config=spirou_config.yaml
+
+Created on 2026-10-18
+
+@author: cook
+"""
+import copy
+
+import numpy as np
+
+from lbljf.core import base
+from lbljf.core import base_classes
+from lbljf.core import math as mp
+from lbljf.instruments import select
+from lbljf.recipes import lbl_compute
+from lbljf.science import general
+
+# =============================================================================
+# Define variables
+# =============================================================================
+__NAME__ = 'validate_compute_precision.py'
+__version__ = base.__version__
+__date__ = base.__date__
+__authors__ = base.__authors__
+# get classes
+log = base_classes.log
+LblLowCCFSNR = base_classes.LblLowCCFSNR
+# the precisions to compare (the first is the reference)
+PRECISIONS = ['float64', 'float32']
+# the number of science files to test
+NUM_FILES = 5
+# the number of [norder, npix] arrays compute rv keeps in the working
+#    precision (sci_data, sci_data0, model, model0, dmodel, d2model, d3model,
+#    ratio, rms) - plus one per residual projection table
+NUM_ARRAYS = 9
+
+
+# =============================================================================
+# Define functions
+# =============================================================================
+def main(**kwargs):
+    """
+    Run the compute rv precision validation
+
+    :param kwargs: kwargs to parse to instrument (same as lbl_compute)
+
+    :return: dict, for each science file the bulk velocity difference (m/s),
+             the bulk velocity uncertainty (m/s) and the maximum per-line
+             velocity difference relative to the line uncertainty
+    """
+    # deal with parsing arguments
+    args = select.parse_args(lbl_compute.ARGS_COMPUTE, kwargs,
+                             'Validate the compute rv precision')
+    # load instrument
+    inst = select.load_instrument(args, plogger=log)
+    # get the directories and files (as in lbl_compute)
+    dparams = select.make_all_directories(inst)
+    mask_file = inst.mask_file(dparams['MODEL_DIR'], dparams['MASK_DIR'])
+    template_file = inst.template_file(dparams['TEMPLATE_DIR'])
+    blaze_file = inst.blaze_file(dparams['CALIB_DIR'])
+    science_files = inst.science_files(dparams['SCIENCE_DIR'])
+    science_files = inst.sort_science_files(science_files)
+    reftable_file, reftable_exists = inst.ref_table_file(dparams['LBLRT_DIR'],
+                                                         mask_file)
+    # load the blaze (if set)
+    if blaze_file is not None:
+        blaze = inst.load_blaze(blaze_file, science_file=science_files[0])
+    else:
+        blaze = None
+    # get the ref table, systemic velocity properties and splines
+    ref_table = general.make_ref_dict(inst, reftable_file, reftable_exists,
+                                      science_files, mask_file,
+                                      dparams['CALIB_DIR'])
+    sys_props = general.get_systemic_vel_props(inst, template_file, mask_file)
+    splines = general.spline_template(inst, template_file,
+                                      sys_props['MASK_SYS_VEL'],
+                                      dparams['MODEL_DIR'])
+    # get the number of arrays in the working precision
+    num_arrays = NUM_ARRAYS
+    if isinstance(inst.params['RESPROJ_TABLES'], dict):
+        num_arrays += len(inst.params['RESPROJ_TABLES'])
+    # storage for the results
+    results = dict()
+    # the model velocity is measured on the first file (as in lbl_compute)
+    model_velocity = np.inf
+    # loop around science files
+    for science_file in science_files[:NUM_FILES]:
+        # load the science data
+        sci_data, sci_hdr = inst.load_science_file(science_file)
+        # load the blaze from the science file if not set
+        if blaze is None:
+            blaze, _ = inst.load_blaze_from_science(science_file, sci_data,
+                                                    sci_hdr,
+                                                    dparams['CALIB_DIR'])
+        # storage for the line velocities for each precision
+        lines = dict()
+        # loop around precisions
+        for precision in PRECISIONS:
+            inst.params['COMPUTE_PRECISION'] = precision
+            try:
+                cout = general.compute_rv(inst, 0, np.array(sci_data), sci_hdr,
+                                          splines=splines,
+                                          ref_table=copy.deepcopy(ref_table),
+                                          blaze=blaze,
+                                          systemic_props=sys_props,
+                                          systemic_all=np.full(1, np.nan),
+                                          mjdate_all=np.zeros(1),
+                                          model_velocity=model_velocity,
+                                          science_file=science_file,
+                                          mask_file=mask_file)
+            except LblLowCCFSNR as e:
+                log.warning(e.message + '\n Skipping file.')
+                break
+            # keep the line velocities and their uncertainties
+            lines[precision] = (np.array(cout[0]['dv'], dtype=float),
+                                np.array(cout[0]['sdv'], dtype=float))
+            # the reference precision sets the model velocity
+            if precision == PRECISIONS[0]:
+                model_velocity = cout[1]['MODEL_VELOCITY']
+        # deal with skipped files
+        if len(lines) != len(PRECISIONS):
+            continue
+        # compare to the reference precision
+        dv0, sdv0 = lines[PRECISIONS[0]]
+        dv1, sdv1 = lines[PRECISIONS[1]]
+        rv0, err0 = mp.odd_ratio_mean(dv0, sdv0)
+        rv1, _ = mp.odd_ratio_mean(dv1, sdv1)
+        max_dv = mp.nanmax(np.abs(dv1 - dv0) / sdv0)
+        results[science_file] = dict(DRV=rv1 - rv0, ERR=err0, MAX_DV=max_dv)
+    # log the memory used per worker by the working precision arrays
+    size = num_arrays * np.prod(np.shape(blaze))
+    for precision in PRECISIONS:
+        msg = 'Working arrays in {0}: {1:.1f} MB'
+        margs = [precision, size * np.dtype(precision).itemsize / 1e6]
+        log.info(msg.format(*margs))
+    # log the results
+    log.info('{0:40s} {1:>12s} {2:>12s} {3:>14s}'.format('file', 'dRV[m/s]',
+                                                         'sRV[m/s]',
+                                                         'max|ddv|/sdv'))
+    for science_file in results:
+        res = results[science_file]
+        msg = '{0:40s} {1:12.2e} {2:12.3f} {3:14.2e}'
+        margs = [science_file[-40:], res['DRV'], res['ERR'], res['MAX_DV']]
+        log.info(msg.format(*margs))
+    # return the results
+    return results
+
+
+# =============================================================================
+# Start of code
+# =============================================================================
+if __name__ == "__main__":
+    # run main
+    _ = main()
+
+# =============================================================================
+# End of code
+# =============================================================================
@@ -372,6 +372,8 @@ def make_all_directories(inst: Union[InstrumentsType],
     plot_dir = io.make_dir(data_dir, 'plots', 'Plot')
     # make the model directory
     model_dir = io.make_dir(data_dir, 'models', 'Model')
+    # make the cache directory (for cached template splines)
+    cache_dir = io.make_dir(data_dir, 'cache', 'Cache')
     # -------------------------------------------------------------------------
     # make sure we have all the model files
     inst.get_model_files(model_dir, inst.params['MODEL_REPO_URL'],
@@ -393,6 +395,7 @@ def make_all_directories(inst: Union[InstrumentsType],
     props.set('LBL_RDB_DIR', value=lbl_rdb_dir, source=func_name)
     props.set('PLOT_DIR', value=plot_dir, source=func_name)
     props.set('MODEL_DIR', value=model_dir, source=func_name)
+    props.set('CACHE_DIR', value=cache_dir, source=func_name)
     # return output directories
     return props
 
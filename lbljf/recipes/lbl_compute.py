@@ -9,11 +9,17 @@ Created on 2021-03-15
 
 @author: cook
 """
+import copy
+import multiprocessing
+import os
+from typing import Any, Dict, List, Tuple, Union
+
 import numpy as np
 
 from lbljf.core import base
 from lbljf.core import base_classes
 from lbljf.core import io
+from lbljf.core import math as mp
 from lbljf.instruments import select
 from lbljf.resources import lbl_misc
 from lbljf.science import general
@@ -47,15 +53,319 @@ ARGS_COMPUTE = [  # core
     # other
     'SKIP_DONE', 'VERBOSE', 'PROGRAM', 'MASK_FILE',
     # multiprocessing arguments
-    'ITERATION', 'TOTAL',
+    'ITERATION', 'TOTAL', 'NCORES',
+    # profiling / warm start / spline cache
+    'COMPUTE_PROFILE', 'COMPUTE_WARM_START', 'SPLINE_CACHE',
 ]
 
 DESCRIPTION_COMPUTE = 'Use this code to compute the LBL rv'
+# the JSON-lines file (in the lblrv directory) for the stage timings
+TIMING_FILE = 'lbl_compute_timings.jsonl'
+# the state shared with the workers in multiprocessing mode (set just before
+#   the worker pool is forked so workers inherit it copy-on-write)
+SHARED_STATE = dict()
 
 
 # =============================================================================
 # Define functions
 # =============================================================================
+def get_ncores(inst: InstrumentsType) -> int:
+    """
+    Get the number of cores to use for the in-process multiprocessing over
+    science files (1 if we cannot fork the process)
+
+    :param inst: Instrument instance
+
+    :return: int, the number of cores to use
+    """
+    # get the number of cores requested
+    ncores = inst.params['NCORES']
+    # deal with no value set
+    if ncores is None or ncores < 1:
+        return 1
+    # workers share the splines via fork (copy-on-write)
+    if ncores > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        wmsg = ('NCORES={0} requires the fork start method (not available). '
+                'Processing files sequentially.')
+        log.warning(wmsg.format(ncores))
+        return 1
+    # numba kernels run before and after the fork must use a fork safe
+    #    threading layer
+    if ncores > 1:
+        mp.use_fork_safe_threading()
+    # return the number of cores
+    return ncores
+
+
+def compute_science_file(inst: InstrumentsType, it: int, science_file: str,
+                         state: Dict[str, Any]
+                         ) -> Union[Dict[str, Any], None]:
+    """
+    Compute the rv of a single science file and save it to its lblrv file
+
+    :param inst: Instrument instance
+    :param it: int, the position of the science file in the list of files
+    :param science_file: str, the absolute path to the science file
+    :param state: dict, the splines, ref table, blaze, systemic properties
+                  and the iterables carried from file to file (updated in
+                  place)
+
+    :return: dict, the outputs of compute rv (None if the file was skipped)
+    """
+    # ---------------------------------------------------------------------
+    # 6.2 get lbl rv file and check whether it exists
+    # ---------------------------------------------------------------------
+    lblrv_file, lblrv_exists = inst.get_lblrv_file(science_file,
+                                                   state['LBLRV_DIR'])
+    # If output file exists then get the model velocity from here
+    if lblrv_exists and not np.isfinite(state['MODEL_VELOCITY']):
+        lblrv_hdr = inst.load_header(lblrv_file, kind='lblrv fits file')
+        model_velocity = lblrv_hdr.get_hkey(inst.params['KW_MODELVEL'],
+                                            dtype=float)
+        state['MODEL_VELOCITY'] = model_velocity
+        largs = [model_velocity]
+        log.general('We read model velo = {0:.2f} m/s'.format(*largs))
+    # if file exists and we are skipping done files
+    if lblrv_exists and inst.params['SKIP_DONE']:
+        # log message about skipping
+        log.general('\t\tFile exists and skipping activated. '
+                    'Skipping file.')
+        # skip
+        return None
+    # ---------------------------------------------------------------------
+    # 6.3 load science file
+    # ---------------------------------------------------------------------
+    sci_data, sci_hdr = inst.load_science_file(science_file)
+    # flag calibration file
+    if inst.params['DATA_TYPE'] != 'SCIENCE':
+        state['MODEL_VELOCITY'] = 0
+
+    # ---------------------------------------------------------------------
+    # 6.4 load blaze if not set above
+    # ---------------------------------------------------------------------
+    if state['BLAZE'] is None:
+        bout = inst.load_blaze_from_science(science_file, sci_data, sci_hdr,
+                                            state['CALIB_DIR'])
+        state['BLAZE'] = bout[0]
+    # ---------------------------------------------------------------------
+    # 6.5 check for bad files (via a header key)
+    # ---------------------------------------------------------------------
+    bad_hdr_keys, bad_hdr_key = state['BAD_HDR_KEYS'], state['BAD_HDR_KEY']
+    # check we have a bad hdr key
+    if bad_hdr_key is not None and bad_hdr_key in sci_hdr:
+        # get bad header key
+        sci_bad_hdr_key = sci_hdr.get_hkey(bad_hdr_key)
+        # if sci_bad_hdr_key in bad_hdr_keys
+        if str(sci_bad_hdr_key) in bad_hdr_keys:
+            # log message about bad header key
+            log.general('\t\tFile is known to be bad. Skipping file.')
+            # skip
+            return None
+    # ---------------------------------------------------------------------
+    # 6.6 quality control on snr
+    # ---------------------------------------------------------------------
+    # get snr key
+    snr_key = inst.params['KW_SNR']
+    snr_limit = inst.params['SNR_THRESHOLD']
+    # check we have snr key in science header
+    if snr_key in sci_hdr:
+        # get snr value
+        snr_value = sci_hdr.get_hkey(snr_key, dtype=float)
+        # check if value is less than limit
+        if snr_value < snr_limit:
+            # log message
+            msg = '\t\tSNR < {0} (SNR = {1}). Skipping file.'
+            margs = [snr_limit, snr_value]
+            log.general(msg.format(*margs))
+            # skip
+            return None
+        else:
+            # log message
+            msg = '\t\tSNR > {0} (SNR = {1:.4f}), passed SNR criteria'
+            margs = [snr_limit, snr_value]
+            log.general(msg.format(*margs))
+
+    # ---------------------------------------------------------------------
+    # 6.7 compute rv
+    # ---------------------------------------------------------------------
+    ckwargs = dict(splines=state['SPLINES'], ref_table=state['REF_TABLE'],
+                   blaze=state['BLAZE'],
+                   systemic_props=state['SYSTEMIC_PROPS'],
+                   systemic_all=state['SYSTEMIC_ALL'],
+                   mjdate_all=state['MJDATE_ALL'],
+                   ccf_ewidth=state['CCF_EWIDTH'],
+                   model_velocity=state['MODEL_VELOCITY'],
+                   science_file=science_file, mask_file=state['MASK_FILE'])
+    # get the warm start (from the previous converged file) if requested
+    warm_start = state['WARM_START']
+    # keep a copy of the science data (compute rv modifies it) in case we
+    #    have to fall back to a cold start
+    if warm_start is not None:
+        sci_data_cold = np.array(sci_data)
+    else:
+        sci_data_cold = None
+    try:
+        cout = general.compute_rv(inst, it, sci_data, sci_hdr,
+                                  reset_rv=state['RESET_RV'],
+                                  warm_start=warm_start, **ckwargs)
+        # fall back to a cold start if the warm started rv did not converge
+        if cout[1]['WARM_STARTED'] and cout[1]['RESET_RV']:
+            log.warning('Warm start did not converge. Recomputing from a '
+                        'cold start.')
+            warm_outputs = cout[1]
+            cout = general.compute_rv(inst, it, sci_data_cold, sci_hdr,
+                                      reset_rv=True, warm_start=None,
+                                      **ckwargs)
+            # the failed warm start counts towards the cost of this file
+            general.add_failed_warm_start(cout[1], warm_outputs)
+    except LblLowCCFSNR as e:
+        emsg = e.message + '\n Skipping file.'
+        log.warning(emsg)
+        return None
+    # get back ref_table and outputs
+    ref_table, outputs = cout
+    # ---------------------------------------------------------------------
+    # update iterables (for next iteration)
+    state['REF_TABLE'] = ref_table
+    state['SYSTEMIC_ALL'] = outputs['SYSTEMIC_ALL']
+    state['MJDATE_ALL'] = outputs['MJDATE_ALL']
+    state['RESET_RV'] = outputs['RESET_RV']
+    state['CCF_EWIDTH'] = outputs['CCF_EW']
+    state['MODEL_VELOCITY'] = outputs['MODEL_VELOCITY']
+    state['WARM_START'] = outputs['WARM_START']
+    # ---------------------------------------------------------------------
+    # 6.8 save to file
+    # ---------------------------------------------------------------------
+    inst.write_lblrv_table(ref_table, lblrv_file, sci_hdr, outputs)
+    # save the stage timings
+    if inst.params['COMPUTE_PROFILE']:
+        timing_file = os.path.join(state['LBLRV_DIR'], TIMING_FILE)
+        general.write_stage_timings(timing_file, science_file, outputs)
+    # return the outputs
+    return outputs
+
+
+def file_statistics(outputs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The run statistics of one file (from the outputs of compute rv)
+
+    :param outputs: dict, the outputs of compute rv
+
+    :return: dict, the total duration, stage timings, number of iterations,
+             whether the file was warm started and whether a warm start
+             failed (and the file was recomputed from a cold start)
+    """
+    return dict(TOTAL_DURATION=outputs['TOTAL_DURATION'],
+                STAGE_TIMINGS=outputs['STAGE_TIMINGS'],
+                NUM_ITERATIONS=outputs['NUM_ITERATIONS'],
+                WARM_STARTED=outputs['WARM_STARTED'],
+                WARM_START_FAILED=outputs['WARM_START_FAILED'])
+
+
+def _compute_worker(it: int) -> Tuple[int, Union[Dict[str, Any], None],
+                                      float, float]:
+    """
+    Worker for compute_parallel: compute the rv of one science file using the
+    state inherited (copy-on-write) from the parent process
+
+    :param it: int, the position of the science file in the list of files
+
+    :return: tuple, 1. the position of the science file, 2. the run
+             statistics (see file_statistics, None if skipped), 3. the
+             systemic velocity, 4. the mid exposure time (mjd)
+    """
+    # get the shared state (set before the pool was forked)
+    inst = SHARED_STATE['INST']
+    science_file = SHARED_STATE['SCIENCE_FILES'][it]
+    # the parallel numba kernels of each worker share the cpus (as the
+    #    order threads do, see general.get_compute_nthreads)
+    mp.set_numba_threads(base.cpu_count() // SHARED_STATE['NCORES'])
+    # every file starts from the same state (not the previous file done by
+    #    this worker) so results do not depend on the scheduling
+    state = dict(SHARED_STATE['STATE'])
+    state['REF_TABLE'] = copy.deepcopy(state['REF_TABLE'])
+    state['SYSTEMIC_ALL'] = np.array(state['SYSTEMIC_ALL'])
+    state['MJDATE_ALL'] = np.array(state['MJDATE_ALL'])
+    # compute the rv and save to file
+    outputs = compute_science_file(inst, it, science_file, state)
+    # only return the run statistics (the rest is in the lblrv file)
+    if outputs is not None:
+        outputs = file_statistics(outputs)
+    # return the values needed by the parent process
+    return it, outputs, state['SYSTEMIC_ALL'][it], state['MJDATE_ALL'][it]
+
+
+def compute_parallel(inst: InstrumentsType, science_files: List[str],
+                     positions: List[int], state: Dict[str, Any],
+                     ncores: int) -> List[Dict[str, Any]]:
+    """
+    Compute the rv of a set of science files with a pool of forked workers.
+    The splines, ref table, blaze and systemic properties are built once
+    (in state) and shared read-only with the workers (copy-on-write). Each
+    worker writes the lblrv file as soon as it has finished it.
+
+    :param inst: Instrument instance
+    :param science_files: list of str, all the science files
+    :param positions: list of int, the positions (in science_files) of the
+                      files to compute
+    :param state: dict, the state after the sequential files (must have a
+                  finite model velocity)
+    :param ncores: int, the number of workers
+
+    :return: list of dicts, the run statistics (see file_statistics) of the
+             files computed
+    """
+    # storage for the run statistics
+    stats = []
+    # nothing to do if we have no files left
+    if len(positions) == 0:
+        return stats
+    # log that we are processing in parallel
+    msg = 'Processing {0} files in parallel on {1} cores'
+    log.general(msg.format(len(positions), ncores))
+    # every worker starts from the same state, so a warm start would come
+    #    from the last sequential file (not the previous file) for all files
+    if state['WARM_START'] is not None:
+        log.warning('Warm start is not used for files processed in parallel '
+                    '(NCORES > 1).')
+        state['WARM_START'] = None
+    # set the shared state (inherited by the workers when forked)
+    SHARED_STATE['INST'] = inst
+    SHARED_STATE['SCIENCE_FILES'] = science_files
+    SHARED_STATE['STATE'] = state
+    SHARED_STATE['NCORES'] = ncores
+    # get the fork context
+    context = multiprocessing.get_context('fork')
+    # loop around files as they finish
+    try:
+        with context.Pool(processes=ncores) as pool:
+            results = pool.imap_unordered(_compute_worker, positions)
+            for count, result in enumerate(results):
+                it, outputs, systemic, mjdate = result
+                # number left
+                nleft = len(positions) - (count + 1)
+                # log progress
+                msg = 'Finished file {0} / {1}   ({2} left): {3}'
+                margs = [it + 1, len(science_files), nleft,
+                         science_files[it]]
+                log.general(msg.format(*margs))
+                # skip files that were skipped by the worker
+                if outputs is None:
+                    continue
+                # update the iterables
+                state['SYSTEMIC_ALL'][it] = systemic
+                state['MJDATE_ALL'][it] = mjdate
+                stats.append(outputs)
+            # wait for the workers to exit cleanly
+            pool.close()
+            pool.join()
+    finally:
+        # remove the shared state
+        SHARED_STATE.clear()
+    # return the run statistics
+    return stats
+
+
 def main(**kwargs):
     """
     Wrapper around __main__ recipe code (deals with errors and loads instrument
@@ -121,12 +431,14 @@ def __main__(inst: InstrumentsType, **kwargs):
     calib_dir, science_dir = dparams['CALIB_DIR'], dparams['SCIENCE_DIR']
     lblrv_dir, lbl_reftable_dir = dparams['LBLRV_DIR'], dparams['LBLRT_DIR']
     lbl_rdb_dir, plot_dir = dparams['LBL_RDB_DIR'], dparams['PLOT_DIR']
-    models_dir = dparams['MODEL_DIR']
+    models_dir, cache_dir = dparams['MODEL_DIR'], dparams['CACHE_DIR']
     # -------------------------------------------------------------------------
     # Step 2: Check and set filenames
     # -------------------------------------------------------------------------
     # check data type
     general.check_data_type(inst.params['DATA_TYPE'])
+    # get the number of cores to use (before any numba kernel is run)
+    ncores = get_ncores(inst)
     # mask filename
     mask_file = inst.mask_file(models_dir, mask_dir)
     # template filename
@@ -164,7 +476,8 @@ def __main__(inst: InstrumentsType, **kwargs):
     # -------------------------------------------------------------------------
     splines = general.spline_template(inst, template_file,
                                       systemic_vel_props['MASK_SYS_VEL'],
-                                      models_dir)
+                                      models_dir,
+                                      cache_dir=cache_dir)
     # -------------------------------------------------------------------------
     # Step 6: Loop around science files
     # -------------------------------------------------------------------------
@@ -188,10 +501,25 @@ def __main__(inst: InstrumentsType, **kwargs):
     model_velocity = np.inf
     # time stats
     mean_time, std_time, time_left = np.nan, np.nan, ''
-    all_durations = []
+    all_durations, all_stats = [], []
     count = 0
+    # the state passed between science files (updated by each file)
+    state = dict(SPLINES=splines, REF_TABLE=ref_table, BLAZE=blaze,
+                 SYSTEMIC_PROPS=systemic_vel_props, SYSTEMIC_ALL=systemic_all,
+                 MJDATE_ALL=mjdate_all, CCF_EWIDTH=ccf_ewidth,
+                 RESET_RV=reset_rv, MODEL_VELOCITY=model_velocity,
+                 BAD_HDR_KEYS=bad_hdr_keys, BAD_HDR_KEY=bad_hdr_key,
+                 LBLRV_DIR=lblrv_dir, CALIB_DIR=calib_dir,
+                 MASK_FILE=mask_file, WARM_START=None)
+    # the first file to process in parallel (None if all done sequentially)
+    parallel_start = None
     # loop through each science file
     for it, science_file in enumerate(science_files):
+        # in multiprocessing mode we only process files sequentially until
+        #    we have a model velocity (the rest are done in parallel)
+        if ncores > 1 and np.isfinite(state['MODEL_VELOCITY']):
+            parallel_start = it
+            break
         # ---------------------------------------------------------------------
         # 6.1 log process
         # ---------------------------------------------------------------------
@@ -214,108 +542,15 @@ def __main__(inst: InstrumentsType, **kwargs):
             for msg in msgs:
                 log.general(msg.format(*margs))
         # ---------------------------------------------------------------------
-        # 6.2 get lbl rv file and check whether it exists
+        # 6.2 - 6.8 compute the rv for this file and save to file
         # ---------------------------------------------------------------------
-        lblrv_file, lblrv_exists = inst.get_lblrv_file(science_file, lblrv_dir)
-        # If output file exists then get the model velocity from here
-        if lblrv_exists and not np.isfinite(model_velocity):
-            lblrv_hdr = inst.load_header(lblrv_file, kind='lblrv fits file')
-            model_velocity = lblrv_hdr.get_hkey(inst.params['KW_MODELVEL'],
-                                                dtype=float)
-            largs = [model_velocity]
-            log.general('We read model velo = {0:.2f} m/s'.format(*largs))
-        # if file exists and we are skipping done files
-        if lblrv_exists and inst.params['SKIP_DONE']:
-            # log message about skipping
-            log.general('\t\tFile exists and skipping activated. '
-                        'Skipping file.')
-            # skip
+        outputs = compute_science_file(inst, it, science_file, state)
+        # deal with skipped files
+        if outputs is None:
             continue
-        # ---------------------------------------------------------------------
-        # 6.3 load science file
-        # ---------------------------------------------------------------------
-        sci_data, sci_hdr = inst.load_science_file(science_file)
-        # flag calibration file
-        if inst.params['DATA_TYPE'] != 'SCIENCE':
-            model_velocity = 0
-
-        # ---------------------------------------------------------------------
-        # 6.4 load blaze if not set above
-        # ---------------------------------------------------------------------
-        if blaze is None:
-            blaze, _ = inst.load_blaze_from_science(science_file, sci_data,
-                                                    sci_hdr, calib_dir)
-        # ---------------------------------------------------------------------
-        # 6.5 check for bad files (via a header key)
-        # ---------------------------------------------------------------------
-        # check we have a bad hdr key
-        if bad_hdr_key is not None and bad_hdr_key in sci_hdr:
-            # get bad header key
-            sci_bad_hdr_key = sci_hdr.get_hkey(bad_hdr_key)
-            # if sci_bad_hdr_key in bad_hdr_keys
-            if str(sci_bad_hdr_key) in bad_hdr_keys:
-                # log message about bad header key
-                log.general('\t\tFile is known to be bad. Skipping file.')
-                # skip
-                continue
-        # ---------------------------------------------------------------------
-        # 6.6 quality control on snr
-        # ---------------------------------------------------------------------
-        # get snr key
-        snr_key = inst.params['KW_SNR']
-        snr_limit = inst.params['SNR_THRESHOLD']
-        # check we have snr key in science header
-        if snr_key in sci_hdr:
-            # get snr value
-            snr_value = sci_hdr.get_hkey(snr_key, dtype=float)
-            # check if value is less than limit
-            if snr_value < snr_limit:
-                # log message
-                msg = '\t\tSNR < {0} (SNR = {1}). Skipping file.'
-                margs = [snr_limit, snr_value]
-                log.general(msg.format(*margs))
-                # skip
-                continue
-            else:
-                # log message
-                msg = '\t\tSNR > {0} (SNR = {1:.4f}), passed SNR criteria'
-                margs = [snr_limit, snr_value]
-                log.general(msg.format(*margs))
-
-        # ---------------------------------------------------------------------
-        # 6.7 compute rv
-        # ---------------------------------------------------------------------
-        try:
-            cout = general.compute_rv(inst, it, sci_data, sci_hdr,
-                                      splines=splines,
-                                      ref_table=ref_table, blaze=blaze,
-                                      systemic_props=systemic_vel_props,
-                                      systemic_all=systemic_all,
-                                      mjdate_all=mjdate_all,
-                                      ccf_ewidth=ccf_ewidth,
-                                      reset_rv=reset_rv,
-                                      model_velocity=model_velocity,
-                                      science_file=science_file,
-                                      mask_file=mask_file)
-        except LblLowCCFSNR as e:
-            emsg = e.message + '\n Skipping file.'
-            log.warning(emsg)
-            continue
-        # get back ref_table and outputs
-        ref_table, outputs = cout
-        # ---------------------------------------------------------------------
-        # update iterables (for next iteration)
-        systemic_all = outputs['SYSTEMIC_ALL']
-        mjdate_all = outputs['MJDATE_ALL']
-        reset_rv = outputs['RESET_RV']
-        ccf_ewidth = outputs['CCF_EW']
-        model_velocity = outputs['MODEL_VELOCITY']
-
+        # add to the durations
         all_durations.append(outputs['TOTAL_DURATION'])
-        # ---------------------------------------------------------------------
-        # 6.8 save to file
-        # ---------------------------------------------------------------------
-        inst.write_lblrv_table(ref_table, lblrv_file, sci_hdr, outputs)
+        all_stats.append(file_statistics(outputs))
         # ---------------------------------------------------------------------
         # 6.9 Time taken stats (For next iteration)
         # ---------------------------------------------------------------------
@@ -325,6 +560,31 @@ def __main__(inst: InstrumentsType, **kwargs):
             mean_time, std_time, time_left = sout
         count += 1
     # -------------------------------------------------------------------------
+    # Step 7: Loop around the remaining science files in parallel
+    # -------------------------------------------------------------------------
+    if parallel_start is not None:
+        # get the remaining files (from the first unprocessed file)
+        remaining = list(range(parallel_start, len(science_files)))
+        # compute these files in parallel
+        pout = compute_parallel(inst, science_files, remaining, state, ncores)
+        # add to the durations
+        all_durations += [fstats['TOTAL_DURATION'] for fstats in pout]
+        all_stats += pout
+    # get back the iterables
+    ref_table, blaze = state['REF_TABLE'], state['BLAZE']
+    systemic_all = state['SYSTEMIC_ALL']
+    mjdate_all = state['MJDATE_ALL']
+    model_velocity = state['MODEL_VELOCITY']
+    # -------------------------------------------------------------------------
+    # Step 8: Summary of the stage timings and warm start
+    # -------------------------------------------------------------------------
+    if inst.params['COMPUTE_PROFILE']:
+        all_timings = [fstats['STAGE_TIMINGS'] for fstats in all_stats]
+        general.log_stage_timings(all_timings, all_durations)
+    # summary of the warm start
+    if inst.params['COMPUTE_WARM_START']:
+        general.log_warm_start(all_stats)
+    # -------------------------------------------------------------------------
     # return local namespace
     # -------------------------------------------------------------------------
     # do not remove this line
@@ -9,11 +9,15 @@ Created on 2021-08-24
 
 @author: cook
 """
+import hashlib
+import json
+import multiprocessing
 import os
+import time
 import warnings
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple, Union
 
 import numpy as np
-import joblib
 
 from lbljf.core import base
 from lbljf.core import base_classes
@@ -47,20 +51,91 @@ ARGS_TEMPLATE = [  # core
     'OBJECT_SCIENCE', 'OBJECT_TEMPLATE'
     # other
                       'VERBOSE', 'PROGRAM',
+    # memory / scratch / persistent s1d cube
+    'TEMPLATE_CHUNK_SIZE', 'SCRATCH_DIR', 'TEMPLATE_CUBE',
+    # parallel processing
+    'NCORES',
 ]
 
 DESCRIPTION_TEMPLATE = 'Use this code to create the LBL template'
+# the maximum number of cores for the parallel template stages
+TEMPLATE_MAX_CORES = 16
+# the state shared with the template workers (set just before the worker
+#   pool is forked so workers inherit it copy-on-write)
+SHARED_STATE = dict()
+# the version of the persistent S1D cube (bump when the S1D changes)
+TEMPLATE_CUBE_VERSION = 1
+# the index of the persistent S1D cube
+TEMPLATE_CUBE_INDEX = 'index.json'
 
 
 # =============================================================================
 # Define functions
 # =============================================================================
 
-def E2DS_to_S1D(filename, it, inst, calib_dir, blaze, sci_table, wavegrid,
-                berv, flux_cube, weight_cube):
-    # select the first science file as a reference file
+def normalize_s1d(s1d_flux: np.ndarray, s1d_weight: np.ndarray
+                  ) -> np.ndarray:
+    """
+    Correct an S1D spectrum for its weights (order overlap) and normalize it
+    by its median (before it goes into the template cube)
+
+    :param s1d_flux: np.ndarray, the S1D flux
+    :param s1d_weight: np.ndarray, the S1D weights
+
+    :return: np.ndarray, the normalized S1D flux
+    """
+    # copy the flux and weights
+    s1d_flux, s1d_weight = np.array(s1d_flux), np.array(s1d_weight)
+    # points are not valid where weight is zero or flux is exactly zero
+    bad_domain = (s1d_weight == 0) | (s1d_flux == 0)
+    # set the bad fluxes to NaN
+    s1d_flux[bad_domain] = np.nan
+    # set the weighting of bad pixels to 1
+    s1d_weight[bad_domain] = 1
+    # divide by the weights (to correct for overlapping orders)
+    s1d_flux = s1d_flux / s1d_weight
+    # normalize by the median
+    return s1d_flux / np.nanmedian(s1d_flux)
+
+
+def get_chunks(length: int, chunk_size: int) -> List[slice]:
+    """
+    Split a length into contiguous chunks of (roughly) equal size of at most
+    chunk_size (and at least 2 elements when length allows it)
+
+    :param length: int, the length to split
+    :param chunk_size: int, the maximum size of a chunk
+
+    :return: list of slices, one per chunk
+    """
+    # number of chunks
+    nchunks = int(np.ceil(length / max(2, chunk_size)))
+    # the chunk boundaries
+    bounds = np.linspace(0, length, nchunks + 1).astype(int)
+    # return the slices
+    return [slice(bounds[it], bounds[it + 1]) for it in range(nchunks)]
+
+
+def e2ds_to_s1d_file(inst: InstrumentsType, filename: str, calib_dir: str,
+                     blaze: Union[np.ndarray, None], wavegrid: np.ndarray
+                     ) -> Tuple[np.ndarray, float, Dict[str, list]]:
+    """
+    Load a science file and compute its normalized S1D on the template
+    wave grid (corrected for the berv)
+
+    :param inst: Instrument instance
+    :param filename: str, the science file
+    :param calib_dir: str, the calibration directory (to find the blaze)
+    :param blaze: np.ndarray or None, the blaze (None to load it from the
+                  science file)
+    :param wavegrid: np.ndarray, the template wave grid
+
+    :return: tuple, 1. the normalized S1D flux, 2. the berv, 3. the science
+             table row of this file (dict of lists with one entry each)
+    """
+    # load the science file
     sci_image, sci_hdr = inst.load_science_file(filename)
-    # get wave solution for reference file
+    # get wave solution for the science file
     sci_wave = inst.get_wave_solution(filename, sci_image, sci_hdr)
     # load blaze (just ones if not needed)
     if blaze is None:
@@ -70,26 +145,490 @@ def E2DS_to_S1D(filename, it, inst, calib_dir, blaze, sci_table, wavegrid,
     else:
         blaze_flag = False
         blazeimage = np.array(blaze)
-
+    # deal with not having blaze (for s1d weighting)
+    if blaze_flag:
+        sci_image, blazeimage = inst.no_blaze_corr(sci_image, sci_wave)
     # get the berv
-    berv[it] = inst.get_berv(sci_hdr)
-    # populate science table
-    sci_table = inst.populate_sci_table(filename, sci_table, sci_hdr,
-                                        berv=berv)
-
+    berv = inst.get_berv(sci_hdr)
+    # get the science table row for this file
+    sci_row = inst.populate_sci_table(filename, dict(), sci_hdr, berv=berv)
     # apply berv if required
-    if berv[it] != 0.0:
-        sci_wave = mp.doppler_shift(sci_wave, -berv[it])
+    if berv != 0.0:
+        sci_wave = mp.doppler_shift(sci_wave, -berv)
     # set exactly zeros to NaNs
     sci_image[sci_image == 0] = np.nan
     # compute s1d from e2ds
     s1d_flux, s1d_weight = apero.e2ds_to_s1d(inst.params, sci_wave,
                                              sci_image, blazeimage,
                                              wavegrid)
-    # push into arrays
-    flux_cube[:, it] = s1d_flux
-    weight_cube[:, it] = s1d_weight
-    return 1
+    # return the normalized spectrum, the berv and the table row
+    return normalize_s1d(s1d_flux, s1d_weight), berv, sci_row
+
+
+def _s1d_worker(it: int) -> Tuple[int, float, Dict[str, list]]:
+    """
+    Compute the S1D of one science file in a forked worker. The instrument,
+    blaze, wave grid and flux cube memmap are inherited from the parent
+    (SHARED_STATE) so they are never pickled. The flux goes straight into
+    the memmap, only the berv and science table row are sent back.
+
+    :param it: int, the position of the science file in the list of files
+
+    :return: tuple, 1. the position, 2. the berv, 3. the science table row
+    """
+    # get the shared state
+    state = SHARED_STATE
+    # compute the s1d of this file
+    sargs = [state['INST'], state['SCIENCE_FILES'][it], state['CALIB_DIR'],
+             state['BLAZE'], state['WAVEGRID']]
+    s1d_flux, berv, sci_row = e2ds_to_s1d_file(*sargs)
+    # push the normalized spectrum into the cube
+    state['FLUX_CUBE'][it] = s1d_flux
+    # return the metadata for this file
+    return it, berv, sci_row
+
+
+def add_sci_row(inst: InstrumentsType, sci_table: Dict[str, list],
+                sci_row: Dict[str, list]) -> Dict[str, list]:
+    """
+    Append the row of a science file (from populate_sci_table) to the
+    science table
+
+    :param inst: Instrument instance
+    :param sci_table: dict, the science table (updated)
+    :param sci_row: dict, the science table row of one file
+
+    :return: dict, the updated science table
+    """
+    # loop around the columns of the row
+    for key in sci_row:
+        for value in sci_row[key]:
+            sci_table = inst.add_dict_list_value(sci_table, key, value)
+    # return the updated table
+    return sci_table
+
+
+def get_template_ncores(inst: InstrumentsType, ntasks: int) -> int:
+    """
+    Get the number of cores to use for the parallel template stages (1 if
+    we cannot fork the process)
+
+    NCORES > 1 sets the number of cores. The default (NCORES=1) means no
+    multiprocessing for lbl_compute, but the template has always used all
+    the cores it may run on (at most TEMPLATE_MAX_CORES), so it keeps
+    doing so
+
+    :param inst: Instrument instance
+    :param ntasks: int, the number of tasks (e.g. science files)
+
+    :return: int, the number of cores to use
+    """
+    # get the number of cores requested
+    ncores = inst.params['NCORES']
+    # by default use the cores we are allowed to run on (at most 16)
+    if ncores is None or ncores <= 1:
+        ncores = TEMPLATE_MAX_CORES
+    # we cannot use more cores than we have (or than there are tasks)
+    ncores = min(ncores, base.cpu_count(), ntasks)
+    # workers inherit the shared state via fork (copy-on-write)
+    if ncores > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        return 1
+    # return the number of cores
+    return max(ncores, 1)
+
+
+def template_map(func: Callable, iterable: Iterable, ncores: int
+                 ) -> Iterator[Any]:
+    """
+    Map a function over an iterable with a pool of forked workers (the
+    workers inherit SHARED_STATE, which must be set before iterating). The
+    results are yielded as they arrive, in the order of iterable.
+
+    :param func: function, the function to call on each element
+    :param iterable: iterable, the elements to pass to func
+    :param ncores: int, the number of workers (1 means no workers)
+
+    :return: iterator, the outputs of func (in the order of iterable)
+    """
+    # without workers just loop
+    if ncores <= 1:
+        yield from map(func, iterable)
+        return
+    # with workers (forked when we start iterating)
+    context = multiprocessing.get_context('fork')
+    with context.Pool(processes=ncores) as pool:
+        yield from pool.imap(func, iterable)
+        # wait for the workers to exit cleanly
+        pool.close()
+        pool.join()
+
+
+def _median_worker(wave_chunk: slice) -> np.ndarray:
+    """
+    Median (across spectra) of one wavelength chunk of the flux cube
+    (SHARED_STATE) in a forked worker
+
+    :param wave_chunk: slice, the wavelength chunk
+
+    :return: np.ndarray, the median of each wavelength in the chunk
+    """
+    with warnings.catch_warnings(record=True) as _:
+        return mp.nanmedian(SHARED_STATE['FLUX_CUBE'][:, wave_chunk], axis=0)
+
+
+def _lowpass_worker(file_block: slice) -> int:
+    """
+    Remove the low frequencies of a block of spectra of the flux cube
+    (SHARED_STATE) in a forked worker. The spectra are divided by the low
+    pass of their ratio to the median spectrum, in place in the memmap.
+
+    :param file_block: slice, the block of spectra
+
+    :return: int, the number of spectra done
+    """
+    # get the shared state
+    flux_cube = SHARED_STATE['FLUX_CUBE']
+    peaks = SHARED_STATE['PEAKS']
+    with warnings.catch_warnings(record=True) as _:
+        # remove the stellar features
+        ratio = flux_cube[file_block] / SHARED_STATE['MEDIAN']
+        # for FP / LFC only keep the peaks
+        if peaks is not None:
+            ratio[:, ~peaks] = np.nan
+        # apply median filtered ratio (low frequency removal)
+        lowpass = mp.lowpassfilter_2d(ratio, SHARED_STATE['HP_WIDTH'])
+        flux_cube[file_block] /= lowpass
+    # return the number of spectra done
+    return len(ratio)
+
+
+def compute_s1d_cube(inst: InstrumentsType, science_files: List[str],
+                     calib_dir: str, blaze: Union[np.ndarray, None],
+                     wavegrid: np.ndarray, flux_cube: np.ndarray
+                     ) -> Tuple[np.ndarray, Dict[str, list]]:
+    """
+    Compute the normalized S1D of every science file into the flux cube.
+    With more than one core the files are mapped over a pool of forked
+    workers that write into the flux cube memmap, the bervs and science
+    table rows are gathered in the order of the science files.
+
+    :param inst: Instrument instance
+    :param science_files: list of str, the science files
+    :param calib_dir: str, the calibration directory (to find the blaze)
+    :param blaze: np.ndarray or None, the blaze (None to load it from each
+                  science file)
+    :param wavegrid: np.ndarray, the template wave grid
+    :param flux_cube: np.memmap, the flux cube [nfiles, nwave] (updated)
+
+    :return: tuple, 1. the berv of each file, 2. the science table
+    """
+    # get tqdm
+    tqdm = base.tqdm_module(inst.params['USE_TQDM'], log.console_verbosity)
+    # storage for the bervs and the science table
+    berv = np.zeros(len(science_files))
+    sci_table = dict()
+    # get the number of cores
+    ncores = get_template_ncores(inst, len(science_files))
+    # log progress
+    msg = 'Processing E2DS->S1D for {0} files'
+    if ncores > 1:
+        msg += ' in parallel on {1} cores'
+    log.general(msg.format(len(science_files), ncores))
+    # start the timer
+    start = time.time()
+    # set the shared state (inherited by the workers when forked)
+    SHARED_STATE['INST'] = inst
+    SHARED_STATE['SCIENCE_FILES'] = science_files
+    SHARED_STATE['CALIB_DIR'] = calib_dir
+    SHARED_STATE['BLAZE'] = blaze
+    SHARED_STATE['WAVEGRID'] = wavegrid
+    SHARED_STATE['FLUX_CUBE'] = flux_cube
+    try:
+        # the results arrive in the order of the files
+        positions = range(len(science_files))
+        results = template_map(_s1d_worker, positions, ncores)
+        for it, berv_it, sci_row in tqdm(results, total=len(positions)):
+            berv[it] = berv_it
+            add_sci_row(inst, sci_table, sci_row)
+    finally:
+        # remove the shared state
+        SHARED_STATE.clear()
+    # log the time taken
+    log.general('Took {0:.2f} seconds'.format(time.time() - start))
+    # return the bervs and the science table
+    return berv, sci_table
+
+
+def template_cube_file_id(filename: str) -> List[int]:
+    """
+    Identify a science file for the persistent S1D cube (its size and
+    modification time, so a modified file is processed again)
+
+    :param filename: str, the science file
+
+    :return: list of int, the size and modification time (ns) of the file
+    """
+    # get the file status
+    stat = os.stat(filename)
+    # return the identity of the file
+    return [int(stat.st_size), int(stat.st_mtime_ns)]
+
+
+def template_cube_key(inst: InstrumentsType, blaze: Union[np.ndarray, None],
+                      wavegrid: np.ndarray) -> str:
+    """
+    Get the key of the persistent S1D cube. The S1D of a file only depends
+    on the file, the blaze, the wave grid and the S1D parameters, the cube
+    is rebuilt if any of these change.
+
+    :param inst: Instrument instance
+    :param blaze: np.ndarray or None, the blaze (None if loaded per file)
+    :param wavegrid: np.ndarray, the template wave grid
+
+    :return: str, the key of the cube
+    """
+    # everything the S1D depends on (other than the file itself)
+    props = dict(version=TEMPLATE_CUBE_VERSION, lbl_version=__version__,
+                 instrument=inst.name, data_type=inst.params['DATA_TYPE'],
+                 blaze=general.array_hash(blaze),
+                 wavegrid=general.array_hash(wavegrid),
+                 smooth_size=inst.params['BLAZE_SMOOTH_SIZE'],
+                 blaze_threshold=inst.params['BLAZE_THRESHOLD'])
+    # return the hash of these properties
+    return hashlib.sha1(json.dumps(props).encode()).hexdigest()
+
+
+def _template_cube_json(value: Any) -> Any:
+    """
+    Convert the science table values that json cannot write
+
+    :param value: Any, the value to convert
+
+    :return: a json compatible version of value
+    """
+    # numpy scalars
+    if isinstance(value, np.generic):
+        return value.item()
+    # anything else as a string
+    return str(value)
+
+
+def empty_template_cube_index(key: Union[str, None] = None
+                              ) -> Dict[str, Any]:
+    """
+    Get an empty index for the persistent S1D cube
+
+    :param key: str or None, the key of the cube (see template_cube_key)
+
+    :return: dict, the index (KEY, FILES, TEMPLATE_FILES, NEXT_CHUNK)
+    """
+    return dict(VERSION=TEMPLATE_CUBE_VERSION, KEY=key, FILES=dict(),
+                TEMPLATE_FILES=[], NEXT_CHUNK=0)
+
+
+def load_template_cube_index(cube_dir: str) -> Dict[str, Any]:
+    """
+    Load the index of the persistent S1D cube (an empty index if the cube
+    does not exist or its index cannot be read)
+
+    :param cube_dir: str, the persistent S1D cube directory
+
+    :return: dict, the index (KEY, FILES, TEMPLATE_FILES, NEXT_CHUNK)
+    """
+    # the empty index
+    index = empty_template_cube_index()
+    # get the index file
+    index_file = os.path.join(cube_dir, TEMPLATE_CUBE_INDEX)
+    # deal with no index
+    if not os.path.exists(index_file):
+        return index
+    # load the index
+    try:
+        with open(index_file, 'r') as ifile:
+            index.update(json.load(ifile))
+    except (OSError, ValueError) as e:
+        wmsg = 'Could not read S1D cube index {0}: {1}. Rebuilding cube.'
+        log.warning(wmsg.format(index_file, str(e)))
+    # return the index
+    return index
+
+
+def save_template_cube_index(cube_dir: str, index: Dict[str, Any]):
+    """
+    Save the index of the persistent S1D cube (written to a temporary file
+    and then renamed, so the index is always complete)
+
+    :param cube_dir: str, the persistent S1D cube directory
+    :param index: dict, the index
+
+    :return: None, writes the index
+    """
+    # get the index file
+    index_file = os.path.join(cube_dir, TEMPLATE_CUBE_INDEX)
+    # write to a temporary file
+    tmp_file = index_file + '.tmp{0}'.format(os.getpid())
+    with open(tmp_file, 'w') as ifile:
+        json.dump(index, ifile, default=_template_cube_json)
+    # rename over the index
+    os.replace(tmp_file, index_file)
+
+
+def template_cube_current(cube_dir: str, science_files: List[str]) -> bool:
+    """
+    Check whether the last template made from the persistent S1D cube used
+    exactly these science files (unmodified). A template that was not made
+    from the cube is considered up-to-date.
+
+    :param cube_dir: str, the persistent S1D cube directory
+    :param science_files: list of str, the science files
+
+    :return: bool, True if the template is up-to-date with the files
+    """
+    # load the index
+    index = load_template_cube_index(cube_dir)
+    # deal with a template not made from the cube
+    if len(index['TEMPLATE_FILES']) == 0:
+        return True
+    # the identity of the current files
+    files = [[os.path.basename(filename), template_cube_file_id(filename)]
+             for filename in science_files]
+    # compare to the files of the last template
+    return sorted(files) == sorted(index['TEMPLATE_FILES'])
+
+
+def set_template_cube_files(cube_dir: str, science_files: List[str]):
+    """
+    Record the science files used for the template (once it is written)
+
+    :param cube_dir: str, the persistent S1D cube directory
+    :param science_files: list of str, the science files
+
+    :return: None, updates the index
+    """
+    with io.FileLock(cube_dir):
+        # load the index
+        index = load_template_cube_index(cube_dir)
+        # the identity of the files used for the template
+        index['TEMPLATE_FILES'] = [[os.path.basename(filename),
+                                    template_cube_file_id(filename)]
+                                   for filename in science_files]
+        # save the index
+        save_template_cube_index(cube_dir, index)
+
+
+def update_template_cube(inst: InstrumentsType, cube_dir: str,
+                         science_files: List[str], calib_dir: str,
+                         blaze: Union[np.ndarray, None], wavegrid: np.ndarray,
+                         flux_cube: np.ndarray
+                         ) -> Tuple[np.ndarray, Dict[str, list]]:
+    """
+    Fill the flux cube from the persistent S1D cube of this object. Only the
+    science files that are not in the persistent cube (or were modified)
+    are processed (compute_s1d_cube); they are added as a new chunk (one
+    .npy file) with their bervs and science table rows in the index. Files
+    that are no longer science files are removed from the persistent cube.
+
+    :param inst: Instrument instance
+    :param cube_dir: str, the persistent S1D cube directory
+    :param science_files: list of str, the science files
+    :param calib_dir: str, the calibration directory (to find the blaze)
+    :param blaze: np.ndarray or None, the blaze (None to load it from each
+                  science file)
+    :param wavegrid: np.ndarray, the template wave grid
+    :param flux_cube: np.memmap, the flux cube [nfiles, nwave] (updated)
+
+    :return: tuple, 1. the berv of each file, 2. the science table
+    """
+    # only one process can update the cube at a time
+    with io.FileLock(cube_dir):
+        # make sure the cube directory exists
+        os.makedirs(cube_dir, exist_ok=True)
+        # load the index
+        index = load_template_cube_index(cube_dir)
+        # the cube is rebuilt if the s1d would be different
+        key = template_cube_key(inst, blaze, wavegrid)
+        if index['KEY'] != key or index['VERSION'] != TEMPLATE_CUBE_VERSION:
+            if index['KEY'] is not None:
+                log.general('\tS1D cube is out of date. Rebuilding cube.')
+            # remove the old chunks
+            for filename in os.listdir(cube_dir):
+                if filename.endswith('.npy'):
+                    os.remove(os.path.join(cube_dir, filename))
+            index = empty_template_cube_index(key)
+        # find the files that need their s1d computing
+        names = [os.path.basename(filename) for filename in science_files]
+        new_files = []
+        for it, filename in enumerate(science_files):
+            entry = index['FILES'].get(names[it], None)
+            if entry is None:
+                new_files.append(it)
+            elif entry['ID'] != template_cube_file_id(filename):
+                new_files.append(it)
+        # log progress
+        msg = '\tS1D cube {0}: {1} files cached, {2} new files'
+        margs = [cube_dir, len(science_files) - len(new_files), len(new_files)]
+        log.general(msg.format(*margs))
+        # compute the s1d of the new files into a new chunk
+        if len(new_files) > 0:
+            chunk = 'flux_{0:06d}.npy'.format(index['NEXT_CHUNK'])
+            chunk_file = os.path.join(cube_dir, chunk)
+            tmp_file = chunk_file + '.tmp{0}.npy'.format(os.getpid())
+            # write the chunk in place (npy memmap)
+            shape = (len(new_files), len(wavegrid))
+            chunk_cube = np.lib.format.open_memmap(tmp_file, mode='w+',
+                                                   dtype=float, shape=shape)
+            try:
+                new_science_files = [science_files[it] for it in new_files]
+                cargs = [inst, new_science_files, calib_dir, blaze, wavegrid,
+                         chunk_cube]
+                new_berv, new_table = compute_s1d_cube(*cargs)
+                chunk_cube.flush()
+                del chunk_cube
+                os.replace(tmp_file, chunk_file)
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+            # add the new files to the index
+            for row, it in enumerate(new_files):
+                sci_row = dict()
+                for tkey in new_table:
+                    sci_row[tkey] = [new_table[tkey][row]]
+                entry = dict(ID=template_cube_file_id(science_files[it]),
+                             CHUNK=chunk, ROW=row, BERV=float(new_berv[row]),
+                             SCI_ROW=sci_row)
+                index['FILES'][names[it]] = entry
+            index['NEXT_CHUNK'] += 1
+        # remove the files that are no longer science files (e.g. removed
+        #    or rejected files)
+        removed = set(index['FILES']) - set(names)
+        for name in removed:
+            del index['FILES'][name]
+        # update the cube on disk if any files were added or removed
+        if len(new_files) > 0 or len(removed) > 0:
+            # remove chunks that no file refers to any more
+            used = set(entry['CHUNK'] for entry in index['FILES'].values())
+            for filename in os.listdir(cube_dir):
+                if filename.startswith('flux_') and filename not in used:
+                    os.remove(os.path.join(cube_dir, filename))
+            # save the index
+            save_template_cube_index(cube_dir, index)
+        # ---------------------------------------------------------------------
+        # fill the flux cube, bervs and science table (in file order)
+        berv = np.zeros(len(science_files))
+        sci_table = dict()
+        chunks = dict()
+        for it in range(len(science_files)):
+            entry = index['FILES'][names[it]]
+            # load the chunk (memory mapped)
+            if entry['CHUNK'] not in chunks:
+                chunk_file = os.path.join(cube_dir, entry['CHUNK'])
+                chunks[entry['CHUNK']] = np.load(chunk_file, mmap_mode='r')
+            # copy the s1d into the cube
+            flux_cube[it] = chunks[entry['CHUNK']][entry['ROW']]
+            berv[it] = entry['BERV']
+            add_sci_row(inst, sci_table, entry['SCI_ROW'])
+    # return the bervs and the science table
+    return berv, sci_table
 
 
 def main(**kwargs):
@@ -151,14 +690,6 @@ def __main__(inst: InstrumentsType, **kwargs):
     template_dir, science_dir = dparams['TEMPLATE_DIR'], dparams['SCIENCE_DIR']
     calib_dir = dparams['CALIB_DIR']
     # -------------------------------------------------------------------------
-    # step 1.1: set up joblib memmap directory
-    mmap_folder = './joblib_memmap'
-    try:
-        os.mkdir(mmap_folder)
-    except FileExistsError:
-        pass
-    # -------------------------------------------------------------------------
-
     # Step 2: Check and set filenames
     # -------------------------------------------------------------------------
     # template filename
@@ -176,7 +707,24 @@ def __main__(inst: InstrumentsType, **kwargs):
     # -------------------------------------------------------------------------
     # Step 3: Check if mask exists
     # -------------------------------------------------------------------------
-    if os.path.exists(template_file) and not inst.params['OVERWRITE']:
+    # with a persistent s1d cube an existing template is updated when the
+    #    science files have changed
+    update = False
+    if inst.params['TEMPLATE_CUBE']:
+        cube_name = 'template_cube_{0}'.format(inst.params['OBJECT_TEMPLATE'])
+        cube_dir = os.path.join(dparams['CACHE_DIR'], cube_name)
+        # may need to filter out calibrations
+        science_files = inst.filter_files(science_files)
+        # check whether the science files have changed
+        if os.path.exists(template_file) and not inst.params['OVERWRITE']:
+            update = not template_cube_current(cube_dir, science_files)
+    else:
+        cube_dir = None
+    # deal with the template existing
+    if os.path.exists(template_file) and update:
+        msg = 'Science files have changed. Updating template {0}'
+        log.general(msg.format(template_file))
+    elif os.path.exists(template_file) and not inst.params['OVERWRITE']:
         # log that mask exist
         msg = 'Template {0} exists. Skipping template creation. '
         log.warning(msg.format(template_file))
@@ -190,8 +738,9 @@ def __main__(inst: InstrumentsType, **kwargs):
     # -------------------------------------------------------------------------
     # Step 4: Deal with reference file (first file)
     # -------------------------------------------------------------------------
-    # may need to filter out calibrations
-    science_files = inst.filter_files(science_files)
+    # may need to filter out calibrations (already done for the s1d cube)
+    if cube_dir is None:
+        science_files = inst.filter_files(science_files)
     # select the first science file as a reference file
     refimage, refhdr = inst.load_science_file(science_files[0])
     # get wave solution for reference file
@@ -204,237 +753,172 @@ def __main__(inst: InstrumentsType, **kwargs):
     # grid scale for the template
     wavegrid = general.get_magic_grid(wave0=wavemin, wave1=wavemax,
                                       dv_grid=grid_step_magic)
-    # -------------------------------------------------------------------------
-    # Step 5: Loop around each file and load into cube
-    # -------------------------------------------------------------------------
-    # create a cube that contains one line for each file
-    # OLD: flux_cube = np.zeros([len(wavegrid), len(science_files)])
-    flux_cube_file_mmap = os.path.join(mmap_folder, 'flux_cube_mmap')
-    _i = 1
-    while(os.path.exists(flux_cube_file_mmap)):
-        flux_cube_file_mmap += f'_{_i}'
-        _i += 1
-
-    flux_cube = np.memmap(flux_cube_file_mmap, dtype=float,
-                          shape=(len(wavegrid), len(science_files)), mode='w+')
-    # weight cube to account for order overlap
-    # OLD: weight_cube = np.zeros([len(wavegrid), len(science_files)])
-    weight_cube_file_mmap = os.path.join(mmap_folder, 'weight_cube_mmap')
-    _i = 1
-    while(os.path.exists(weight_cube_file_mmap)):
-        weight_cube_file_mmap += f'_{_i}'
-        _i += 1
-
-    weight_cube = np.memmap(weight_cube_file_mmap, dtype=float,
-                            shape=(len(wavegrid), len(science_files)), mode='w+')
-
-    # science table
-    sci_table = dict()
-    # all bervs
-    berv_file_mmap = os.path.join(mmap_folder, 'berv_mmap')
-    _i = 1
-    while(os.path.exists(berv_file_mmap)):
-        berv_file_mmap += f'_{_i}'
-        _i += 1
-
-    berv = np.memmap(berv_file_mmap, dtype=float, shape=np.shape(science_files),
-                     mode='w+')
-    # 
-    msg = 'Processing E2DS->S1D for {0} files'
-
-    import time
-    start = time.time()
-
-    if 1: # parallel
-        ncpus = len(os.sched_getaffinity(0))
-        ncpus = min(ncpus, 16)
-        msg += ' in parallel on {1} cores'
-        log.general(msg.format(len(science_files), ncpus))
-        # loop around files
-        res = base.ProgressParallel(ncpus, verbose=0)(
-            joblib.delayed(E2DS_to_S1D)(f, it, inst, calib_dir, blaze, sci_table, wavegrid, 
-                                        berv, flux_cube, weight_cube)
-            for it, f in enumerate(science_files)
-        )
-
-    else:
-        log.general(msg.format(len(science_files)))
-        # loop around files
-        for it, filename in tqdm(enumerate(science_files), total=len(science_files)):
-            # select the first science file as a reference file
-            sci_image, sci_hdr = inst.load_science_file(filename)
-            # get wave solution for reference file
-            sci_wave = inst.get_wave_solution(filename, sci_image, sci_hdr)
-            # load blaze (just ones if not needed)
-            if blaze is None:
-                bargs = [filename, sci_image, sci_hdr, calib_dir]
-                bout = inst.load_blaze_from_science(*bargs, normalize=False)
-                blazeimage, blaze_flag = bout
+    # the memmaps live in a unique scratch directory for this run that is
+    #    removed when we leave this block (even if there is an error)
+    scratch = io.ScratchDirectory(inst.params['SCRATCH_DIR'], 'lbl_template')
+    with scratch as mmap_folder:
+        # ---------------------------------------------------------------------
+        # Step 5: Loop around each file and load into cube
+        # ---------------------------------------------------------------------
+        # create a cube that contains one line for each file (each spectrum is
+        #    contiguous on disk, wavelength chunks read one run per spectrum)
+        # OLD: flux_cube = np.zeros([len(wavegrid), len(science_files)])
+        flux_cube_file_mmap = os.path.join(mmap_folder, 'flux_cube_mmap')
+        cube_shape = (len(science_files), len(wavegrid))
+        flux_cube = np.memmap(flux_cube_file_mmap, dtype=float,
+                              shape=cube_shape, mode='w+')
+
+        # compute the s1d of each file (and get the bervs and science table)
+        #    with a persistent s1d cube only new files are computed
+        if cube_dir is not None:
+            cargs = [inst, cube_dir, science_files, calib_dir, blaze,
+                     wavegrid, flux_cube]
+            berv, sci_table = update_template_cube(*cargs)
+        else:
+            cargs = [inst, science_files, calib_dir, blaze, wavegrid,
+                     flux_cube]
+            berv, sci_table = compute_s1d_cube(*cargs)
+
+        # ---------------------------------------------------------------------
+        # Step 6. Creation of the template
+        # ---------------------------------------------------------------------
+        # print progress
+        log.general('Calculating template')
+        # each spectrum was corrected for its weights and normalized by its
+        #    median as it was added to the cube. The cube is now processed
+        #    in wavelength chunks (across all spectra) and blocks of spectra
+        #    (across all wavelengths) so the memory used is bounded by the
+        #    chunk size (per core). There are at least as many chunks and
+        #    blocks as cores so they can be shared between the workers
+        chunk_size = inst.params['TEMPLATE_CHUNK_SIZE']
+        nspec, nwave = flux_cube.shape
+        ncores = get_template_ncores(inst, nspec)
+        # workers can only update the flux cube in place if it is a memmap
+        if not isinstance(flux_cube, np.memmap):
+            ncores = 1
+        wave_chunk_size = min(chunk_size // nspec, -(-nwave // ncores))
+        file_block_size = min(chunk_size // nwave, -(-nspec // ncores))
+        wave_chunks = get_chunks(nwave, wave_chunk_size)
+        file_blocks = get_chunks(nspec, file_block_size)
+        # get the pixel hp_width [needs to be in m/s]
+        grid_step_original = general.get_velocity_step(refwave, rounding=False)
+
+        hp_width = int(np.round(inst.params['HP_WIDTH'] * 1000 / grid_step_original))
+        # ---------------------------------------------------------------------
+        # applying low pass filter
+        msg = '\tApplying low pass filter to cube'
+        if ncores > 1:
+            msg += ' in parallel on {0} cores'.format(ncores)
+        log.general(msg)
+        # set the shared state (inherited by the workers when forked)
+        SHARED_STATE['FLUX_CUBE'] = flux_cube
+        SHARED_STATE['HP_WIDTH'] = hp_width
+        try:
+            # calculate the median of the big cube (one wavelength chunk
+            #    per task)
+            median = np.zeros(nwave)
+            results = template_map(_median_worker, wave_chunks, ncores)
+            for wave_chunk, median_chunk in zip(wave_chunks, results):
+                median[wave_chunk] = median_chunk
+            # deal with FP / LFC
+            if inst.params['DATA_TYPE'] != 'SCIENCE':
+                # mask to keep only FP peaks and avoid dividing
+                # two small values (minima between lines in median and
+                # individual spectrum) when computing the lowpass
+                with warnings.catch_warnings(record=True) as _:
+                    peaks = median > mp.lowpassfilter(median, hp_width)
             else:
-                blaze_flag = False
-                blazeimage = np.array(blaze)
-            # deal with not having blaze (for s1d weighting)
-            if blaze_flag:
-                sci_image, blazeimage = inst.no_blaze_corr(sci_image, sci_wave)
-
-            # sci_image, sci_hdr, sci_wave, blazeimage = \
-            #     E2DS_to_S1D(filename, inst, calib_dir, blaze)
-
-            # get the berv
-            berv[it] = inst.get_berv(sci_hdr)
-            # populate science table
-            sci_table = inst.populate_sci_table(filename, sci_table, sci_hdr,
-                                                berv=berv[it])
-
-            # apply berv if required
-            if berv[it] != 0.0:
-                sci_wave = mp.doppler_shift(sci_wave, -berv[it])
-            # set exactly zeros to NaNs
-            sci_image[sci_image == 0] = np.nan
-            # compute s1d from e2ds
-            s1d_flux, s1d_weight = apero.e2ds_to_s1d(inst.params, sci_wave,
-                                                    sci_image, blazeimage,
-                                                    wavegrid)
-            # push into arrays
-            flux_cube[:, it] = s1d_flux
-            weight_cube[:, it] = s1d_weight
-
-    end = time.time()
-    log.general(f'Took {end - start:.2f} seconds')
-
-    # -------------------------------------------------------------------------
-    # Step 6. Creation of the template
-    # -------------------------------------------------------------------------
-    # points are not valid where weight is zero or flux_cube is exactly zero
-    bad_domain = (weight_cube == 0) | (flux_cube == 0)
-    # set the bad fluxes to NaN
-    flux_cube[bad_domain] = np.nan
-    # set the weighting of bad pixels to 1
-    weight_cube[bad_domain] = 1
-    # -------------------------------------------------------------------------
-    # print progress
-    log.general('Calculating template')
-    # divide by the weights (to correct for overlapping orders)
-    flux_cube = flux_cube / weight_cube
-    # normalize each slice of the cube by its median
-    for it in tqdm(range(len(science_files))):
-        flux_cube[:, it] = flux_cube[:, it] / np.nanmedian(flux_cube[:, it])
-
-    # copy
-    flux_cube0 = np.array(flux_cube)
-    # get the pixel hp_width [needs to be in m/s]
-    grid_step_original = general.get_velocity_step(refwave, rounding=False)
-
-    hp_width = int(np.round(inst.params['HP_WIDTH'] * 1000 / grid_step_original))
-    # -------------------------------------------------------------------------
-    # applying low pass filter
-    log.general('\tApplying low pass filter to cube')
-    # deal with science
-    if inst.params['DATA_TYPE'] == 'SCIENCE':
-        with warnings.catch_warnings(record=True) as _:
-            # calculate the median of the big cube
-            median = mp.nanmedian(flux_cube, axis=1)
-            # iterate until low frequency gone
-            for sci_it in tqdm(range(flux_cube.shape[1])):
-                # remove the stellar features
-                ratio = flux_cube[:, sci_it] / median
-                # apply median filtered ratio (low frequency removal)
-                lowpass = mp.lowpassfilter(ratio, hp_width)
-                flux_cube[:, sci_it] /= lowpass
-    else:
-        with warnings.catch_warnings(record=True) as _:
-            # calculate the median of the big cube
-            median = mp.nanmedian(flux_cube, axis=1)
-            # mask to keep only FP peaks and avoid dividing
-            # two small values (minima between lines in median and
-            # individual spectrum) when computing the lowpass
-            peaks = median > mp.lowpassfilter(median, hp_width)
-            # iterate until low frequency gone
-            for sci_it in tqdm(range(flux_cube.shape[1])):
-                # remove the stellar features
-                ratio = flux_cube[:, sci_it] / median
-                ratio[~peaks] = np.nan
-
-                # apply median filtered ratio (low frequency removal)
-                lowpass = mp.lowpassfilter(ratio, hp_width)
-                flux_cube[:, sci_it] /= lowpass
-
-    # -------------------------------------------------------------------------
-    # bin cube by BERV (to give equal weighting to epochs)
-    # -------------------------------------------------------------------------
-    # get minimum number of berv bins
-    nmin_bervbin = inst.params['BERVBIN_MIN_ENTRIES']
-    # get the size of the berv bins
-    bervbin_size = inst.params['BERVBIN_SIZE']
-    # only for science data
-    if inst.params['DATA_TYPE'] == 'SCIENCE':
-        # get the berv bin centers
-        bervbins = berv // bervbin_size
-        # find unique berv bins
-        ubervbins = np.unique(bervbins)
-        # storage the number of observations per berv bin
-        nobs_bervbin = np.zeros_like(ubervbins, dtype=int)
-        # get a flux cube for the binned by berv data
-        fcube_shape = [flux_cube.shape[0], len(ubervbins)]
-        flux_cube_bervbin = np.full(fcube_shape, np.nan)
-        # loop around unique berv bings and merge entries via median
-        for it, bervbin in enumerate(ubervbins):
-            # get mask for those observations in berv bin
-            good = bervbins == bervbin
-            # count the number of observation in this berv bin
-            n_obs = np.sum(good)
-            # log progress message
-            msg = 'Computing BERV bin {0} of {1}, n files = {2}'
-            margs = [it + 1, len(ubervbins), n_obs]
-            log.general(msg.format(*margs))
-            # deal with minimum number of observations allowed
-            if n_obs < nmin_bervbin:
-                continue
-            # add to the number of observations used
-            nobs_bervbin[it] = n_obs
-            # combine all observations in bin with median
-            with warnings.catch_warnings(record=True) as _:
-                bervmed = np.nanmedian(flux_cube[:, good], axis=1)
-                flux_cube_bervbin[:, it] = bervmed
-        # calculate the number of observations used and berv bins used
-        nfiles = np.sum(nobs_bervbin)
-        total_nobs_berv = np.sum(nobs_bervbin != 0)
-        # calculate the number of observations and the berv coverage
-        template_coverage = total_nobs_berv * grid_step_original / 1000
-    # else deal with non-science cases
-    else:
-        flux_cube_bervbin = flux_cube
-        # calculate the number of observations used
-        total_nobs_berv = 0
-        # calculate the number of observations and the berv coverage
-        template_coverage = 0
-        # we use all files
-        nfiles = len(science_files)
-        # Set uberv bins
-        ubervbins = []
-
-    # -------------------------------------------------------------------------
-    # get the median and +/- 1 sigma values for the cube
-    # -------------------------------------------------------------------------
-    log.general('Calculate 16th, 50th and 84th percentiles')
-    with warnings.catch_warnings(record=True) as _:
+                peaks = None
+            # low pass the spectra in blocks (one row per spectrum), in
+            #    place in the flux cube memmap
+            SHARED_STATE['MEDIAN'] = median
+            SHARED_STATE['PEAKS'] = peaks
+            results = template_map(_lowpass_worker, file_blocks, ncores)
+            for _ in tqdm(results, total=len(file_blocks)):
+                pass
+        finally:
+            # remove the shared state
+            SHARED_STATE.clear()
+
+        # ---------------------------------------------------------------------
+        # bin cube by BERV (to give equal weighting to epochs)
+        # ---------------------------------------------------------------------
+        # get minimum number of berv bins
+        nmin_bervbin = inst.params['BERVBIN_MIN_ENTRIES']
+        # get the size of the berv bins
+        bervbin_size = inst.params['BERVBIN_SIZE']
+        # only for science data
+        if inst.params['DATA_TYPE'] == 'SCIENCE':
+            # get the berv bin centers
+            bervbins = berv // bervbin_size
+            # sort the files into berv bins (once)
+            ubervbins, bervbin_order, bervbin_bounds = mp.group_index(bervbins)
+            # storage the number of observations per berv bin
+            nobs_bervbin = np.zeros_like(ubervbins, dtype=int)
+            # get a flux cube for the binned by berv data
+            fcube_shape = [nwave, len(ubervbins)]
+            flux_cube_bervbin = np.full(fcube_shape, np.nan)
+            # loop around unique berv bings
+            for it in range(len(ubervbins)):
+                # count the number of observation in this berv bin
+                n_obs = bervbin_bounds[it + 1] - bervbin_bounds[it]
+                # log progress message
+                msg = 'Computing BERV bin {0} of {1}, n files = {2}'
+                margs = [it + 1, len(ubervbins), n_obs]
+                log.general(msg.format(*margs))
+                # deal with minimum number of observations allowed
+                if n_obs < nmin_bervbin:
+                    continue
+                # add to the number of observations used
+                nobs_bervbin[it] = n_obs
+            # merge the entries of each berv bin via median (one wavelength
+            #    chunk at a time, all berv bins with enough observations at
+            #    once)
+            for wave_chunk in wave_chunks:
+                bargs = [flux_cube[:, wave_chunk], bervbin_order,
+                         bervbin_bounds, max(nmin_bervbin, 1)]
+                flux_cube_bervbin[wave_chunk] = mp.grouped_nanmedian(*bargs).T
+            # calculate the number of observations used and berv bins used
+            nfiles = np.sum(nobs_bervbin)
+            total_nobs_berv = np.sum(nobs_bervbin != 0)
+            # calculate the number of observations and the berv coverage
+            template_coverage = total_nobs_berv * grid_step_original / 1000
+        # else deal with non-science cases
+        else:
+            flux_cube_bervbin = flux_cube
+            # calculate the number of observations used
+            total_nobs_berv = 0
+            # calculate the number of observations and the berv coverage
+            template_coverage = 0
+            # we use all files
+            nfiles = len(science_files)
+            # Set uberv bins
+            ubervbins = []
+
+        # ---------------------------------------------------------------------
+        # get the median and +/- 1 sigma values for the cube
+        # ---------------------------------------------------------------------
+        log.general('Calculate 16th, 50th and 84th percentiles')
         if len(ubervbins) > 3:
             # to get statistics on the ber-bin rms, we need more than 3
             # bervbins
             log.general('computation done per-berv bin')
-            # p16, p50, p84 = np.nanpercentile(flux_cube_bervbin, [16, 50, 84], axis=1)
-            # typically more than 500x faster than np.nanpercentile
-            p16, p50, p84 = mp.nan_percentile(flux_cube, [16, 50, 84], axis=1)
         else:
             # if too few berv bins, we take stats on whole cube rather than
             #    per-bervbin
             log.general('computation done per-file, not per-berv bin')
-            # p16, p50, p84 = np.nanpercentile(flux_cube, [16, 50, 84], axis=1)
-            # typically more than 500x faster than np.nanpercentile
-            p16, p50, p84 = mp.nan_percentile(flux_cube, [16, 50, 84], axis=1)
-
-        # calculate the rms of each wavelength element
-        rms = (p84 - p16) / 2
+        # storage for the percentiles
+        p16, p50, p84 = np.zeros(nwave), np.zeros(nwave), np.zeros(nwave)
+        # compute the percentiles one wavelength chunk at a time
+        with warnings.catch_warnings(record=True) as _:
+            for wave_chunk in wave_chunks:
+                # p16, p50, p84 = np.nanpercentile(flux_cube, [16, 50, 84], axis=1)
+                # typically more than 500x faster than np.nanpercentile
+                pout = mp.nan_percentile(flux_cube[:, wave_chunk].T,
+                                         [16, 50, 84], axis=1)
+                p16[wave_chunk], p50[wave_chunk], p84[wave_chunk] = pout
+            # calculate the rms of each wavelength element
+            rms = (p84 - p16) / 2
 
     # -------------------------------------------------------------------------
     # Step 7. Write template
@@ -445,16 +929,9 @@ def __main__(inst: InstrumentsType, **kwargs):
                  total_nobs_berv=total_nobs_berv, template_nobs=nfiles)
     # write table
     inst.write_template(template_file, props, refhdr, sci_table)
-
-    # clean-up the joblib memmap
-    #import shutil
-    try:
-        os.remove(flux_cube_file_mmap)
-        os.remove(weight_cube_file_mmap)
-        os.remove(berv_file_mmap)
-        #shutil.rmtree(mmap_folder)
-    except:
-        log.warning('Could not clean-up automatically.')
+    # record the files used for this template (in the persistent s1d cube)
+    if cube_dir is not None:
+        set_template_cube_files(cube_dir, science_files)
 
     # -------------------------------------------------------------------------
     # return local namespace
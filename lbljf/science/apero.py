@@ -10,7 +10,7 @@ Created on 2021-11-01
 @author: cook
 """
 import warnings
-from typing import Tuple
+from typing import Any, Dict, Tuple
 
 import numpy as np
 
@@ -18,6 +18,7 @@ from lbljf.core import base
 from lbljf.core import base_classes
 from lbljf.core import math as mp
 from lbljf.instruments import select
+from lbljf.science import general
 
 # =============================================================================
 # Define variables
@@ -33,68 +34,135 @@ InstrumentsType = select.InstrumentsType
 ParamDict = base_classes.ParamDict
 LblException = base_classes.LblException
 log = base_classes.log
+# cache of the e2ds_to_s1d edge weights and splines (see get_s1d_cache)
+S1D_CACHE = dict()
 
 
 # =============================================================================
 # Define functions
 # =============================================================================
+def s1d_edge_weights(valid: np.ndarray, ker: np.ndarray,
+                     dtype: Any = float) -> np.ndarray:
+    """
+    Smooth transition weights at the edges of the valid domain of each order
+    (the valid mask convolved with the edge kernel, normalised to 0 to 1)
+
+    :param valid: np.ndarray (2D), the valid pixels of each order
+                  (norders x npixels)
+    :param ker: np.ndarray (1D), the edge kernel
+    :param dtype: the data type of the weights (that of the blaze)
+
+    :return: np.ndarray (2D), the weight of each pixel (norders x npixels)
+    """
+    # storage for the weights
+    slopevector = np.zeros(valid.shape, dtype=dtype)
+    # for each order find the sloping weight vector
+    for order_num in range(valid.shape[0]):
+        # convolve with the edge kernel
+        oweight = np.convolve(valid[order_num], ker, mode='same')
+        # normalise to the maximum
+        with warnings.catch_warnings(record=True) as _:
+            oweight = oweight - mp.nanmin(oweight)
+            oweight = oweight / mp.nanmax(oweight)
+        # append to sloping vector storage
+        slopevector[order_num] = oweight
+    # return the sloping weights
+    return slopevector
+
+
+def get_s1d_cache(params: ParamDict, blaze: np.ndarray,
+                  wavemap: np.ndarray) -> Dict[str, Any]:
+    """
+    Get the e2ds_to_s1d cache for a blaze and wave solution. For the blaze
+    this holds the valid pixels (finite, above threshold and away from the
+    edges) and their sloping edge weights, for the wave solution the
+    per-order blaze and validity splines. Only the last blaze and wave
+    solution are kept (all files share the blaze and consecutive files often
+    share a wave solution).
+
+    :param params: ParamDict, parameter dictionary of constants
+    :param blaze: np.ndarray (2D), the blaze function of the E2DS
+    :param wavemap: np.ndarray (2D), the wave map for the E2DS
+
+    :return: dict, the cache for this blaze and wave solution
+    """
+    # get quantities from parameter dictionary of constants
+    smooth_size = params['BLAZE_SMOOTH_SIZE']
+    blazethres = params['BLAZE_THRESHOLD']
+    # the blaze and wave solution are identified by their content
+    blaze_key = (general.array_hash(blaze), smooth_size, blazethres)
+    wave_key = general.array_hash(wavemap)
+    # deal with a new blaze
+    if S1D_CACHE.get('BLAZE_KEY') != blaze_key:
+        S1D_CACHE.clear()
+        # get size from blaze
+        nord, npix = blaze.shape
+        # define a kernel that goes from -3 to +3 smooth_sizes of the mask
+        xker = np.arange(-smooth_size * 3, smooth_size * 3, 1)
+        ker = np.exp(-0.5 * (xker / smooth_size) ** 2)
+        # set up the edge vector
+        edges = np.ones(npix, dtype=bool)
+        # set edges of the image to 0 so that  we get a sloping weight
+        edges[:int(3 * smooth_size)] = False
+        edges[-int(3 * smooth_size):] = False
+        # find the valid pixels of the blaze
+        valid = np.isfinite(blaze) & edges
+        for order_num in range(nord):
+            oblaze = np.array(blaze[order_num])
+            with warnings.catch_warnings(record=True) as _:
+                valid[order_num] &= oblaze > (blazethres * mp.nanmax(oblaze))
+        # push into the cache
+        S1D_CACHE['BLAZE_KEY'] = blaze_key
+        S1D_CACHE['KERNEL'] = ker
+        S1D_CACHE['VALID'] = valid
+        S1D_CACHE['SLOPE'] = s1d_edge_weights(valid, ker, blaze.dtype)
+    # deal with a new wave solution (only keep the last one)
+    if S1D_CACHE.get('WAVE_KEY') != wave_key:
+        S1D_CACHE['WAVE_KEY'] = wave_key
+        S1D_CACHE['ORDERS'] = dict()
+    # return the cache
+    return S1D_CACHE
+
+
 def e2ds_to_s1d(params: ParamDict, wavemap: np.ndarray, e2ds: np.ndarray,
                 blaze: np.ndarray, wavegrid: np.ndarray
                 ) -> Tuple[np.ndarray, np.ndarray]:
     """
     E2DS to S1D function (taken from apero - with adjustments)
 
+    The edge weights and the blaze and validity splines are cached for the
+    last blaze and wave solution (see get_s1d_cache) and each order only
+    evaluates its splines on its own slice of the output wave grid
+
     :param params: ParamDict, parameter dictionary of constants
     :param wavemap: np.ndarray (2D), the wave map for the E2DS
     :param e2ds: np.ndarray (2D), the E2DS 2D numpy array (norders x npixels)
                  must not be blaze corrected
     :param blaze: np.ndarray (2D), the blaze function of the E2DS - used for
                   weighting orders
-    :param wavegrid: np.ndarray (1D), the output s1d wave grid
+    :param wavegrid: np.ndarray (1D), the output s1d wave grid (must be
+                     increasing)
 
     :return: tuple, 1. np.array (1D) the s1d flux, 2. np.array (1D) the weight
              assigned to each order
     """
-    # get quantities from parameter dictionary of constants
-    smooth_size = params['BLAZE_SMOOTH_SIZE']
-    blazethres = params['BLAZE_THRESHOLD']
-    # -------------------------------------------------------------------------
     # get size from e2ds
     nord, npix = e2ds.shape
     # -------------------------------------------------------------------------
     # define a smooth transition mask at the edges of the image
     # this ensures that the s1d has no discontinuity when going from one order
-    # to the next. We define a scale for this mask
-    # smoothing scale
+    # to the next (the blaze part of this is cached)
     # -------------------------------------------------------------------------
-    # define a kernel that goes from -3 to +3 smooth_sizes of the mask
-    xker = np.arange(-smooth_size * 3, smooth_size * 3, 1)
-    ker = np.exp(-0.5 * (xker / smooth_size) ** 2)
-    # set up the edge vector
-    edges = np.ones(npix, dtype=bool)
-    # set edges of the image to 0 so that  we get a sloping weight
-    edges[:int(3 * smooth_size)] = False
-    edges[-int(3 * smooth_size):] = False
+    cache = get_s1d_cache(params, blaze, wavemap)
+    # the valid pixels also need a finite e2ds
+    valid = cache['VALID'] & np.isfinite(e2ds)
+    # only recompute the sloping weights of orders with extra invalid pixels
+    changed = np.any(valid != cache['VALID'], axis=1)
     # define the weighting for the edges (slopevector)
-    slopevector = np.zeros_like(blaze)
-    # for each order find the sloping weight vector
-    for order_num in range(nord):
-        # get the blaze for this order
-        oblaze = np.array(blaze[order_num])
-        # find the valid pixels
-        cond1 = np.isfinite(oblaze) & np.isfinite(e2ds[order_num])
-        with warnings.catch_warnings(record=True) as _:
-            cond2 = oblaze > (blazethres * mp.nanmax(oblaze))
-        valid = cond1 & cond2 & edges
-        # convolve with the edge kernel
-        oweight = np.convolve(valid, ker, mode='same')
-        # normalise to the maximum
-        with warnings.catch_warnings(record=True) as _:
-            oweight = oweight - mp.nanmin(oweight)
-            oweight = oweight / mp.nanmax(oweight)
-        # append to sloping vector storage
-        slopevector[order_num] = oweight
-
+    slopevector = np.array(cache['SLOPE'])
+    if np.any(changed):
+        slopevector[changed] = s1d_edge_weights(valid[changed],
+                                                cache['KERNEL'], blaze.dtype)
     # multiple the spectrum and blaze by the sloping vector
     sblaze = np.array(blaze) * slopevector
     se2ds = np.array(e2ds) * slopevector
@@ -136,27 +204,42 @@ def e2ds_to_s1d(params: ParamDict, wavemap: np.ndarray, e2ds: np.ndarray,
                    'Skipping order')
             log.info(msg.format(order_num))
             continue
-        # create the splines for this order
+        # the blaze and validity splines only depend on the valid pixels
+        #   and the blaze (reuse them from the cache if these match)
+        ocache = cache['ORDERS'].get(order_num, None)
+        if ocache is not None:
+            if not np.array_equal(ocache['VALID'], valid):
+                ocache = None
+            elif not np.array_equal(ocache['BLAZE'], oblaze):
+                ocache = None
+        if ocache is None:
+            spline_bl = mp.iuv_spline(owave[valid], oblaze, k=1, ext=1)
+            # valid must be cast as float for splining
+            valid_float = valid.astype(float)
+            # we mask pixels that are neighbours to a NaN.
+            valid_float = np.convolve(valid_float, np.ones(3) / 3.0,
+                                      mode='same')
+            spline_valid = mp.iuv_spline(owave[wavemask],
+                                         valid_float[wavemask], k=1, ext=1)
+            # push into the cache
+            ocache = dict(VALID=valid, BLAZE=oblaze, SPLINE_BL=spline_bl,
+                          SPLINE_VALID=spline_valid)
+            cache['ORDERS'][order_num] = ocache
+        # create the spectrum spline for this order
         spline_sp = mp.iuv_spline(owave[valid], oe2ds, k=5, ext=1)
-        spline_bl = mp.iuv_spline(owave[valid], oblaze, k=1, ext=1)
-        # valid must be cast as float for splining
-        valid_float = valid.astype(float)
-        # we mask pixels that are neighbours to a NaN.
-        valid_float = np.convolve(valid_float, np.ones(3) / 3.0, mode='same')
-        spline_valid = mp.iuv_spline(owave[wavemask], valid_float[wavemask],
-                                     k=1, ext=1)
-        # can only spline in domain of the wave
-        useful_range = (wavegrid > mp.nanmin(owave[valid]))
-        useful_range &= (wavegrid < mp.nanmax(owave[valid]))
+        # can only spline in domain of the wave (the slice of the wave grid
+        #   strictly between the first and last valid wavelength)
+        start = np.searchsorted(wavegrid, mp.nanmin(owave[valid]), 'right')
+        end = np.searchsorted(wavegrid, mp.nanmax(owave[valid]), 'left')
+        owavegrid = wavegrid[start:end]
         # finding pixels where we have immediate neighbours that are
         #   considered valid in the spline (to avoid interpolating over large
         #   gaps in validity)
-        maskvalid = np.zeros_like(wavegrid, dtype=bool)
-        maskvalid[useful_range] = spline_valid(wavegrid[useful_range]) > 0.9
-        useful_range &= maskvalid
+        useful_range = ocache['SPLINE_VALID'](owavegrid) > 0.9
+        owavegrid = owavegrid[useful_range]
         # get splines and add to outputs
-        weight[useful_range] += spline_bl(wavegrid[useful_range])
-        out_spec[useful_range] += spline_sp(wavegrid[useful_range])
+        weight[start:end][useful_range] += ocache['SPLINE_BL'](owavegrid)
+        out_spec[start:end][useful_range] += spline_sp(owavegrid)
 
     # where out_spec is exactly zero set to NaN
     out_spec[out_spec == 0] = np.nan
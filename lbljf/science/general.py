@@ -7,7 +7,11 @@ Created on 2021-03-16
 
 @author: cook
 """
+import functools
+import hashlib
+import json
 import os
+import shutil
 import time
 import warnings
 from typing import Any, Dict, List, Optional, Tuple, Union
@@ -44,73 +48,28 @@ Instrument = default.Instrument
 ParamDict = base_classes.ParamDict
 LblException = base_classes.LblException
 LblLowCCFSNR = base_classes.LblLowCCFSNR
+StageTimer = base_classes.StageTimer
 log = base_classes.log
 InstrumentsType = select.InstrumentsType
 # get speed of light
 speed_of_light_ms = constants.c.value
 speed_of_light_kms = constants.c.value / 1000.0
+# cache of the last wave to pixel map (see get_wave2pix_map)
+WAVE2PIX_CACHE = dict()
+# maximum number of line positions held in memory at once in a ccf
+CCF_CHUNK_SIZE = 2 ** 22
+# oversampling of the magic grid used for the ccf of a (cubic) model
+CCF_MODEL_OVERSAMPLING = 2
+# version of the template spline cache (change to invalidate all caches)
+SPLINE_CACHE_VERSION = 3
+# age (in seconds) after which a temporary spline cache directory (of a
+#    process that died while writing it) is removed
+SPLINE_CACHE_TMP_AGE = 24 * 3600
 
 
 # =============================================================================
 # Define compute functions
 # =============================================================================
-def multi_wait(inst: InstrumentsType, reftable_exists: bool,
-               reftable_file: str) -> bool:
-    """
-    Only used if iterations > 0 and total > 0 in inst.params
-
-    In this case we need the first iteration to continue as normal and all
-    other iterations to wait for the file to exist
-
-    :param inst: Instrument instance
-    :param reftable_exists: bool, whether the reftable currently exists
-    :param reftable_file: str, the reftable filename
-
-    :return: reftable_exists, bool, the updated flag whether reftable exists
-    """
-    # first case if reftable_exists is True then we have no problem in any
-    #   mode
-    if reftable_exists:
-        return True
-    # get the iteration and total parameters
-    iteration = inst.params['ITERATION']
-    total = inst.params['TOTAL']
-    # get the maximum time out in seconds
-    max_timeout = 300
-    # if either iteration or total is below zero we are not in multi-iteration
-    #   mode - so return the current value of reftable_exists
-    if iteration < 0 or total < 0:
-        return False
-    # if iteration == 0 then we are in the first iteration and we can continue
-    if iteration == 0:
-        return False
-    # start the count
-    count = 0
-    # else we have to wait for iteration zero to make the ref table
-    while not os.path.exists(reftable_file):
-        # every 10 iterations print a message
-        if count % 10 == 0:
-            msg = ('Iteration {0}/{1}: Waiting for reftable to be created by'
-                   'iteration 0: Count = {2}')
-            margs = [iteration, total, count]
-            log.general(msg.format(*margs))
-        # sleep for 1 second
-        time.sleep(1)
-        # add one to count
-        count += 1
-        # if count is greater than max_timeout we have timed out
-        if count > max_timeout:
-            # raise an error
-            emsg = ('Timeout waiting for reftable to be created by iteration '
-                    '0')
-            raise LblException(emsg)
-    # lets wait a little longer to make sure the file is written completely
-    if count > 0:
-        time.sleep(5)
-    # return
-    return True
-
-
 def filter_science_files(inst: InstrumentsType,
                          science_files: List[str]) -> List[str]:
     """
@@ -142,6 +101,10 @@ def make_ref_dict(inst: InstrumentsType, reftable_file: str,
     """
     Make the reference table dictionary
 
+    If the ref table does not exist only one process creates it (the others,
+    e.g. other iterations in multi-iteration mode, block on a file lock and
+    then read the table once it is published)
+
     :param inst: Instrument instance
     :param reftable_file: str, the ref table filename
     :param reftable_exists: bool, if True file exists and we load it
@@ -152,131 +115,168 @@ def make_ref_dict(inst: InstrumentsType, reftable_file: str,
 
     :return:
     """
-    # deal with waiting for reftable to exist when in multi-iteration mode
-    reftable_exists = multi_wait(inst, reftable_exists, reftable_file)
+    # deal with loading from file (the file is published atomically so it
+    #    is complete if it exists)
+    if reftable_exists:
+        return load_ref_dict(inst, reftable_file)
+    # only one process may create the table
+    with io.FileLock(reftable_file):
+        # another process may have created it while we waited for the lock
+        if io.check_file_exists(reftable_file, required=False):
+            return load_ref_dict(inst, reftable_file)
+        # create the table from the mask + wave solution (and save it)
+        return create_ref_dict(inst, reftable_file, science_files, mask_file,
+                               calib_dir)
+
+
+def load_ref_dict(inst: InstrumentsType,
+                  reftable_file: str) -> Dict[str, np.ndarray]:
+    """
+    Load the reference table dictionary from disk
+
+    :param inst: Instrument instance
+    :param reftable_file: str, the ref table filename
+
+    :return: dict, the reference table dictionary
+    """
+    # get parameter dictionary of constants
+    params = inst.params
+    # storage for ref dictionary
+    ref_dict = dict()
+    # log writing
+    log.general('Reading existing ref table {0}'.format(reftable_file))
+    # load ref table from disk
+    table = Table.read(reftable_file, format=params['REF_TABLE_FMT'])
+    # copy columns
+    ref_dict['ORDER'] = np.array(table['ORDER'])
+    ref_dict['WAVE_START'] = np.array(table['WAVE_START'])
+    ref_dict['WAVE_END'] = np.array(table['WAVE_END'])
+    ref_dict['WEIGHT_LINE'] = np.array(table['WEIGHT_LINE'])
+    ref_dict['XPIX'] = np.array(table['XPIX'])
+    ref_dict['LINE_SNR'] = np.array(table['LINE_SNR'])
+    ref_dict['LINE_DEPTH'] = np.array(table['LINE_DEPTH'])
+    ref_dict['LOCAL_FLUX'] = np.array(table['LOCAL_FLUX'])
+    # ratio of expected VS actual RMS in difference of model vs line
+    ref_dict['RMSRATIO'] = np.array(table['RMSRATIO'])
+    # effective number of pixels in line
+    ref_dict['NPIXLINE'] = np.array(table['NPIXLINE'])
+    # mean line position in pixel space
+    ref_dict['MEANXPIX'] = np.array(table['MEANXPIX'])
+    # blaze value compared to peak for that order
+    ref_dict['MEANBLAZE'] = np.array(table['MEANBLAZE'])
+    # amp continuum
+    ref_dict['AMP_CONTINUUM'] = np.array(table['AMP_CONTINUUM'])
+    # Considering the number of pixels, expected and actual RMS,
+    #     this is the likelihood that the line is acually valid from a
+    #     Chi2 test point of view
+    ref_dict['CHI2'] = np.array(table['CHI2'])
+    # probability of valid considering the chi2 CDF for the number of DOF
+    ref_dict['CHI2_VALID_CDF'] = np.array(table['CHI2_VALID_CDF'])
+    # close table
+    del table
+    # return table
+    return ref_dict
+
+
+def create_ref_dict(inst: InstrumentsType, reftable_file: str,
+                    science_files: List[str], mask_file: str,
+                    calib_dir: str) -> Dict[str, np.ndarray]:
+    """
+    Create the reference table dictionary from the mask and the wave solution
+    and save it to disk
+
+    :param inst: Instrument instance
+    :param reftable_file: str, the ref table filename
+    :param science_files: list of absolute paths to science files
+    :param mask_file: absolute path to mask file
+    :param calib_dir: str, the calibration directory
+
+    :return: dict, the reference table dictionary
+    """
     # get parameter dictionary of constants
     params = inst.params
     # storage for ref dictionary
     ref_dict = dict()
     # load the mask
     mask_table = inst.load_mask(mask_file)
-    # -------------------------------------------------------------------------
-    # deal with loading from file
-    if reftable_exists:
-        # log writing
-        log.general('Reading existing ref table {0}'.format(reftable_file))
-        # load ref table from disk
-        table = Table.read(reftable_file, format=params['REF_TABLE_FMT'])
-        # copy columns
-        ref_dict['ORDER'] = np.array(table['ORDER'])
-        ref_dict['WAVE_START'] = np.array(table['WAVE_START'])
-        ref_dict['WAVE_END'] = np.array(table['WAVE_END'])
-        ref_dict['WEIGHT_LINE'] = np.array(table['WEIGHT_LINE'])
-        ref_dict['XPIX'] = np.array(table['XPIX'])
-        ref_dict['LINE_SNR'] = np.array(table['LINE_SNR'])
-        ref_dict['LINE_DEPTH'] = np.array(table['LINE_DEPTH'])
-        ref_dict['LOCAL_FLUX'] = np.array(table['LOCAL_FLUX'])
-        # ratio of expected VS actual RMS in difference of model vs line
-        ref_dict['RMSRATIO'] = np.array(table['RMSRATIO'])
-        # effective number of pixels in line
-        ref_dict['NPIXLINE'] = np.array(table['NPIXLINE'])
-        # mean line position in pixel space
-        ref_dict['MEANXPIX'] = np.array(table['MEANXPIX'])
-        # blaze value compared to peak for that order
-        ref_dict['MEANBLAZE'] = np.array(table['MEANBLAZE'])
-        # amp continuum
-        ref_dict['AMP_CONTINUUM'] = np.array(table['AMP_CONTINUUM'])
-        # Considering the number of pixels, expected and actual RMS,
-        #     this is the likelihood that the line is acually valid from a
-        #     Chi2 test point of view
-        ref_dict['CHI2'] = np.array(table['CHI2'])
-        # probability of valid considering the chi2 CDF for the number of DOF
-        ref_dict['CHI2_VALID_CDF'] = np.array(table['CHI2_VALID_CDF'])
-        # close table
-        del table
-    # -------------------------------------------------------------------------
-    # deal with creating table
-    else:
-        # load wave solution from first science file
-        wavegrid = inst.get_sample_wave_grid(calib_dir, science_files[0])
-        # storage for vectors
-        order, wave_start, wave_end, weight_line, xpix = [], [], [], [], []
-        line_snr, line_depth, local_flux = [], [], []
-        # loop around orders
-        for order_num in range(wavegrid.shape[0]):
-            # get the min max wavelengths for this order
-            min_wave = np.min(wavegrid[order_num])
-            max_wave = np.max(wavegrid[order_num])
-            # build a mask for mask lines in this order
-            good = mask_table['ll_mask_s'] > min_wave
-            good &= mask_table['ll_mask_s'] < max_wave
-            # if we pass a 'full' mask, then we only keep local maxima
-            # only valid for science frames
-            if params['DATA_TYPE'] == 'SCIENCE':
-                good &= mask_table['w_mask'] < 0
-
-            # if we have values then add to arrays
-            if np.sum(good) > 0:
-                # add an order flag
-                order += list(np.repeat(order_num, np.sum(good) - 1))
-                # get the wave starts
-                wave_start += list(mask_table['ll_mask_s'][good][:-1])
-                # get the wave ends
-                wave_end += list(mask_table['ll_mask_s'][good][1:])
-                # get the weights of the lines (only used to get systemic
-                # velocity as a starting point)
-                weight_line += list(mask_table['w_mask'][good][:-1])
-                # spline x pixels using wave grid
-                xgrid = np.arange(len(wavegrid[order_num]))
-                xspline = mp.iuv_spline(wavegrid[order_num], xgrid)
-                # get the x pixel vector for mask
-                xpix += list(xspline(mask_table['ll_mask_s'][good][:-1]))
-                # get the line snr
-                line_snr += list(mask_table['line_snr'][good][:-1])
-                line_depth += list(mask_table['depth'][good][:-1])
-                local_flux += list(mask_table['value'][good][:-1])
-        # make xpix a numpy array
-        xpix = np.array(xpix)
-        # add to reference dictionary
-        ref_dict['ORDER'] = np.array(order)
-        ref_dict['WAVE_START'] = np.array(wave_start)
-        ref_dict['WAVE_END'] = np.array(wave_end)
-        ref_dict['WEIGHT_LINE'] = np.array(weight_line)
-        ref_dict['XPIX'] = xpix
-        ref_dict['LINE_SNR'] = np.array(line_snr)
-        ref_dict['LINE_DEPTH'] = np.array(line_depth)
-        ref_dict['LOCAL_FLUX'] = np.array(local_flux)
-        # ratio of expected VS actual RMS in difference of model vs line
-        ref_dict['RMSRATIO'] = np.zeros_like(xpix, dtype=float)
-        # effective number of pixels in line
-        ref_dict['NPIXLINE'] = np.zeros_like(xpix, dtype=int)
-        # mean line position in pixel space
-        ref_dict['MEANXPIX'] = np.zeros_like(xpix, dtype=float)
-        # blaze value compared to peak for that order
-        ref_dict['MEANBLAZE'] = np.zeros_like(xpix, dtype=float)
-        # amp continuum
-        ref_dict['AMP_CONTINUUM'] = np.zeros_like(xpix, dtype=float)
-        # Considering the number of pixels, expected and actual RMS,
-        #     this is the likelihood that the line is acually valid from a
-        #     Chi2 test point of view
-        ref_dict['CHI2'] = np.zeros_like(xpix, dtype=float)
-        # probability of valid considering the chi2 CDF for the number of DOF
-        ref_dict['CHI2_VALID_CDF'] = np.zeros_like(xpix, dtype=float)
+    # load wave solution from first science file
+    wavegrid = inst.get_sample_wave_grid(calib_dir, science_files[0])
+    # storage for vectors
+    order, wave_start, wave_end, weight_line, xpix = [], [], [], [], []
+    line_snr, line_depth, local_flux = [], [], []
+    # loop around orders
+    for order_num in range(wavegrid.shape[0]):
+        # get the min max wavelengths for this order
+        min_wave = np.min(wavegrid[order_num])
+        max_wave = np.max(wavegrid[order_num])
+        # build a mask for mask lines in this order
+        good = mask_table['ll_mask_s'] > min_wave
+        good &= mask_table['ll_mask_s'] < max_wave
+        # if we pass a 'full' mask, then we only keep local maxima
+        # only valid for science frames
+        if params['DATA_TYPE'] == 'SCIENCE':
+            good &= mask_table['w_mask'] < 0
+
+        # if we have values then add to arrays
+        if np.sum(good) > 0:
+            # add an order flag
+            order += list(np.repeat(order_num, np.sum(good) - 1))
+            # get the wave starts
+            wave_start += list(mask_table['ll_mask_s'][good][:-1])
+            # get the wave ends
+            wave_end += list(mask_table['ll_mask_s'][good][1:])
+            # get the weights of the lines (only used to get systemic
+            # velocity as a starting point)
+            weight_line += list(mask_table['w_mask'][good][:-1])
+            # spline x pixels using wave grid
+            xgrid = np.arange(len(wavegrid[order_num]))
+            xspline = mp.iuv_spline(wavegrid[order_num], xgrid)
+            # get the x pixel vector for mask
+            xpix += list(xspline(mask_table['ll_mask_s'][good][:-1]))
+            # get the line snr
+            line_snr += list(mask_table['line_snr'][good][:-1])
+            line_depth += list(mask_table['depth'][good][:-1])
+            local_flux += list(mask_table['value'][good][:-1])
+    # make xpix a numpy array
+    xpix = np.array(xpix)
+    # add to reference dictionary
+    ref_dict['ORDER'] = np.array(order)
+    ref_dict['WAVE_START'] = np.array(wave_start)
+    ref_dict['WAVE_END'] = np.array(wave_end)
+    ref_dict['WEIGHT_LINE'] = np.array(weight_line)
+    ref_dict['XPIX'] = xpix
+    ref_dict['LINE_SNR'] = np.array(line_snr)
+    ref_dict['LINE_DEPTH'] = np.array(line_depth)
+    ref_dict['LOCAL_FLUX'] = np.array(local_flux)
+    # ratio of expected VS actual RMS in difference of model vs line
+    ref_dict['RMSRATIO'] = np.zeros_like(xpix, dtype=float)
+    # effective number of pixels in line
+    ref_dict['NPIXLINE'] = np.zeros_like(xpix, dtype=int)
+    # mean line position in pixel space
+    ref_dict['MEANXPIX'] = np.zeros_like(xpix, dtype=float)
+    # blaze value compared to peak for that order
+    ref_dict['MEANBLAZE'] = np.zeros_like(xpix, dtype=float)
+    # amp continuum
+    ref_dict['AMP_CONTINUUM'] = np.zeros_like(xpix, dtype=float)
+    # Considering the number of pixels, expected and actual RMS,
+    #     this is the likelihood that the line is acually valid from a
+    #     Chi2 test point of view
+    ref_dict['CHI2'] = np.zeros_like(xpix, dtype=float)
+    # probability of valid considering the chi2 CDF for the number of DOF
+    ref_dict['CHI2_VALID_CDF'] = np.zeros_like(xpix, dtype=float)
 
-        # ---------------------------------------------------------------------
-        # convert ref_dict to table (for saving to disk
-        ref_table = Table()
-        for key in ref_dict.keys():
-            ref_table[key] = np.array(ref_dict[key])
-        # log writing
-        log.general('Writing ref table {0}'.format(reftable_file))
-        # write to file
-        io.write_table(reftable_file, ref_table,
-                       fmt=inst.params['REF_TABLE_FMT'])
-
-    # -------------------------------------------------------------------------
-    # return table (either loaded from file or constructed from mask +
-    #               wave solution)
+    # ---------------------------------------------------------------------
+    # convert ref_dict to table (for saving to disk
+    ref_table = Table()
+    for key in ref_dict.keys():
+        ref_table[key] = np.array(ref_dict[key])
+    # log writing
+    log.general('Writing ref table {0}'.format(reftable_file))
+    # write to file
+    io.write_table(reftable_file, ref_table,
+                   fmt=inst.params['REF_TABLE_FMT'], atomic=True)
+    # -------------------------------------------------------------------------
+    # return table (constructed from mask + wave solution)
     return ref_dict
 
 
@@ -301,16 +301,253 @@ def get_velo_scale(wave_vector: np.ndarray, hp_width: float) -> int:
     return width
 
 
+def file_hash(filename: str, block_size: int = 2 ** 20) -> str:
+    """
+    Identify a file by its content (sha1 hash of its bytes)
+
+    :param filename: str, the absolute path to the file
+    :param block_size: int, the number of bytes read at once
+
+    :return: str, the hash of the file
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as filehandle:
+        for block in iter(lambda: filehandle.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def spline_cache_key(inst: InstrumentsType, template_file: str,
+                     systemic_vel: float, models_dir: str) -> str:
+    """
+    Get the key of the template spline cache. This is a hash of everything
+    the splines are built from: the template (and resproj table) content,
+    the systemic velocity and the parameters used in spline_template
+
+    :param inst: Instrument instance
+    :param template_file: str, the absolute path to the template file
+    :param systemic_vel: float, the systemic velocity
+    :param models_dir: str, the absolute path to the models directory
+
+    :return: str, the spline cache key
+    """
+    # the content of the residual projection tables
+    resproj = dict()
+    if isinstance(inst.params['RESPROJ_TABLES'], dict):
+        for key, spline_file in inst.params['RESPROJ_TABLES'].items():
+            spline_path = os.path.join(models_dir, spline_file)
+            # a missing table is dealt with when building the splines
+            if os.path.exists(spline_path):
+                resproj[key] = file_hash(spline_path)
+            else:
+                resproj[key] = None
+    # everything the splines depend on
+    props = dict(VERSION=SPLINE_CACHE_VERSION, LBL_VERSION=__version__,
+                 INSTRUMENT=inst.name, TEMPLATE=file_hash(template_file),
+                 MASK_SYS_VEL=repr(float(systemic_vel)),
+                 HP_WIDTH=repr(inst.params['HP_WIDTH']),
+                 ROTBROAD=repr(inst.params['ROTBROAD']),
+                 RESPROJ_TABLES=resproj,
+                 MODEL_BACKEND=inst.params['COMPUTE_MODEL_BACKEND'],
+                 OVERSAMPLING=inst.params['LOGLAMBDA_OVERSAMPLING'])
+    # hash these properties
+    props_str = json.dumps(props, sort_keys=True)
+    return hashlib.sha1(props_str.encode()).hexdigest()
+
+
+def save_spline_cache(sps: Dict[str, Any], cache_path: str,
+                      template_file: str):
+    """
+    Save the template splines to the spline cache. Each array (knots and
+    coefficients or log-lambda samples) is a .npy file (so it can be
+    memory-mapped) and an index (json) describes how to rebuild each spline.
+    Spline stacks are saved once (their curves only refer to them).
+
+    The cache is written to a temporary directory and then renamed, so a
+    cache directory is always complete (even with several processes). Only
+    the newest cache of each template file is kept (see prune_spline_cache).
+
+    :param sps: dict, the template splines (from spline_template)
+    :param cache_path: str, the absolute path to the spline cache directory
+    :param template_file: str, the absolute path to the template file
+
+    :return: None, writes the spline cache directory
+    """
+    # storage for the index (splines and spline stacks) and the template
+    #    the splines were made from
+    index = dict(splines=dict(), stacks=dict(),
+                 version=SPLINE_CACHE_VERSION,
+                 template=os.path.realpath(template_file))
+    # storage for the arrays to write (filename: array)
+    arrays = dict()
+    # storage for the names of the spline stacks
+    stack_names = dict()
+    # NaN splines (too few points) are not cached
+    for key in sps:
+        spline = sps[key]
+        if isinstance(spline, mp.IUVSpline):
+            # get the knots, coefficients and order of the spline
+            knots, coeffs, k_order = spline._eval_args
+            arrays[key + '_knots.npy'] = knots
+            arrays[key + '_coeffs.npy'] = coeffs
+            index['splines'][key] = dict(kind='IUVSpline', k=int(k_order),
+                                         ext=int(spline.ext))
+        elif isinstance(spline, mp.LogLambdaSpline):
+            arrays[key + '_values.npy'] = spline.values
+            arrays[key + '_slopes.npy'] = spline.slopes
+            index['splines'][key] = dict(kind='LogLambdaSpline',
+                                         log_wave0=spline.log_wave0,
+                                         log_step=spline.log_step)
+        elif isinstance(spline, mp.SplineStackCurve):
+            # save each stack once
+            if id(spline.stack) not in stack_names:
+                stack_name = 'stack{0}'.format(len(stack_names))
+                stack_names[id(spline.stack)] = stack_name
+                arrays[stack_name + '_knots.npy'] = spline.stack.knots
+                arrays[stack_name + '_coeffs.npy'] = spline.stack.coeffs
+                index['stacks'][stack_name] = dict(k=spline.stack.k,
+                                                   names=spline.stack.names)
+            index['splines'][key] = dict(kind='SplineStackCurve',
+                                         stack=stack_names[id(spline.stack)],
+                                         name=spline.name)
+        else:
+            msg = 'Spline "{0}" cannot be cached. Not caching splines.'
+            log.general(msg.format(key))
+            return
+    # write to a temporary directory
+    tmp_path = '{0}.tmp{1}'.format(cache_path, os.getpid())
+    try:
+        os.makedirs(tmp_path, exist_ok=True)
+        for filename in arrays:
+            np.save(os.path.join(tmp_path, filename),
+                    np.asarray(arrays[filename], dtype=float))
+        # the index is written last
+        with open(os.path.join(tmp_path, 'index.json'), 'w') as jfile:
+            json.dump(index, jfile, indent=2)
+        # move the complete cache into place
+        os.rename(tmp_path, cache_path)
+    except OSError as e:
+        # another process may have written the cache first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.exists(os.path.join(cache_path, 'index.json')):
+            msg = 'Could not write spline cache {0}\n\t{1}: {2}'
+            log.warning(msg.format(cache_path, type(e).__name__, str(e)))
+        return
+    # log that we cached the splines
+    msg = 'Template splines cached to {0}'
+    log.general(msg.format(cache_path))
+    # remove the older caches of this template
+    prune_spline_cache(os.path.dirname(cache_path), cache_path, template_file)
+
+
+def prune_spline_cache(cache_dir: str, keep_path: str, template_file: str):
+    """
+    Remove the stale entries of the spline cache: the other caches of this
+    template file (a new template, HP_WIDTH, backend etc. gives a new
+    cache), caches from older cache versions and temporary directories left
+    by processes that died while writing a cache. Processes still using a
+    removed cache keep their (memory-mapped) arrays.
+
+    :param cache_dir: str, the absolute path to the cache directory
+    :param keep_path: str, the absolute path of the cache to keep
+    :param template_file: str, the absolute path to the template file
+
+    :return: None, removes stale spline cache directories
+    """
+    # the template the kept cache was made from
+    template = os.path.realpath(template_file)
+    # loop around the spline caches
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not name.startswith('splines_') or path == keep_path:
+            continue
+        if not os.path.isdir(path):
+            continue
+        # temporary directories are only stale if they are old
+        if '.tmp' in name:
+            stale = time.time() - os.path.getmtime(path) > SPLINE_CACHE_TMP_AGE
+        else:
+            # read the index (a cache without an index is incomplete)
+            try:
+                with open(os.path.join(path, 'index.json'), 'r') as jfile:
+                    index = json.load(jfile)
+            except (OSError, ValueError):
+                continue
+            # older cache versions can never be used again
+            stale = index.get('version', None) != SPLINE_CACHE_VERSION
+            # older caches of the same template are replaced
+            stale |= index.get('template', None) == template
+        # remove the stale cache
+        if stale:
+            shutil.rmtree(path, ignore_errors=True)
+            log.general('Removed stale template spline cache {0}'.format(path))
+
+
+def load_spline_cache(cache_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Load the template splines from the spline cache (arrays are
+    memory-mapped)
+
+    :param cache_path: str, the absolute path to the spline cache directory
+
+    :return: dict, the template splines (None if there is no valid cache)
+    """
+    # the index is written last so without it the cache is not valid
+    index_file = os.path.join(cache_path, 'index.json')
+    if not os.path.exists(index_file):
+        return None
+
+    # memory-map an array of the cache
+    def load_array(filename: str) -> np.ndarray:
+        return np.load(os.path.join(cache_path, filename), mmap_mode='r')
+
+    # storage for splines and spline stacks
+    sps, stacks = dict(), dict()
+    try:
+        # load the index
+        with open(index_file, 'r') as jfile:
+            index = json.load(jfile)
+        # rebuild the spline stacks
+        for name, props in index['stacks'].items():
+            stacks[name] = mp.SplineStack(load_array(name + '_knots.npy'),
+                                          load_array(name + '_coeffs.npy'),
+                                          props['k'], props['names'])
+        # rebuild the splines
+        for key, props in index['splines'].items():
+            if props['kind'] == 'IUVSpline':
+                tck = (load_array(key + '_knots.npy'),
+                       load_array(key + '_coeffs.npy'), props['k'])
+                sps[key] = mp.IUVSpline._from_tck(tck, ext=props['ext'])
+            elif props['kind'] == 'LogLambdaSpline':
+                sps[key] = mp.LogLambdaSpline(props['log_wave0'],
+                                              props['log_step'],
+                                              load_array(key + '_values.npy'),
+                                              load_array(key + '_slopes.npy'))
+            else:
+                sps[key] = stacks[props['stack']].curve(props['name'])
+    except (OSError, ValueError, KeyError) as e:
+        msg = 'Could not load spline cache {0}\n\t{1}: {2}'
+        log.warning(msg.format(cache_path, type(e).__name__, str(e)))
+        return None
+    # return the splines
+    return sps
+
+
 def spline_template(inst: InstrumentsType, template_file: str,
-                    systemic_vel: float, models_dir: str
+                    systemic_vel: float, models_dir: str,
+                    cache_dir: Optional[str] = None
                     ) -> Dict[str, mp.IUVSpline]:
     """
     Calculate all the template splines (for later use)
 
+    If cache_dir is set (and SPLINE_CACHE is True) the splines are loaded
+    from (or saved to) the spline cache
+
     :param inst: Instrument instance
     :param template_file: str, the absolute path to the template file
     :param systemic_vel: float, the systemic velocity
     :param models_dir: str, the absolute path to the models directory
+    :param cache_dir: str or None, the absolute path to the cache directory
 
     :return:
     """
@@ -319,6 +556,28 @@ def spline_template(inst: InstrumentsType, template_file: str,
     log.general(msg)
     # get the pixel hp_width [needs to be in m/s]
     hp_width = inst.params['HP_WIDTH'] * 1000
+    # get the model evaluation backend (and log-lambda oversampling)
+    model_backend = inst.params['COMPUTE_MODEL_BACKEND']
+    oversampling = inst.params['LOGLAMBDA_OVERSAMPLING']
+    # deal with bad model backend
+    if model_backend not in ['spline', 'loglambda']:
+        emsg = ('COMPUTE_MODEL_BACKEND={0} is not valid. Must be "spline" or '
+                '"loglambda"')
+        raise LblException(emsg.format(model_backend))
+    # -------------------------------------------------------------------------
+    # try to load the splines from the spline cache
+    cache_path = None
+    if cache_dir is not None and inst.params['SPLINE_CACHE']:
+        cache_key = spline_cache_key(inst, template_file, systemic_vel,
+                                     models_dir)
+        cache_path = os.path.join(cache_dir, 'splines_' + cache_key)
+        sps = load_spline_cache(cache_path)
+        # if we have the splines we are done
+        if sps is not None:
+            msg = 'Loaded template splines from cache {0}'
+            log.general(msg.format(cache_path))
+            return sps
+    # -------------------------------------------------------------------------
     # load the template
     margs = [template_file]
     msg = 'Loading template file {}'
@@ -372,10 +631,13 @@ def spline_template(inst: InstrumentsType, template_file: str,
         msg = 'Rotational broadening epsilon = {}, vsini = {} km/s'
         log.general(msg.format(*inst.params['ROTBROAD']))
         # push the rotational broadening onto the flux using the rotational
-        #  broadening kernel
-        tflux2 = np.zeros_like(tflux)
-        for ioff in range(len(delta_tmp)):
-            tflux2 += np.roll(tflux, ioff - npix) * rot_kernel[ioff]
+        #  broadening kernel (centred on the delta function). This is a
+        #  normalized convolution so NaNs (and the edges) only remove
+        #  weight from the kernel
+        rot_kernel = rot_kernel[:len(delta_tmp)]
+        tflux2 = mp.convolve_same(tflux, rot_kernel, normalize=True)
+        # keep the invalid pixels invalid
+        tflux2[~np.isfinite(tflux)] = np.nan
         # set this to the flux we would have had from before
         tflux = tflux2
     # -------------------------------------------------------------------------
@@ -415,6 +677,14 @@ def spline_template(inst: InstrumentsType, template_file: str,
     sps['dspline'] = mp.iuv_spline(ntwave, dflux[valid], k=k_order, ext=1)
     sps['d2spline'] = mp.iuv_spline(ntwave, d2flux[valid], k=k_order, ext=1)
     sps['d3spline'] = mp.iuv_spline(ntwave, d3flux[valid], k=k_order, ext=1)
+    # these splines share their knots (they are all on ntwave) so we stack
+    #    them to evaluate the model and its derivatives in one pass
+    model_keys = ['spline0', 'spline', 'dspline', 'd2spline', 'd3spline']
+    if all(isinstance(sps[key], mp.IUVSpline) for key in model_keys):
+        stack = mp.SplineStack.from_splines({key: sps[key]
+                                             for key in model_keys})
+        for key in model_keys:
+            sps[key] = stack.curve(key)
     # deal with residual projection tables
     if isinstance(inst.params['RESPROJ_TABLES'], dict):
         # loop around table
@@ -461,10 +731,51 @@ def spline_template(inst: InstrumentsType, template_file: str,
     ntwave1 = mp.doppler_shift(twave, systemic_vel)
     sps['spline_mask'] = mp.iuv_spline(ntwave1, tmask, k=1, ext=1)
     # -------------------------------------------------------------------------
+    # deal with the log-lambda model backend
+    if model_backend == 'loglambda':
+        # log that we are resampling the template splines
+        msg = 'Resampling template splines on a log-lambda grid (x{0})'
+        log.general(msg.format(oversampling))
+        # resample the splines used by compute rv
+        sps = loglambda_template(sps, ntwave, oversampling)
+    # -------------------------------------------------------------------------
+    # save the splines to the spline cache
+    if cache_path is not None:
+        save_spline_cache(sps, cache_path, template_file)
+    # -------------------------------------------------------------------------
     # return splines
     return sps
 
 
+def loglambda_template(sps: Dict[str, Any], wave: np.ndarray,
+                       oversampling: int) -> Dict[str, Any]:
+    """
+    Replace the template splines used to build the compute rv models
+    (spline0, dspline, d2spline, d3spline) by their resampled equivalent on
+    an oversampled uniform log-wavelength grid (mp.LogLambdaSpline). A Doppler
+    shift is then a constant index offset followed by a local interpolation.
+
+    :param sps: dict, the template splines (from spline_template)
+    :param wave: np.ndarray, the (doppler shifted) template wave grid the
+                 splines were computed on
+    :param oversampling: int, the oversampling of the log-wavelength grid
+                         relative to the template sampling
+
+    :return: dict, the updated template splines
+    """
+    # get the log-wavelength grid
+    log_wave = np.log(wave)
+    log_step = mp.nanmedian(np.diff(log_wave)) / oversampling
+    # number of points to cover the full template
+    npoints = int(np.ceil((log_wave[-1] - log_wave[0]) / log_step)) + 1
+    # loop around the model splines
+    for key in ['spline0', 'dspline', 'd2spline', 'd3spline']:
+        sps[key] = mp.LogLambdaSpline.from_spline(sps[key], log_wave[0],
+                                                  log_step, npoints)
+    # return the updated splines
+    return sps
+
+
 def get_systemic_vel_props(inst: InstrumentsType, template_file: str,
                            mask_file: str) -> Dict[str, Any]:
     # set the function name
@@ -535,17 +846,20 @@ def get_systemic_vel_props(inst: InstrumentsType, template_file: str,
     good = np.isfinite(fluxgrid)
     # Use k=1 to avoid ringing at edges if 'good' has holes.
     sps = mp.iuv_spline(wavegrid[good], fluxgrid[good], k=1, ext=1)
+    # put the template on a magic grid (at the template velocity step)
+    grid_step = get_velocity_step(wavegrid[good], rounding=False)
+    magic_grid = get_magic_grid(wavegrid[good][0], wavegrid[good][-1],
+                                dv_grid=grid_step)
+    magic_flux = sps(magic_grid)
     # ---------------------------------------------------------------------
     # define the ccf dv grid
     dv = np.arange(rv_min, rv_max + rv_step, rv_step)
-    # storage for the ccf
-    ccf_vector = np.zeros_like(dv)
-    # compute the ccf
-    for it in range(len(dv)):
-        # shift the mask by dv for this iteration
-        pos = mp.doppler_shift(mask_table['ll_mask_s'], -dv[it])
-        # calculate the ccf for this iteration
-        ccf_vector[it] = mp.nansum(mask_table['w_mask'] * sps(pos))
+    # compute the ccf (the mask shifted by dv for each element)
+    mask_index = get_magic_index(np.array(mask_table['ll_mask_s']),
+                                 magic_grid[0], grid_step)
+    ccf_vector = compute_ccf(magic_flux, mask_index,
+                             np.array(mask_table['w_mask']),
+                             get_magic_shift(-dv, grid_step))
     # CCF can be normalized to its median as we have only used
     # features in absorption rather than the 'full'
     ccf_vector /= np.nanmedian(ccf_vector)
@@ -668,6 +982,96 @@ def get_magic_grid(wave0: float, wave1: float, dv_grid: float = 500):
     return magic_grid
 
 
+def get_magic_index(wave: np.ndarray, wave0: float,
+                    dv_grid: float) -> np.ndarray:
+    """
+    Get the (fractional) position of wavelengths along a magic grid (see
+    get_magic_grid)
+
+    :param wave: np.ndarray, the wavelengths
+    :param wave0: float, the first wavelength of the magic grid
+    :param dv_grid: float, the grid size in m/s
+
+    :return: np.ndarray, the positions along the magic grid
+    """
+    return np.log(wave / wave0) * speed_of_light_ms / dv_grid
+
+
+def get_magic_shift(velocity: Union[float, np.ndarray],
+                    dv_grid: float) -> Union[float, np.ndarray]:
+    """
+    Get the (fractional) shift along a magic grid of a doppler shift by
+    velocity (see mp.doppler_shift) - a doppler shift is a translation of a
+    magic grid
+
+    :param velocity: float or np.ndarray, the velocity in m/s
+    :param dv_grid: float, the grid size in m/s
+
+    :return: float or np.ndarray, the shift (in magic grid pixels)
+    """
+    # relativistic calculation (1 - v/c)
+    part1 = 1 - (velocity / speed_of_light_ms)
+    # relativistic calculation (1 + v/c)
+    part2 = 1 + (velocity / speed_of_light_ms)
+    # return the shift in pixels
+    return 0.5 * np.log(part1 / part2) * speed_of_light_ms / dv_grid
+
+
+def compute_ccf(spectrum: np.ndarray, line_index: np.ndarray,
+                line_weight: np.ndarray, shifts: np.ndarray,
+                chunk_size: int = CCF_CHUNK_SIZE) -> np.ndarray:
+    """
+    Cross-correlate a spectrum on a magic grid (see get_magic_grid) with a
+    weighted line list for all shifts at once:
+
+        ccf[j] = nansum(line_weight * spectrum[line_index + shifts[j]])
+
+    The positions (line_index + shifts) may be fractional, in which case the
+    spectrum is linearly interpolated between pixels. Positions off the grid
+    are ignored. The positions of all lines at all shifts are gathered at once
+    (in chunks of at most chunk_size positions).
+
+    :param spectrum: np.ndarray, the spectrum on the magic grid
+    :param line_index: np.ndarray, the positions of the lines along the magic
+                       grid (see get_magic_index)
+    :param line_weight: np.ndarray, the weight of each line
+    :param shifts: np.ndarray, the shifts in magic grid pixels (see
+                   get_magic_shift)
+    :param chunk_size: int, the maximum number of positions held in memory at
+                       once
+
+    :return: np.ndarray, the ccf for each shift
+    """
+    # add a NaN pixel for the positions off the grid
+    npix = len(spectrum)
+    spectrum = np.append(np.asarray(spectrum, dtype=float), np.nan)
+    # storage for the ccf
+    ccf_vector = np.zeros(len(shifts))
+    # number of shifts per chunk
+    nchunk = max(1, chunk_size // max(len(line_index), 1))
+    # loop around chunks of shifts
+    for start in range(0, len(shifts), nchunk):
+        # the positions of all lines at these shifts
+        pos = line_index[None, :] + shifts[start:start + nchunk, None]
+        # get the pixel below each position and the fraction to the next
+        low = np.floor(pos)
+        frac = pos - low
+        low = low.astype(int)
+        # positions off the grid use the NaN pixel
+        low[(low < 0) | (low > npix - 1)] = npix
+        high = np.minimum(low + 1, npix)
+        # linear interpolation of the spectrum (only where fractional)
+        values = spectrum[low]
+        interp = frac > 0
+        values[interp] += frac[interp] * (spectrum[high[interp]] -
+                                          values[interp])
+        # the ccf at these shifts is the weighted sum of the line values
+        ccf_vector[start:start + nchunk] = mp.nansum(values * line_weight,
+                                                     axis=1)
+    # return the ccf
+    return ccf_vector
+
+
 def rough_ccf_rv(inst: InstrumentsType, wavegrid: np.ndarray,
                  sci_data: np.ndarray, wave_mask: np.ndarray,
                  weight_line: np.ndarray, kind: str) -> Tuple[float, float]:
@@ -738,10 +1142,9 @@ def rough_ccf_rv(inst: InstrumentsType, wavegrid: np.ndarray,
     magic_grid = get_magic_grid(wave0, wave1, dv_grid=grid_step)
     # spline the magic grid
     magic_spline = spline_sp(magic_grid)
-    # define a spline across the magic grid
-    index_spline = mp.iuv_spline(magic_grid, np.arange(len(magic_grid)))
     # we find the position along the magic grid for the CCF lines
-    index_mask = np.array(index_spline(wave_mask) + 0.5, dtype=int)
+    index_mask = get_magic_index(wave_mask, magic_grid[0], grid_step)
+    index_mask = np.array(index_mask + 0.5, dtype=int)
 
     # -------------------------------------------------------------------------
     # perform the CCF
@@ -750,20 +1153,15 @@ def rough_ccf_rv(inst: InstrumentsType, wavegrid: np.ndarray,
     istep = np.arange(int(rv_min / grid_step), int(rv_max / grid_step))
     # define the dv grid from the initial steps in pixels * rv step
     dvgrid = istep * grid_step
-    # set up the CCF vector for all rv elements
-    ccf_vector = np.zeros(len(istep))
     # define a mask that only keeps certain index values
     keep_line = index_mask > (rv_max / grid_step) + 2
     keep_line &= index_mask < len(magic_spline) - (rv_max / grid_step) - 2
     # only keep the indices and weights within the keep line mask
     index_mask = index_mask[keep_line]
     weight_line = weight_line[keep_line]
-    # now loop around the dv elements
-    for dv_element in range(len(istep)):
-        # get the ccf for each index (and multiply by weight of the line
-        ccf_indices = magic_spline[index_mask - istep[dv_element]] * weight_line
-        # ccf vector at this dv element is the sum of these ccf values
-        ccf_vector[dv_element] = mp.nansum(ccf_indices)
+    # get the ccf for all dv elements (the ccf at each dv element is the
+    #    weighted sum of the magic spline at the shifted line positions)
+    ccf_vector = compute_ccf(magic_spline, index_mask, weight_line, -istep)
 
     # high-pass the CCF just to be really sure that we are finding a true CCF
     # peak and not a spurious excursion in the low-frequencies
@@ -881,7 +1279,8 @@ def get_scaling_ratio(spectrum1: np.ndarray,
 
 def estimate_noise_model(spectrum: np.ndarray, wavegrid: np.ndarray,
                          model: np.ndarray,
-                         noise_sampling_width: float) -> np.ndarray:
+                         noise_sampling_width: float,
+                         nthreads: int = 1) -> np.ndarray:
     """
     Estimate the noise on spectrum given the model
 
@@ -890,55 +1289,78 @@ def estimate_noise_model(spectrum: np.ndarray, wavegrid: np.ndarray,
     :param model: np.ndarray, the model
     :param noise_sampling_width: float, the width of the window used to sample
                                    the noise.
+    :param nthreads: int, the number of threads to use (orders are split
+                     between threads)
 
     :return: np.ndarray, the rms vector for this spectrum give the model
     """
     # storage for output rms
     rms = np.zeros_like(spectrum)
-    # loop around each order and estimate noise model
-    for order_num in range(spectrum.shape[0]):
-        # get the wavelength for this order
-        waveord = wavegrid[order_num]
-        # calculate the number of points for the sliding error rms
-        npoints = get_velo_scale(waveord, noise_sampling_width)
-        # get the residuals between science and model
-        residuals = spectrum[order_num] - model[order_num]
-        # get the pixels along the model to spline at (box centers)
-        indices = np.arange(0, model.shape[1], npoints // 4)
-        # store the sigmas
-        sigma = np.zeros_like(indices, dtype=float)
-        # loop around each pixel and work out sigma value
-        for it in range(len(indices)):
-            # get start and end values for this box
-            istart = indices[it] - npoints // 2
-            iend = indices[it] + npoints // 2
-            # fix boundary problems
-            if istart < 0:
-                istart = 0
-            if iend > model.shape[1]:
-                iend = model.shape[1]
-            tmp = residuals[istart: iend]
-            # if more than 50% of the points are valid. If shorter at the
-            # start or end of domain, we compare to npoints rather than the
-            # length of tmp
-            frac_valid = np.sum(np.isfinite(tmp)) / npoints
-            if frac_valid > 0.5:
-                # work out the sigma of this box
-                sigma[it] = mp.estimate_sigma(tmp)
-            # set any zero values to NaN
-            sigma[sigma == 0] = np.nan
-        # mask all NaN values
-        good = np.isfinite(sigma)
-        # if we have enough points calculate the rms
-        if np.sum(good) > 2:
-            # get the spline across all indices
-            rms_spline = mp.iuv_spline(indices[good], sigma[good], k=1, ext=1)
-            # apply the spline to the model positions
-            rms[order_num] = rms_spline(np.arange(model.shape[1]))
-        # else we don't have a noise model
-        else:
-            # we fill the rms with NaNs for each pixel
-            rms[order_num] = np.full(model.shape[1], fill_value=np.nan)
+    # number of pixels per order
+    npix = model.shape[1]
+    # get the residuals between science and model (flattened, with an extra
+    #    NaN pixel used to pad the boxes)
+    residuals = np.append(np.ravel(spectrum - model), np.nan)
+    # estimate the noise model for a group of orders (the sigmas of all boxes
+    #    of all these orders are computed in one pass)
+    def noise_model_orders(orders: np.ndarray):
+        # storage for the centers, bounds and number of points of each box
+        order_index, indices, istarts, iends, npoints = [], [], [], [], []
+        # loop around orders
+        for order_num in orders:
+            # calculate the number of points for the sliding error rms
+            npoints_ord = get_velo_scale(wavegrid[order_num],
+                                         noise_sampling_width)
+            # get the pixels along the model to interpolate at (box centers)
+            indices_ord = np.arange(0, npix, npoints_ord // 4)
+            indices.append(indices_ord)
+            # get start and end values for each box (fix boundary problems)
+            istarts.append(np.maximum(indices_ord - npoints_ord // 2, 0))
+            iends.append(np.minimum(indices_ord + npoints_ord // 2, npix))
+            # the order and number of points of each box
+            order_index.append(np.full(len(indices_ord), order_num))
+            npoints.append(np.full(len(indices_ord), npoints_ord))
+        # convert to arrays
+        order_index = np.concatenate(order_index)
+        indices = np.concatenate(indices)
+        istarts, iends = np.concatenate(istarts), np.concatenate(iends)
+        npoints = np.concatenate(npoints)
+        # get the residuals in each box (padded with NaNs to the longest box)
+        pixels = istarts[:, None] + np.arange(np.max(iends - istarts))
+        flat_pixels = order_index[:, None] * npix + pixels
+        flat_pixels[pixels >= iends[:, None]] = len(residuals) - 1
+        tmp = residuals[flat_pixels]
+        # if more than 50% of the points are valid. If shorter at the
+        # start or end of domain, we compare to npoints rather than the
+        # length of tmp
+        frac_valid = np.sum(np.isfinite(tmp), axis=1) / npoints
+        # work out the sigma of these boxes
+        sigma = np.zeros(len(tmp))
+        valid = frac_valid > 0.5
+        sigma[valid] = mp.estimate_sigma_rows(tmp[valid])
+        # set any zero values to NaN
+        sigma[sigma == 0] = np.nan
+        # loop around orders
+        for order_num in orders:
+            # get the box centers and sigmas of this order
+            order_mask = order_index == order_num
+            indices_ord, sigma_ord = indices[order_mask], sigma[order_mask]
+            # mask all NaN values
+            good = np.isfinite(sigma_ord)
+            # if we have enough points calculate the rms
+            if np.sum(good) > 2:
+                # linear interpolation to the model positions (zero outside
+                #    the first and last good box)
+                rms[order_num] = np.interp(np.arange(npix), indices_ord[good],
+                                           sigma_ord[good], left=0, right=0)
+            # else we don't have a noise model
+            else:
+                # we fill the rms with NaNs for each pixel
+                rms[order_num] = np.full(npix, fill_value=np.nan)
+    # split the orders between threads and estimate the noise model
+    order_groups = np.array_split(np.arange(spectrum.shape[0]), nthreads)
+    order_groups = [group for group in order_groups if len(group) > 0]
+    base.thread_map(noise_model_orders, order_groups, nthreads)
     rms[rms == 0] = np.nan
     # return rms
     return rms
@@ -970,6 +1392,584 @@ def bouchy_equation_line(vector: np.ndarray, diff_vector: np.ndarray,
     return value, rms_value
 
 
+def bouchy_equation_lines(vector: np.ndarray, diff_vector: np.ndarray,
+                          mean_rms: np.ndarray, offsets: np.ndarray
+                          ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Apply the Bouchy 2001 equation to many lines at once (same as
+    bouchy_equation_line but for flat arrays of concatenated line segments)
+
+    :param vector: np.ndarray, the flat concatenated vectors of all lines
+    :param diff_vector: np.ndarray, the flat concatenated diff vectors of
+                        all lines
+    :param mean_rms: np.ndarray, the mean rms of each line [nlines]
+    :param offsets: np.ndarray, the start index of each line segment in the
+                    flat arrays [nlines]
+
+    :return: tuple, 1. the value for each line, 2. the rms of the value for
+             each line
+    """
+    # get the number of pixels in each segment
+    npix = np.diff(np.append(offsets, len(vector)))
+    # suppress the division warnings (nans are dealt with later)
+    with warnings.catch_warnings(record=True) as _:
+        # work out the rms (mean rms of the line for each pixel)
+        rms_pix = np.repeat(mean_rms, npix) / vector
+        # work out the RV error (must be a sum - see bouchy_equation_line)
+        rms_value = 1 / np.sqrt(np.add.reduceat(1 / rms_pix ** 2, offsets))
+        # feed the lines (must be a sum - see bouchy_equation_line)
+        value = np.add.reduceat(diff_vector * vector, offsets)
+        value = value / np.add.reduceat(vector ** 2, offsets)
+    # return the value and rms of the value
+    return value, rms_value
+
+
+def segment_nansum(vector: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    The nansum of each segment of a flat array of concatenated segments
+
+    :param vector: np.ndarray, the flat concatenated segments
+    :param offsets: np.ndarray, the start index of each segment
+
+    :return: np.ndarray, the nansum of each segment (zero if all NaN)
+    """
+    return np.add.reduceat(np.where(np.isnan(vector), 0.0, vector), offsets)
+
+
+def array_hash(array: Optional[np.ndarray]) -> Union[str, None]:
+    """
+    Identify an array by its content (sha1 hash of its bytes)
+
+    :param array: np.ndarray, the array (or None)
+
+    :return: str, the hash of the array (None if array is None)
+    """
+    if array is None:
+        return None
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+def get_wave2pix_map(wavegrid: np.ndarray) -> mp.WavePixelMap:
+    """
+    Get the wave to pixel map for a wave solution. The map of the last wave
+    solution is kept so consecutive files sharing a wave solution only
+    build it once.
+
+    :param wavegrid: np.ndarray, the wave grid [norder, npix]
+
+    :return: WavePixelMap, the wave to pixel map for this wave grid
+    """
+    # the wave solution is identified by its content
+    key = array_hash(wavegrid)
+    # only keep the last map
+    if key not in WAVE2PIX_CACHE:
+        WAVE2PIX_CACHE.clear()
+        WAVE2PIX_CACHE[key] = mp.WavePixelMap(wavegrid)
+    # return the wave to pixel map
+    return WAVE2PIX_CACHE[key]
+
+
+def get_line_spans(ref_table: Dict[str, Any], nwavegrid: np.ndarray,
+                   wave2pix: mp.WavePixelMap, velocity: float,
+                   mask_keep: np.ndarray,
+                   iteration: int, min_line_width: int,
+                   flatten: bool = True) -> Dict[str, Any]:
+    """
+    Work out the pixel span of all lines that need measuring in this
+    iteration and flatten them into concatenated index arrays (with the
+    edge pixels weighted by their overlap with the line)
+
+    Lines failing the boundary conditions are flagged in mask_keep (updated
+    in place) exactly as in the per-line loop of compute_rv
+
+    :param ref_table: dict, the reference table (WAVE_START, WAVE_END, ORDER)
+    :param nwavegrid: np.ndarray, the doppler shifted wave grid [norder, npix]
+    :param wave2pix: WavePixelMap, the wave to pixel map of the (unshifted)
+                     wave grid
+    :param velocity: float, the velocity nwavegrid is doppler shifted by
+    :param mask_keep: np.ndarray, the mask of lines to keep (updated)
+    :param iteration: int, the compute rv iteration number
+    :param min_line_width: int, the minimum line width (in pixels)
+    :param flatten: bool, if False only the per-line spans are computed
+                    (not the flat index and weight arrays)
+
+    :return: dict, the line spans (LINES, ORDER, WAVE_START, WAVE_END,
+             X_START, X_END, NPIX and if flatten: OFFSETS, FLAT_ORDER,
+             FLAT_PIX, WEIGHT)
+    """
+    # get the line properties
+    orders = np.array(ref_table['ORDER'], dtype=int)
+    wave_start = np.array(ref_table['WAVE_START'], dtype=float)
+    wave_end = np.array(ref_table['WAVE_END'], dtype=float)
+    # lines flagged as bad are skipped (in all but the second iteration)
+    if iteration != 1:
+        lines = np.where(mask_keep)[0]
+    else:
+        lines = np.arange(len(orders))
+    # storage for pixel positions of the start and end of the lines
+    x_start = np.zeros(len(lines), dtype=int)
+    x_end = np.zeros(len(lines), dtype=int)
+    # loop around orders (one spline call per order)
+    for order_num in np.unique(orders[lines]):
+        # get the lines in this order
+        omask = orders[lines] == order_num
+        # get the pixel position of the start and end of the lines
+        xs = wave2pix(order_num, wave_start[lines[omask]], velocity)
+        xe = wave2pix(order_num, wave_end[lines[omask]], velocity)
+        # round pixel positions to nearest pixel
+        x_start[omask] = np.floor(xs).astype(int)
+        x_end[omask] = np.floor(xe).astype(int)
+    # -------------------------------------------------------------------------
+    # boundary conditions
+    good = (x_end - x_start) >= min_line_width
+    good &= x_start >= 0
+    good &= x_end <= nwavegrid.shape[1] - 2
+    # flag bad lines
+    mask_keep[lines[~good]] = False
+    # only keep the good lines
+    lines, x_start, x_end = lines[good], x_start[good], x_end[good]
+    orders, wave_start = orders[lines], wave_start[lines]
+    wave_end = wave_end[lines]
+    # number of pixels in each line
+    npix = x_end - x_start + 1
+    # push into span dictionary
+    spans = dict()
+    spans['LINES'] = lines
+    spans['ORDER'] = orders
+    spans['WAVE_START'] = wave_start
+    spans['WAVE_END'] = wave_end
+    spans['X_START'] = x_start
+    spans['X_END'] = x_end
+    spans['NPIX'] = npix
+    # the compiled engine does not need the flat arrays
+    if not flatten:
+        return spans
+    # -------------------------------------------------------------------------
+    # offset of each line in flat arrays
+    offsets = np.cumsum(npix) - npix
+    # flat pixel and order positions of all lines
+    flat_pix = np.arange(np.sum(npix)) - np.repeat(offsets - x_start, npix)
+    flat_order = np.repeat(orders, npix)
+    # -------------------------------------------------------------------------
+    # get weights at the edge of the domain. Pixels inside have a
+    # weight of 1, at the edge, it's proportional to the overlap
+    weight = np.ones(len(flat_pix))
+    # deal with overlapping pixels (before start)
+    first = nwavegrid[orders, x_start] < wave_start
+    refdiff = nwavegrid[orders, x_start + 1] - wave_start
+    wavediff = nwavegrid[orders, x_start + 1] - nwavegrid[orders, x_start]
+    weight[offsets[first]] = 1 - refdiff[first] / wavediff[first]
+    # deal with overlapping pixels (after end)
+    last = nwavegrid[orders, x_end + 1] > wave_end
+    refdiff = wave_end - nwavegrid[orders, x_end]
+    wavediff = nwavegrid[orders, x_end] - nwavegrid[orders, x_end - 1]
+    weight[(offsets + npix - 1)[last]] = 1 - refdiff[last] / wavediff[last]
+    # -------------------------------------------------------------------------
+    # push into span dictionary
+    spans['OFFSETS'] = offsets
+    spans['FLAT_ORDER'] = flat_order
+    spans['FLAT_PIX'] = flat_pix
+    spans['WEIGHT'] = weight
+    # return the span dictionary
+    return spans
+
+
+def compute_line_rvs(spans: Dict[str, Any], sci_data: np.ndarray,
+                     model: np.ndarray, dmodel: np.ndarray, rms: np.ndarray,
+                     blaze: np.ndarray, d2model: Optional[np.ndarray] = None,
+                     d3model: Optional[np.ndarray] = None,
+                     proj_models: Optional[Dict[str, np.ndarray]] = None,
+                     last_iter: bool = False) -> Dict[str, Any]:
+    """
+    Compute the line-by-line velocities (and derivative projections) for
+    all lines at once, using the flat line spans from get_line_spans
+
+    :param spans: dict, the line spans (from get_line_spans)
+    :param sci_data: np.ndarray, the science data [norder, npix]
+    :param model: np.ndarray, the model [norder, npix]
+    :param dmodel: np.ndarray, the 1st derivative model [norder, npix]
+    :param rms: np.ndarray, the rms [norder, npix]
+    :param blaze: np.ndarray, the blaze [norder, npix]
+    :param d2model: np.ndarray, the 2nd derivative model [norder, npix]
+                    (only used on the last iteration)
+    :param d3model: np.ndarray, the 3rd derivative model [norder, npix]
+                    (only used on the last iteration)
+    :param proj_models: dict, for each residual projection table the
+                        projection model [norder, npix] (only used on the
+                        last iteration)
+    :param last_iter: bool, if True this is the last iteration and we
+                      compute the derivative projections and line stats
+
+    :return: dict, the per-line values for the lines in spans['LINES']
+    """
+    # get the flat positions, weights and offsets of the lines
+    flat = (spans['FLAT_ORDER'], spans['FLAT_PIX'])
+    weight = spans['WEIGHT']
+    offsets = spans['OFFSETS']
+    npix = spans['NPIX']
+    # storage for outputs
+    lout = dict()
+    # deal with no lines to measure
+    if len(offsets) == 0:
+        return lout
+    # get mean xpix and mean blaze for lines
+    with warnings.catch_warnings(record=True) as _:
+        lout['MEANXPIX'] = (segment_nansum(weight * flat[1], offsets) /
+                            segment_nansum(weight, offsets))
+    mid_pix = (spans['X_START'] + spans['X_END']) // 2
+    lout['MEANBLAZE'] = blaze[spans['ORDER'], mid_pix]
+    # get the science and model segments (line sums are always done in
+    #    float64, even if the arrays are float32)
+    sci_seg = sci_data[flat].astype(float, copy=False)
+    model_seg = model[flat].astype(float, copy=False)
+    # derivative of the segments
+    d_seg = dmodel[flat] * weight
+    # keep track of the fraction of each lines that is not finite
+    finite_sci = np.isfinite(sci_seg).astype(float)
+    lout['FRAC_LINE_VALID'] = np.add.reduceat(finite_sci, offsets) / npix
+    # calculate the difference of the segments (weighted by the mask)
+    diff_seg = (sci_seg - model_seg) * weight
+    # work out the mean rms (weighted by the mask)
+    sum_rms = np.add.reduceat(rms[flat] * weight, offsets)
+    mean_rms = sum_rms / np.add.reduceat(weight, offsets)
+    # -------------------------------------------------------------------------
+    # work out the 1st derivative
+    #    From bouchy 2001 equation, RV error for each pixel
+    # -------------------------------------------------------------------------
+    bout = bouchy_equation_lines(d_seg, diff_seg, mean_rms, offsets)
+    lout['DV'], lout['SDV'] = bout
+    # the rest is only done on the last iteration
+    if not last_iter:
+        return lout
+    # -------------------------------------------------------------------------
+    # work out the 0th derivative (requires at least 2 finite model values)
+    #    From bouchy 2001 equation, RV error for each pixel
+    # -------------------------------------------------------------------------
+    num_model = np.add.reduceat(np.isfinite(model_seg).astype(int), offsets)
+    num_nonnan = np.add.reduceat((~np.isnan(model_seg)).astype(int), offsets)
+    with warnings.catch_warnings(record=True) as _:
+        v1 = segment_nansum(model_seg, offsets) / num_nonnan
+    bout = bouchy_equation_lines(model_seg - np.repeat(v1, npix), diff_seg,
+                                 mean_rms, offsets)
+    lout['D0V_VALID'] = num_model >= 2
+    lout['D0V'], lout['SD0V'] = bout
+    # -------------------------------------------------------------------------
+    # work out the 2nd and 3rd derivative
+    #    From bouchy 2001 equation, RV error for each pixel
+    # -------------------------------------------------------------------------
+    bout = bouchy_equation_lines(d2model[flat] * weight, diff_seg, mean_rms,
+                                 offsets)
+    lout['D2V'], lout['SD2V'] = bout
+    bout = bouchy_equation_lines(d3model[flat] * weight, diff_seg, mean_rms,
+                                 offsets)
+    lout['D3V'], lout['SD3V'] = bout
+    # -------------------------------------------------------------------------
+    # deal with residual projection tables if required
+    if proj_models is not None:
+        lout['PROJ'] = dict()
+        # loop around residual project tables
+        for key in proj_models:
+            pd_seg = proj_models[key][flat] * weight
+            # calculate the bouchy equation
+            lout['PROJ'][key] = bouchy_equation_lines(pd_seg, diff_seg,
+                                                      mean_rms, offsets)
+    # -------------------------------------------------------------------------
+    # ratio of expected VS actual RMS in difference of model vs line
+    #   (the nanstd of each segment)
+    finite_diff = ~np.isnan(diff_seg)
+    num_diff = np.add.reduceat(finite_diff.astype(int), offsets)
+    with warnings.catch_warnings(record=True) as _:
+        mean_diff = segment_nansum(diff_seg, offsets) / num_diff
+        sq_diff = (diff_seg - np.repeat(mean_diff, npix)) ** 2
+        std_diff = np.sqrt(segment_nansum(sq_diff, offsets) / num_diff)
+        lout['RMSRATIO'] = std_diff / mean_rms
+        # Considering the number of pixels, expected and actual RMS, this
+        #   is the likelihood that the line is actually valid from chi2
+        #   point of view
+        norm_diff = (diff_seg / np.repeat(mean_rms, npix)) ** 2
+        lout['CHI2'] = segment_nansum(norm_diff, offsets)
+    # effective number of pixels in line
+    lout['NPIXLINE'] = npix
+    # return the per-line outputs
+    return lout
+
+
+def compute_line_rvs_numba(spans: Dict[str, Any], nwavegrid: np.ndarray,
+                           sci_data: np.ndarray, model: np.ndarray,
+                           dmodel: np.ndarray, rms: np.ndarray,
+                           blaze: np.ndarray, d2model: np.ndarray,
+                           d3model: np.ndarray,
+                           proj_models: Optional[Dict[str, np.ndarray]] = None,
+                           last_iter: bool = False) -> Dict[str, Any]:
+    """
+    Compute the line-by-line velocities (and derivative projections) for
+    all lines with the compiled kernel (mp.bouchy_lines_kernel). Returns
+    the same dictionary as compute_line_rvs.
+
+    :param spans: dict, the line spans (from get_line_spans)
+    :param nwavegrid: np.ndarray, the doppler shifted wave grid
+                      [norder, npix]
+    :param sci_data: np.ndarray, the science data [norder, npix]
+    :param model: np.ndarray, the model [norder, npix]
+    :param dmodel: np.ndarray, the 1st derivative model [norder, npix]
+    :param rms: np.ndarray, the rms [norder, npix]
+    :param blaze: np.ndarray, the blaze [norder, npix]
+    :param d2model: np.ndarray, the 2nd derivative model [norder, npix]
+    :param d3model: np.ndarray, the 3rd derivative model [norder, npix]
+    :param proj_models: dict, for each residual projection table the
+                        projection model [norder, npix] (only used on the
+                        last iteration)
+    :param last_iter: bool, if True this is the last iteration and we
+                      compute the derivative projections and line stats
+
+    :return: dict, the per-line values for the lines in spans['LINES']
+    """
+    # storage for outputs
+    lout = dict()
+    # deal with no lines to measure
+    if len(spans['LINES']) == 0:
+        return lout
+    # the kernel takes the projection models as a single cube
+    if proj_models is not None:
+        proj_keys = list(proj_models.keys())
+        proj_cube = np.array([proj_models[key] for key in proj_keys])
+    else:
+        proj_keys = []
+        proj_cube = np.zeros((0,) + sci_data.shape, dtype=sci_data.dtype)
+    # run the compiled kernel
+    kout = mp.bouchy_lines_kernel(spans['ORDER'], spans['X_START'],
+                                  spans['X_END'], spans['WAVE_START'],
+                                  spans['WAVE_END'], nwavegrid, sci_data,
+                                  model, dmodel, d2model, d3model, proj_cube,
+                                  rms, blaze, last_iter)
+    # push into the output dictionary
+    lout['MEANXPIX'], lout['MEANBLAZE'], lout['FRAC_LINE_VALID'] = kout[:3]
+    lout['DV'], lout['SDV'] = kout[3:5]
+    # the rest is only done on the last iteration
+    if not last_iter:
+        return lout
+    lout['D0V'], lout['SD0V'], lout['D0V_VALID'] = kout[5:8]
+    lout['D2V'], lout['SD2V'] = kout[8:10]
+    lout['D3V'], lout['SD3V'] = kout[10:12]
+    # deal with residual projection tables if required
+    if proj_models is not None:
+        lout['PROJ'] = dict()
+        for it, key in enumerate(proj_keys):
+            lout['PROJ'][key] = (kout[12][it], kout[13][it])
+    # line statistics
+    lout['RMSRATIO'], lout['CHI2'] = kout[14:16]
+    lout['NPIXLINE'] = spans['NPIX']
+    # return the per-line outputs
+    return lout
+
+
+def get_compute_nthreads(inst: InstrumentsType) -> int:
+    """
+    Get the number of threads compute rv uses over orders
+    (COMPUTE_NTHREADS), bounded so that all the processes (NCORES) do not
+    use more than the cpus available
+
+    :param inst: Instrument instance
+
+    :return: int, the number of threads (at least 1)
+    """
+    # get the number of threads requested
+    nthreads = inst.params['COMPUTE_NTHREADS']
+    # deal with no value set
+    if nthreads is None or nthreads < 1:
+        return 1
+    # get the number of processes running compute rv
+    ncores = max(inst.params.get('NCORES', 1) or 1, 1)
+    # the cpus available to each process
+    max_threads = max(base.cpu_count() // ncores, 1)
+    # warn if we have to reduce the number of threads
+    if nthreads > max_threads:
+        wmsg = ('COMPUTE_NTHREADS={0} too large for {1} cpus and NCORES={2}. '
+                'Using {3} threads')
+        wargs = [nthreads, base.cpu_count(), ncores, max_threads]
+        log.warning(wmsg.format(*wargs))
+    # return the number of threads
+    return min(nthreads, max_threads)
+
+
+def build_model_order(order_num: int, wavegrid: np.ndarray,
+                      blaze: np.ndarray, splines: Dict[str, Any],
+                      spline_mask: mp.IUVSpline, model_keys: List[str],
+                      shift: float, width: np.ndarray, sci_data: np.ndarray,
+                      model: np.ndarray, ratio: np.ndarray, lowpass: bool,
+                      warm_ratio: Optional[np.ndarray] = None
+                      ) -> Tuple[bool, Optional[np.ndarray],
+                                 Optional[Dict[str, np.ndarray]]]:
+    """
+    Update the model of a single order (the doppler shifted template
+    corrected for the blaze) and work out whether its science to model
+    ratio needs to be low-passed again
+
+    :param order_num: int, the order number
+    :param wavegrid: np.ndarray, the wave grid [norder, npix]
+    :param blaze: np.ndarray, the blaze [norder, npix]
+    :param splines: dict, the template splines (from spline_template)
+    :param spline_mask: spline, the mask of the template (0 or 1)
+    :param model_keys: list of str, the model splines to evaluate
+    :param shift: float, the doppler shift of the model (m/s)
+    :param width: np.ndarray, the low-pass width of each order (0 for orders
+                  with fewer than 3 lines)
+    :param sci_data: np.ndarray, the science data [norder, npix]
+    :param model: np.ndarray, the model [norder, npix] (updated)
+    :param ratio: np.ndarray, the low-passed science to model ratio
+                  [norder, npix] (updated if warm_ratio is used)
+    :param lowpass: bool, whether the ratio needs to be low-passed again
+    :param warm_ratio: np.ndarray or None, if set the ratio of the previous
+                       file [norder, npix], scaled to this spectrum instead
+                       of low-passing the ratio
+
+    :return: tuple, 1. whether the ratio needs to be low-passed, 2. the
+             doppler shifted wave grid of this order, 3. the model splines
+             evaluated for this order (2. and 3. are None if the order has
+             fewer than 3 lines)
+    """
+    # flags orders that have <3 lines
+    # do not spend time on this order computing anything
+    if width[order_num] == 0:
+        return False, None, None
+    # doppler shifted wave grid for this order
+    wave_ord = mp.doppler_shift(wavegrid[order_num], shift)
+    # evaluate the model splines (in one pass when they are stacked)
+    template_ord = mp.evaluate_splines(splines, model_keys, wave_ord)
+    # get the blaze for this order
+    blaze_ord = blaze[order_num]
+    # get the low-frequency component out
+    model_mask = np.ones_like(model[order_num])
+    # add the spline mask values to model_mask (spline mask is 0 or 1)
+    smask = spline_mask(wave_ord) < 0.99
+    # set spline mask splined values to NaN
+    model_mask[smask] = np.nan
+    # RV shift the spline and correct for blaze and add model mask
+    # TODO spline0 or spline depending on the type of filtering and
+    #      normalization
+    model[order_num] = template_ord['spline0'] * blaze_ord * model_mask
+    # whether we need to low-pass the ratio for this order
+    do_hp = lowpass
+    # warm start: scale the ratio of the previous file to the flux of this
+    #    spectrum (do the low-pass if this fails)
+    if warm_ratio is not None:
+        wratio = warm_ratio[order_num]
+        part2 = model[order_num] * wratio
+        part2[part2 == 0] = np.nan
+        with warnings.catch_warnings(record=True) as _:
+            scale = mp.nanmedian(sci_data[order_num] / part2)
+        if np.isfinite(scale):
+            ratio[order_num] = wratio * scale
+            do_hp = False
+    # the model is the denominator of the low-passed ratio
+    if do_hp:
+        model[order_num][model[order_num] == 0] = np.nan
+    # return whether to low-pass, the wave grid and the model splines
+    return do_hp, wave_ord, template_ord
+
+
+def finish_model_order(order_num: int, wave_ords: List[np.ndarray],
+                       template_ords: List[Dict[str, np.ndarray]],
+                       blaze: np.ndarray, width: np.ndarray,
+                       splines: Dict[str, Any], sci_data: np.ndarray,
+                       sci_data0: np.ndarray, ratio: np.ndarray,
+                       model: np.ndarray, model0: np.ndarray,
+                       dmodel: np.ndarray, d2model: np.ndarray,
+                       d3model: np.ndarray, proj_model: Dict[str, Any],
+                       first_iter: bool, last_iter: bool):
+    """
+    Update model0, dmodel, d2model, d3model (and the residual projection
+    models) of a single order once the low-passed ratio is known
+
+    :param order_num: int, the order number
+    :param wave_ords: list of np.ndarray, the doppler shifted wave grid of
+                      each order (from build_model_order)
+    :param template_ords: list of dicts, the model splines evaluated for
+                          each order (from build_model_order)
+    :param blaze: np.ndarray, the blaze [norder, npix]
+    :param width: np.ndarray, the low-pass width of each order (0 for orders
+                  with fewer than 3 lines)
+    :param splines: dict, the template splines (from spline_template)
+    :param sci_data: np.ndarray, the science data [norder, npix]
+    :param sci_data0: np.ndarray, the original science data [norder, npix]
+    :param ratio: np.ndarray, the low-passed science to model ratio
+                  [norder, npix]
+    :param model: np.ndarray, the model [norder, npix] (updated)
+    :param model0: np.ndarray, the model of the original spectrum
+                   [norder, npix] (updated on the first iteration)
+    :param dmodel: np.ndarray, the first derivative model (updated)
+    :param d2model: np.ndarray, the second derivative model (updated on the
+                    last iteration)
+    :param d3model: np.ndarray, the third derivative model (updated on the
+                    last iteration)
+    :param proj_model: dict, the residual projection models (updated on the
+                       last iteration)
+    :param first_iter: bool, whether this is the first iteration
+    :param last_iter: bool, whether this is the last iteration
+
+    :return: None, updates the models in place
+    """
+    # flags orders that have <3 lines
+    if width[order_num] == 0:
+        return
+    # get the doppler shifted wave grid, model splines and blaze for
+    #    this order
+    wave_ord = wave_ords[order_num]
+    template_ord = template_ords[order_num]
+    blaze_ord = blaze[order_num]
+
+    model[order_num] *= ratio[order_num]
+
+    # work out the ratio between spectrum and model
+    # amp = get_scaling_ratio(sci_data[order_num], model[order_num])
+    # apply this scaling ratio to the model
+    # model[order_num] = model[order_num] * amp
+
+    # corr_model = mp.lowpassfilter(model[order_num] - sci_data[order_num],
+    #                              width=100)
+    # model[order_num] -= corr_model
+    # if this is the first iteration update model0
+    if first_iter:
+        # spline the original template and apply blaze
+        model0[order_num] = template_ord['spline0'] * blaze_ord
+        model0[order_num][model0[order_num] == 0] = np.nan
+        # get the good values for the median
+        valid = np.isfinite(model0[order_num])
+        valid &= np.isfinite(sci_data[order_num])
+
+        # get the median for the model and original spectrum
+        med_model0 = mp.nanmedian(model0[order_num][valid])
+        med_sci_data_0 = mp.nanmedian(sci_data0[order_num][valid])
+        # normalize by the median
+        with warnings.catch_warnings(record=True):
+            model0[order_num] = model0[order_num] / med_model0
+        # multiply by the median of the original spectrum
+        with warnings.catch_warnings(record=True):
+            model0[order_num] = model0[order_num] * med_sci_data_0
+    # update the other splines
+    # track ratio if relevant
+    dmodel[order_num] = template_ord['dspline'] * blaze_ord * ratio[order_num]
+    # only do the d2 and d3 stuff if on last iteration
+    if last_iter:
+        d2model_ord = (template_ord['d2spline'] * blaze_ord *
+                       ratio[order_num])
+        d3model_ord = (template_ord['d3spline'] * blaze_ord *
+                       ratio[order_num])
+        d2model[order_num] = d2model_ord
+        d3model[order_num] = d3model_ord
+        # deal with residual projection tables (one projection model per
+        #    residual projection table)
+        for key in proj_model:
+            # calculate spline
+            rp_spline = splines[key](wave_ord)
+            # The models are always expressed in terms of the
+            # original spectrum
+            rblaze = np.nanmedian(sci_data0[order_num] / blaze_ord)
+            rp_spline *= (blaze_ord * rblaze)
+            # add to projection model
+            proj_model[key]['model'][order_num] = rp_spline
+
+
 def compute_rv(inst: InstrumentsType, sci_iteration: int,
                sci_data: np.ndarray, sci_hdr: io.LBLHeader,
                splines: Dict[str, Any], ref_table: Dict[str, Any],
@@ -977,7 +1977,8 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
                systemic_all: np.ndarray,
                mjdate_all: np.ndarray, ccf_ewidth: Union[float, None] = None,
                reset_rv: bool = True, model_velocity: float = np.inf,
-               science_file: str = '', mask_file: str = ''
+               science_file: str = '', mask_file: str = '',
+               warm_start: Optional[Dict[str, Any]] = None
                ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
     """
     Compute the RV using a line-by-line analysis
@@ -1001,6 +2002,11 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
     :param science_file: str, the science file name (required for some
                          instruments)
     :param mask_file: str, the mask file name (required for science data types)
+    :param warm_start: dict or None, outputs['WARM_START'] of the previous
+                       file. If set (and reset_rv is False) the systemic
+                       velocity starts from the previous file (corrected for
+                       the BERV difference) and the previous low-pass ratio
+                       is reused (if the blaze and wave solution match)
 
     :return: tuple, 1. the reference table dict, 2. the output dictionary
     """
@@ -1037,6 +2043,34 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
     resproj_flag = isinstance(inst.params['RESPROJ_TABLES'], dict)
     # get the size of running window sample = noise
     noise_sampling_width = inst.params['NOISE_SAMPLING_WIDTH']
+    # get the engine used to compute the line-by-line velocities
+    compute_engine = inst.params['COMPUTE_ENGINE']
+    # get the number of threads to use over orders
+    nthreads = get_compute_nthreads(inst)
+    # get the stage timer (does nothing unless COMPUTE_PROFILE is True)
+    timer = StageTimer(enabled=inst.params['COMPUTE_PROFILE'])
+    # get the precision of the science and model arrays
+    compute_precision = inst.params['COMPUTE_PRECISION']
+    # -------------------------------------------------------------------------
+    # deal with bad compute engine
+    if compute_engine not in ['numba', 'numpy', 'legacy']:
+        emsg = ('COMPUTE_ENGINE={0} is not valid. Must be "numba", "numpy" '
+                'or "legacy"')
+        raise LblException(emsg.format(compute_engine))
+    # the numba engine falls back to the numpy engine without numba
+    if compute_engine == 'numba' and not mp.HAS_NUMBA:
+        log.warning('COMPUTE_ENGINE=numba requires numba. Using "numpy"')
+        compute_engine = 'numpy'
+    # -------------------------------------------------------------------------
+    # deal with bad precision
+    if compute_precision not in ['float64', 'float32']:
+        emsg = ('COMPUTE_PRECISION={0} is not valid. Must be "float64" or '
+                '"float32"')
+        raise LblException(emsg.format(compute_precision))
+    # the science data, model, derivative models, ratio and rms arrays all
+    #    follow the precision of the science data (line sums are always done
+    #    in float64)
+    sci_data = np.asarray(sci_data, dtype=compute_precision)
     # -------------------------------------------------------------------------
     # deal with max number of iterations higher than computer_rv_n_iters
     if max_good_num_iters > compute_rv_n_iters:
@@ -1062,8 +2096,13 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
     # get the wave grid for this science data
     # -------------------------------------------------------------------------
     # instrument specific wave solution --> use instrument method
-    wavegrid = inst.get_wave_solution(data=sci_data, header=sci_hdr,
-                                      science_filename=science_file)
+    with timer.stage('WAVE_SOLUTION'):
+        wavegrid = inst.get_wave_solution(data=sci_data, header=sci_hdr,
+                                          science_filename=science_file)
+    # get the wave to pixel map for this wave solution (shifted every
+    #   iteration with the doppler factor)
+    with timer.stage('WAVE2PIX'):
+        wave2pix = get_wave2pix_map(wavegrid)
     # loop around orders
     # for order_num in range(sci_data.shape[0]):
     #    # work out the velocity scale
@@ -1106,6 +2145,26 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
     else:
         # for FP files
         sys_rv, ccf_ewidth = 0, 0
+    # -------------------------------------------------------------------------
+    # deal with warm start from the previous file (only if it converged)
+    # -------------------------------------------------------------------------
+    warm_started, warm_ratio = False, False
+    # the blaze and wave solution are identified by their content
+    if inst.params['COMPUTE_WARM_START']:
+        wave_key, blaze_key = array_hash(wavegrid), array_hash(blaze)
+    else:
+        wave_key, blaze_key = None, None
+    # start from the systemic velocity of the previous file
+    if warm_start is not None and not reset_rv:
+        if inst.params['DATA_TYPE'] == 'SCIENCE':
+            sys_rv = warm_start['SYSTEMIC_VELOCITY'] + berv
+        # reuse the low-pass ratio if the blaze and wave solution match
+        warm_ratio = warm_start['WAVE_KEY'] == wave_key
+        warm_ratio &= warm_start['BLAZE_KEY'] == blaze_key
+        warm_started = True
+        # log warm start
+        msg = '\tWarm start: systemic rv + berv={0:.4f} m/s (reuse ratio={1})'
+        log.general(msg.format(-sys_rv, warm_ratio))
 
     # if reset_rv:
     #     # if we are not using calibration file
@@ -1173,12 +2232,8 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
 
     # correction of the model from the low-passed ratio of science to model
     ratio = np.zeros_like(sci_data)
-    # get the splines out of the spline dictionary
-    spline0 = splines['spline0']
-    # spline = splines['spline']
-    dspline = splines['dspline']
-    d2spline = splines['d2spline']
-    d3spline = splines['d3spline']
+    # get the spline mask out of the spline dictionary (the model splines
+    #    spline0, dspline, d2spline, d3spline are evaluated together)
     spline_mask = splines['spline_mask']
     # set up storage for the dv, d2v, d3v and corresponding rms values
     #    fill with NaNs
@@ -1225,111 +2280,82 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
             model_offset = float(model_velocity)
         else:
             model_offset = 0
-        # loop around each order and update model, dmodel, d2model, d3model
-        for order_num in range(sci_data.shape[0]):
-            # flags orders that have <3 lines
-            # do not spend time on this order computing anything
-            if width[order_num] == 0:
-                continue
-            # doppler shifted wave grid for this order
-            shift = -sys_rv - model_offset
-            wave_ord = mp.doppler_shift(wavegrid[order_num], shift)
-            # get the blaze for this order
-            blaze_ord = blaze[order_num]
-            # get the low-frequency component out
-            model_mask = np.ones_like(model[order_num])
-            # add the spline mask values to model_mask (spline mask is 0 or 1)
-            smask = spline_mask(wave_ord) < 0.99
-            # set spline mask splined values to NaN
-            model_mask[smask] = np.nan
-            # RV shift the spline and correct for blaze and add model mask
-            # TODO spline0 or spline depending on the type of filtering and
-            #      normalization
-            model[order_num] = spline0(wave_ord) * blaze_ord * model_mask
-            # we are so close in RV with RV_mean<10*sigma that there is no need
-            # to do the low-pass filtering again
-            if iteration == 0:
-                do_hp = True
-                # nsig_rv_mean = np.inf
+        # doppler shift of the model for this iteration
+        shift = -sys_rv - model_offset
+        # the model splines needed this iteration (d2 and d3 only on the
+        #    last iteration)
+        if flag_last_iter:
+            model_keys = ['spline0', 'dspline', 'd2spline', 'd3spline']
+        else:
+            model_keys = ['spline0', 'dspline']
+        # we are so close in RV with RV_mean<10*sigma that there is no need
+        # to do the low-pass filtering again
+        if iteration == 0:
+            lowpass = True
+            # nsig_rv_mean = np.inf
+            # warm start: the ratio of the previous file scaled to the
+            #    flux of this spectrum (do the low-pass if this fails)
+            if warm_ratio:
+                prev_ratio = warm_start['RATIO']
             else:
-                nsig_rv_mean = np.abs(rv_mean) / bulk_error
-                if nsig_rv_mean > 10:
-                    do_hp = True  # too far from 0, do the high-pass filtering
-                else:
-                    do_hp = False
-
-            if do_hp:
-                part1 = sci_data[order_num]
-                part2 = model[order_num]
-                part2[part2 == 0] = np.nan
-                ratio[order_num] = mp.lowpassfilter(part1 / part2, int(width[order_num]), k=3)
-                if order_num == 0:
-                    log.general('\t\tLow-pass match of model to science ratio')
-
-            model[order_num] *= ratio[order_num]
-
-            # work out the ratio between spectrum and model
-            # amp = get_scaling_ratio(sci_data[order_num], model[order_num])
-            # apply this scaling ratio to the model
-            # model[order_num] = model[order_num] * amp
-
-            # corr_model = mp.lowpassfilter(model[order_num] - sci_data[order_num],
-            #                              width=100)
-            # model[order_num] -= corr_model
-            # if this is the first iteration update model0
-            if iteration == 0:
-                # spline the original template and apply blaze
-                model0[order_num] = spline0(wave_ord) * blaze_ord
-                model0[order_num][model0[order_num] == 0] = np.nan
-                # get the good values for the median
-                valid = np.isfinite(model0[order_num])
-                valid &= np.isfinite(sci_data[order_num])
-
-                # get the median for the model and original spectrum
-                med_model0 = mp.nanmedian(model0[order_num][valid])
-                med_sci_data_0 = mp.nanmedian(sci_data0[order_num][valid])
-                # normalize by the median
-                with warnings.catch_warnings(record=True):
-                    model0[order_num] = model0[order_num] / med_model0
-                # multiply by the median of the original spectrum
-                with warnings.catch_warnings(record=True):
-                    model0[order_num] = model0[order_num] * med_sci_data_0
-            # update the other splines
-            # track ratio if relevant
-            dmodel[order_num] = dspline(wave_ord) * blaze_ord * ratio[order_num]
-            # only do the d2 and d3 stuff if on last iteration
-            if flag_last_iter:
-                d2model_ord = d2spline(wave_ord) * blaze_ord * ratio[order_num]
-                d3model_ord = d3spline(wave_ord) * blaze_ord * ratio[order_num]
-                d2model[order_num] = d2model_ord
-                d3model[order_num] = d3model_ord
-                # deal with residual projection tables if required
-                if resproj_flag:
-                    # loop around residual project tables
-                    for key in inst.params['RESPROJ_TABLES']:
-                        # calculate spline
-                        rp_spline = splines[key](wave_ord)
-                        # The models are always expressed in terms of the
-                        # original spectrum
-                        rblaze = np.nanmedian(sci_data0[order_num] / blaze_ord)
-                        rp_spline *= (blaze_ord * rblaze)
-                        # add to projection model
-                        proj_model[key]['model'][order_num] = rp_spline
+                prev_ratio = None
+        else:
+            nsig_rv_mean = np.abs(rv_mean) / bulk_error
+            # too far from 0, do the high-pass filtering
+            lowpass = nsig_rv_mean > 10
+            prev_ratio = None
+        # loop around each order and update model, dmodel, d2model, d3model
+        #    (orders are independent so they can be done in parallel threads)
+        with timer.stage('MODEL_UPDATE'):
+            build_order = functools.partial(
+                build_model_order, wavegrid=wavegrid, blaze=blaze,
+                splines=splines, spline_mask=spline_mask,
+                model_keys=model_keys, shift=shift, width=width,
+                sci_data=sci_data, model=model, ratio=ratio, lowpass=lowpass,
+                warm_ratio=prev_ratio)
+            bout = base.thread_map(build_order, range(sci_data.shape[0]),
+                                   nthreads)
+            do_hp, wave_ords, template_ords = zip(*bout)
+            # low-pass the science to model ratio of all orders that need it
+            #    in one call (each order has its own width)
+            hp_orders = np.where(do_hp)[0]
+            if len(hp_orders) > 0:
+                with timer.stage('LOWPASS'):
+                    part1 = sci_data[hp_orders]
+                    part2 = model[hp_orders]
+                    ratio[hp_orders] = mp.lowpassfilter_2d(part1 / part2,
+                                                           width[hp_orders],
+                                                           k=3)
+                log.general('\t\tLow-pass match of model to science ratio')
+            finish_order = functools.partial(
+                finish_model_order, wave_ords=wave_ords,
+                template_ords=template_ords, blaze=blaze, width=width,
+                splines=splines, sci_data=sci_data, sci_data0=sci_data0,
+                ratio=ratio, model=model, model0=model0, dmodel=dmodel,
+                d2model=d2model, d3model=d3model, proj_model=proj_model,
+                first_iter=iteration == 0, last_iter=flag_last_iter)
+            base.thread_map(finish_order, range(sci_data.shape[0]), nthreads)
         # ---------------------------------------------------------------------
         # estimate rms
         # ---------------------------------------------------------------------
+        # time the noise model (and sigma clipping)
+        tstart = timer.start()
         # if we are not using a noise model - estimate the noise
         if not use_noise_model:
 
             rms = estimate_noise_model(sci_data, wavegrid, model,
-                                       noise_sampling_width)
-            # work out the number of sigma away from the model
-            nsig = (sci_data - model) / rms
-            # mask for nsigma
-            with warnings.catch_warnings(record=True) as _:
-                sigmask = np.abs(nsig) > rms_sigclip_thres
-            # apply sigma clip to the science data
-            sci_data[sigmask] = np.nan
+                                       noise_sampling_width, nthreads)
+            # apply sigma clip to the science data (compiled)
+            if compute_engine == 'numba':
+                mp.sigma_clip_kernel(sci_data, model, rms, rms_sigclip_thres)
+            else:
+                # work out the number of sigma away from the model
+                nsig = (sci_data - model) / rms
+                # mask for nsigma
+                with warnings.catch_warnings(record=True) as _:
+                    sigmask = np.abs(nsig) > rms_sigclip_thres
+                # apply sigma clip to the science data
+                sci_data[sigmask] = np.nan
         else:
             for order_num in range(sci_data.shape[0]):
                 # work out normalised residual
@@ -1340,6 +2366,7 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
                 # TODO keep track of the stats on 'scale' as it should be 1
                 # TODO for the photon-noise limited case.
                 rms[order_num] *= scale
+        timer.stop('NOISE_MODEL', tstart)
         # ---------------------------------------------------------------------
         # work out dv line-by-line
         # ---------------------------------------------------------------------
@@ -1349,11 +2376,6 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
         current_order = None
         # set these for use/update later
         nwavegrid = mp.doppler_shift(wavegrid, -sys_rv)
-        # get splines between shifted wave grid and pixel grid
-        wave2pixlist = []
-        xpix = np.arange(model.shape[1])
-        for order_num in range(wavegrid.shape[0]):
-            wave2pixlist.append(mp.iuv_spline(nwavegrid[order_num], xpix))
         # ---------------------------------------------------------------------
         # debug plot dictionary for plotting later
         if iteration == 0:
@@ -1373,237 +2395,309 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
             # if SNR of line is less than 3 we don't use it
             ccf_weight[mask_snr < 3] = 0
             # calculate the rough CCF RV estimate
-            sys_model_rv, ewidth_model = rough_ccf_rv(inst, wavegrid, model,
-                                                      wave_mask, ccf_weight,
-                                                      kind='model')
+            with timer.stage('CCF'):
+                sys_model_rv, ewidth_model = rough_ccf_rv(inst, wavegrid,
+                                                          model, wave_mask,
+                                                          ccf_weight,
+                                                          kind='model')
 
             model_velocity = sys_model_rv - sys_rv
             log.general('\tModel velocity {:.2f} m/s'.format(model_velocity))
             # we don't want to continue this run if we have model_velocity
             continue
         # ---------------------------------------------------------------------
-        # loop through all lines
-        for line_it in range(0, len(orders)):
-            # get the order number for this line
-            order_num = orders[line_it]
-            # -----------------------------------------------------------------
-            # if line has been flagged as bad (in all but the first iteration)
-            #   skip this line
-            if (iteration != 1) and not (mask_keep[line_it]):
-                continue
-            # -----------------------------------------------------------------
-            # if this is a new order the get residuals for this order
-            if order_num != current_order:
-                # update current order
-                current_order = int(order_num)
-            # get this orders values
-            ww_ord = nwavegrid[order_num]
-            sci_ord = sci_data[order_num]
-            wave2pix = wave2pixlist[order_num]
-            rms_ord = rms[order_num]
-            model_ord = model[order_num]
-            dmodel_ord = dmodel[order_num]
-            blaze_ord = blaze[order_num]
-            # only do the d2 and d3 stuff if on last iteration
-            if flag_last_iter:
-                d2model_ord = d2model[order_num]
-                d3model_ord = d3model[order_num]
-                # deal with residual projection tables if required
-                if resproj_flag:
-                    # loop around residual project tables
-                    for key in inst.params['RESPROJ_TABLES']:
-                        # add the model for this order
-                        pmodel_ord = proj_model[key]['model'][order_num]
-                        # add to projection_model
-                        proj_model[key]['model_ord'] = pmodel_ord
-            else:
-                d2model_ord = None
-                d3model_ord = None
-            # -----------------------------------------------------------------
-            # get the start and end wavelengths and pixels for this line
-            wave_start = ref_table['WAVE_START'][line_it]
-            wave_end = ref_table['WAVE_END'][line_it]
-            x_start, x_end = wave2pix([wave_start, wave_end])
-            # round pixel positions to nearest pixel
-            x_start, x_end = int(np.floor(x_start)), int(np.floor(x_end))
-            # -----------------------------------------------------------------
-            # boundary conditions
-            if (x_end - x_start) < min_line_width:
-                mask_keep[line_it] = False
-                continue
-            if x_start < 0:
-                mask_keep[line_it] = False
-                continue
-            if x_end > len(ww_ord) - 2:
-                mask_keep[line_it] = False
-                continue
-            # -----------------------------------------------------------------
-            # get weights at the edge of the domain. Pixels inside have a
-            # weight of 1, at the edge, it's proportional to the overlap
-            weight_mask = np.ones(x_end - x_start + 1)
-            # deal with overlapping pixels (before start)
-            if ww_ord[x_start] < wave_start:
-                refdiff = ww_ord[x_start + 1] - wave_start
-                wavediff = ww_ord[x_start + 1] - ww_ord[x_start]
-                weight_mask[0] = 1 - refdiff / wavediff
-            # deal with overlapping pixels (after end)
-            if ww_ord[x_end + 1] > wave_end:
-                refdiff = wave_end - ww_ord[x_end]
-                wavediff = ww_ord[x_end] - ww_ord[x_end - 1]
-                weight_mask[-1] = 1 - (refdiff / wavediff)
-            # get the x pixels
-            xpix = np.arange(x_start, len(weight_mask) + x_start)
-            # get mean xpix and mean blaze for line
-            mean_xpix = mp.nansum(weight_mask * xpix) / mp.nansum(weight_mask)
-            mean_blaze = blaze_ord[(x_start + x_end) // 2]
-            # push mean xpix and mean blaze into ref table
-            ref_table['MEANXPIX'][line_it] = mean_xpix
-            ref_table['MEANBLAZE'][line_it] = mean_blaze
-            # -----------------------------------------------------------------
-            # add to the plots dictionary (for plotting later)
-            if iteration == 1:
-                plot_dict['LINE_ORDERS'] += [order_num]
-                plot_dict['WW_ORD_LINE'] += [ww_ord[x_start:x_end + 1]]
-                plot_dict['SPEC_ORD_LINE'] += [sci_ord[x_start:x_end + 1]]
-                plot_dict['MODEL_ORD_LINE'] += [model_ord[x_start:x_end + 1]]
-            # -----------------------------------------------------------------
-            # derivative of the segment
-            d_seg = dmodel_ord[x_start: x_end + 1] * weight_mask
-
-            # only do the d2 and d3 stuff if on last iteration
-            if flag_last_iter:
-                # keep track of second and third derivatives
-                d2_seg = d2model_ord[x_start: x_end + 1] * weight_mask
-                d3_seg = d3model_ord[x_start: x_end + 1] * weight_mask
-                # deal with residual projection tables if required
-                if resproj_flag:
-                    # loop around residual project tables
-                    for key in inst.params['RESPROJ_TABLES']:
-                        # get model_order projection
-                        pmodel_ord = proj_model[key]['model_ord']
-                        # work out the d_seg for this projection
-                        pd_seg = pmodel_ord[x_start: x_end + 1] * weight_mask
-                        # add to projection_model
-                        proj_model[key]['d_seg'] = pd_seg
-            else:
-                d2_seg, d3_seg = None, None
-            # residual of the segment
-            # TODO -> investigate data type problem
-            # data type should work in the sum below. Does
-            # not happen with SPIRou data
-            sci_seg = sci_ord[x_start:x_end + 1]
-            model_seg = model_ord[x_start:x_end + 1]
-
-            # keep track of the fraction of each lines that is not finite
-            frac_mask = np.isfinite(sci_ord[x_start:x_end + 1])
-            frac_line_valid[line_it] = np.mean(frac_mask)
-
-            # diff_seg = (sci_seg - model_seg) * weight_mask
-            # work out the sum of the weights of the weight mask
-            sum_weight_mask = np.sum(weight_mask)
-
-            # -----------------------------------------------------------------
-            # This is part of the code we had when we had to subtract
-            #   a mean value for each segment as we high-passed
-            #   - no longer used (remove later)
-
-            # denominator = np.nansum(model_seg ** 2 * weight_mask ** 2)
-            # if (sum_weight_mask != 0) and (denominator != 0):
-            #     # subtract off normalized science sum
-            #     # scisum = mp.nansum(sci_seg * weight_mask)
-            #     # sci_seg = sci_seg - (scisum / sum_weight_mask)
-            #     # subtract off normalized model sum
-            #     # modsum = mp.nansum(model_seg * weight_mask)
-            #     #  model_seg = model_seg - (modsum / sum_weight_mask)
-            #     # to be consistent between the spectrum residuals and model
-            #     # d_sum = mp.nansum(d_seg * weight_mask)
-            #
-            #     # TODO --> check if useful at all
-            #     # TODO -> should be an option to subtraction or not the
-            #     # TODO -> mean line flux
-            #     # d_seg = d_seg# - (d_sum / sum_weight_mask)
-            #     # only do the d2 and d3 stuff if on last iteration
-            #     if flag_last_iter:
-            #         # to be consistent between the spectrum residuals and model
-            #         d2_sum = mp.nansum(d2_seg * weight_mask)
-            #         # to be consistent between the spectrum residuals and model
-            #         d3_sum = mp.nansum(d3_seg * weight_mask)
-            #         # deal with residual projection tables if required
-            #         if resproj_flag:
-            #             # loop around residual project tables
-            #             for key in inst.params['RESPROJ_TABLES']:
-            #                 # get the d_seg value
-            #                 d_seg = proj_model[key]['d_seg']
-            #                 # calculate the sum of the d_seg
-            #                 d_sum = mp.nansum(d_seg * weight_mask)
-            #                 # push into the projection model
-            #                 proj_model[key]['d_sum'] = d_sum
-            # -----------------------------------------------------------------
-            # calculate the difference of this segment (weighted by the mask)
-            diff_seg = (sci_seg - model_seg) * weight_mask
-            # work out the sum of the rms
-            sum_rms = np.sum(rms_ord[x_start: x_end + 1] * weight_mask)
-            # work out the mean rms
-            mean_rms = sum_rms / sum_weight_mask
-            # -----------------------------------------------------------------
-            # work out the 1st derivative
-            #    From bouchy 2001 equation, RV error for each pixel
-            # -----------------------------------------------------------------
-            bout = bouchy_equation_line(d_seg, diff_seg, mean_rms)
-            dv[line_it], sdv[line_it] = bout
-
-            if flag_last_iter:
-                # to be consistent between the spectrum residuals and model
+        # time the line-by-line velocities
+        tstart = timer.start()
+        # loop through all lines one at a time (legacy engine)
+        if compute_engine == 'legacy':
+            for line_it in range(0, len(orders)):
+                # get the order number for this line
+                order_num = orders[line_it]
                 # -------------------------------------------------------------
-                # work out the 0th derivative
-                #    From bouchy 2001 equation, RV error for each pixel
+                # if line has been flagged as bad (in all but the first iteration)
+                #   skip this line
+                if (iteration != 1) and not (mask_keep[line_it]):
+                    continue
                 # -------------------------------------------------------------
-                if np.sum(np.isfinite(model_seg)) >= 2:
-                    v1 = np.nanmean(model_seg)
-                    bout = bouchy_equation_line(model_seg - v1, diff_seg,
-                                                mean_rms)
-                    d0v[line_it], sd0v[line_it] = bout
+                # if this is a new order the get residuals for this order
+                if order_num != current_order:
+                    # update current order
+                    current_order = int(order_num)
+                # get this orders values
+                ww_ord = nwavegrid[order_num]
+                sci_ord = sci_data[order_num]
+                rms_ord = rms[order_num]
+                model_ord = model[order_num]
+                dmodel_ord = dmodel[order_num]
+                blaze_ord = blaze[order_num]
+                # only do the d2 and d3 stuff if on last iteration
+                if flag_last_iter:
+                    d2model_ord = d2model[order_num]
+                    d3model_ord = d3model[order_num]
+                    # deal with residual projection tables if required
+                    if resproj_flag:
+                        # loop around residual project tables
+                        for key in inst.params['RESPROJ_TABLES']:
+                            # add the model for this order
+                            pmodel_ord = proj_model[key]['model'][order_num]
+                            # add to projection_model
+                            proj_model[key]['model_ord'] = pmodel_ord
+                else:
+                    d2model_ord = None
+                    d3model_ord = None
                 # -------------------------------------------------------------
-                # work out the 2nd derivative
-                #    From bouchy 2001 equation, RV error for each pixel
+                # get the start and end wavelengths and pixels for this line
+                wave_start = ref_table['WAVE_START'][line_it]
+                wave_end = ref_table['WAVE_END'][line_it]
+                x_start, x_end = wave2pix(order_num, [wave_start, wave_end],
+                                          -sys_rv)
+                # round pixel positions to nearest pixel
+                x_start, x_end = int(np.floor(x_start)), int(np.floor(x_end))
+                # -------------------------------------------------------------
+                # boundary conditions
+                if (x_end - x_start) < min_line_width:
+                    mask_keep[line_it] = False
+                    continue
+                if x_start < 0:
+                    mask_keep[line_it] = False
+                    continue
+                if x_end > len(ww_ord) - 2:
+                    mask_keep[line_it] = False
+                    continue
+                # -------------------------------------------------------------
+                # get weights at the edge of the domain. Pixels inside have a
+                # weight of 1, at the edge, it's proportional to the overlap
+                weight_mask = np.ones(x_end - x_start + 1)
+                # deal with overlapping pixels (before start)
+                if ww_ord[x_start] < wave_start:
+                    refdiff = ww_ord[x_start + 1] - wave_start
+                    wavediff = ww_ord[x_start + 1] - ww_ord[x_start]
+                    weight_mask[0] = 1 - refdiff / wavediff
+                # deal with overlapping pixels (after end)
+                if ww_ord[x_end + 1] > wave_end:
+                    refdiff = wave_end - ww_ord[x_end]
+                    wavediff = ww_ord[x_end] - ww_ord[x_end - 1]
+                    weight_mask[-1] = 1 - (refdiff / wavediff)
+                # get the x pixels
+                xpix = np.arange(x_start, len(weight_mask) + x_start)
+                # get mean xpix and mean blaze for line
+                mean_xpix = mp.nansum(weight_mask * xpix) / mp.nansum(weight_mask)
+                mean_blaze = blaze_ord[(x_start + x_end) // 2]
+                # push mean xpix and mean blaze into ref table
+                ref_table['MEANXPIX'][line_it] = mean_xpix
+                ref_table['MEANBLAZE'][line_it] = mean_blaze
+                # -------------------------------------------------------------
+                # add to the plots dictionary (for plotting later)
+                if iteration == 1:
+                    plot_dict['LINE_ORDERS'] += [order_num]
+                    plot_dict['WW_ORD_LINE'] += [ww_ord[x_start:x_end + 1]]
+                    plot_dict['SPEC_ORD_LINE'] += [sci_ord[x_start:x_end + 1]]
+                    plot_dict['MODEL_ORD_LINE'] += [model_ord[x_start:x_end + 1]]
                 # -------------------------------------------------------------
-                bout = bouchy_equation_line(d2_seg, diff_seg, mean_rms)
-                d2v[line_it], sd2v[line_it] = bout
+                # derivative of the segment
+                d_seg = dmodel_ord[x_start: x_end + 1] * weight_mask
+
+                # only do the d2 and d3 stuff if on last iteration
+                if flag_last_iter:
+                    # keep track of second and third derivatives
+                    d2_seg = d2model_ord[x_start: x_end + 1] * weight_mask
+                    d3_seg = d3model_ord[x_start: x_end + 1] * weight_mask
+                    # deal with residual projection tables if required
+                    if resproj_flag:
+                        # loop around residual project tables
+                        for key in inst.params['RESPROJ_TABLES']:
+                            # get model_order projection
+                            pmodel_ord = proj_model[key]['model_ord']
+                            # work out the d_seg for this projection
+                            pd_seg = pmodel_ord[x_start: x_end + 1] * weight_mask
+                            # add to projection_model
+                            proj_model[key]['d_seg'] = pd_seg
+                else:
+                    d2_seg, d3_seg = None, None
+                # residual of the segment
+                # TODO -> investigate data type problem
+                # data type should work in the sum below. Does
+                # not happen with SPIRou data
+                sci_seg = sci_ord[x_start:x_end + 1]
+                model_seg = model_ord[x_start:x_end + 1]
+
+                # keep track of the fraction of each lines that is not finite
+                frac_mask = np.isfinite(sci_ord[x_start:x_end + 1])
+                frac_line_valid[line_it] = np.mean(frac_mask)
+
+                # diff_seg = (sci_seg - model_seg) * weight_mask
+                # work out the sum of the weights of the weight mask
+                sum_weight_mask = np.sum(weight_mask)
+
                 # -------------------------------------------------------------
-                # work out the 3rd derivative
+                # This is part of the code we had when we had to subtract
+                #   a mean value for each segment as we high-passed
+                #   - no longer used (remove later)
+
+                # denominator = np.nansum(model_seg ** 2 * weight_mask ** 2)
+                # if (sum_weight_mask != 0) and (denominator != 0):
+                #     # subtract off normalized science sum
+                #     # scisum = mp.nansum(sci_seg * weight_mask)
+                #     # sci_seg = sci_seg - (scisum / sum_weight_mask)
+                #     # subtract off normalized model sum
+                #     # modsum = mp.nansum(model_seg * weight_mask)
+                #     #  model_seg = model_seg - (modsum / sum_weight_mask)
+                #     # to be consistent between the spectrum residuals and model
+                #     # d_sum = mp.nansum(d_seg * weight_mask)
+                #
+                #     # TODO --> check if useful at all
+                #     # TODO -> should be an option to subtraction or not the
+                #     # TODO -> mean line flux
+                #     # d_seg = d_seg# - (d_sum / sum_weight_mask)
+                #     # only do the d2 and d3 stuff if on last iteration
+                #     if flag_last_iter:
+                #         # to be consistent between the spectrum residuals and model
+                #         d2_sum = mp.nansum(d2_seg * weight_mask)
+                #         # to be consistent between the spectrum residuals and model
+                #         d3_sum = mp.nansum(d3_seg * weight_mask)
+                #         # deal with residual projection tables if required
+                #         if resproj_flag:
+                #             # loop around residual project tables
+                #             for key in inst.params['RESPROJ_TABLES']:
+                #                 # get the d_seg value
+                #                 d_seg = proj_model[key]['d_seg']
+                #                 # calculate the sum of the d_seg
+                #                 d_sum = mp.nansum(d_seg * weight_mask)
+                #                 # push into the projection model
+                #                 proj_model[key]['d_sum'] = d_sum
+                # -------------------------------------------------------------
+                # calculate the difference of this segment (weighted by the mask)
+                diff_seg = (sci_seg - model_seg) * weight_mask
+                # work out the sum of the rms
+                sum_rms = np.sum(rms_ord[x_start: x_end + 1] * weight_mask)
+                # work out the mean rms
+                mean_rms = sum_rms / sum_weight_mask
+                # -------------------------------------------------------------
+                # work out the 1st derivative
                 #    From bouchy 2001 equation, RV error for each pixel
                 # -------------------------------------------------------------
-                bout = bouchy_equation_line(d3_seg, diff_seg, mean_rms)
-                d3v[line_it], sd3v[line_it] = bout
+                bout = bouchy_equation_line(d_seg, diff_seg, mean_rms)
+                dv[line_it], sdv[line_it] = bout
+
+                if flag_last_iter:
+                    # to be consistent between the spectrum residuals and model
+                    # ---------------------------------------------------------
+                    # work out the 0th derivative
+                    #    From bouchy 2001 equation, RV error for each pixel
+                    # ---------------------------------------------------------
+                    if np.sum(np.isfinite(model_seg)) >= 2:
+                        v1 = np.nanmean(model_seg)
+                        bout = bouchy_equation_line(model_seg - v1, diff_seg,
+                                                    mean_rms)
+                        d0v[line_it], sd0v[line_it] = bout
+                    # ---------------------------------------------------------
+                    # work out the 2nd derivative
+                    #    From bouchy 2001 equation, RV error for each pixel
+                    # ---------------------------------------------------------
+                    bout = bouchy_equation_line(d2_seg, diff_seg, mean_rms)
+                    d2v[line_it], sd2v[line_it] = bout
+                    # ---------------------------------------------------------
+                    # work out the 3rd derivative
+                    #    From bouchy 2001 equation, RV error for each pixel
+                    # ---------------------------------------------------------
+                    bout = bouchy_equation_line(d3_seg, diff_seg, mean_rms)
+                    d3v[line_it], sd3v[line_it] = bout
+                    # deal with residual projection tables if required
+                    if resproj_flag:
+                        # loop around residual project tables
+                        for key in inst.params['RESPROJ_TABLES']:
+                            # get d_seg
+                            pd_seg = proj_model[key]['d_seg']
+                            # calculate the bouchy equation
+                            pbout = bouchy_equation_line(pd_seg, diff_seg, mean_rms)
+                            # push into the projection model
+                            pd_key, psd_key = pbout
+                            if np.isfinite(pd_key) and np.isfinite(psd_key):
+                                # only update if both finite
+                                proj_model[key]['proj'][line_it] = pd_key
+                                proj_model[key]['sproj'][line_it] = psd_key
+
+                # only add stuff to the ref_table if on last iteration
+                if flag_last_iter:
+                    # ---------------------------------------------------------
+                    # ratio of expected VS actual RMS in difference of model vs line
+                    ref_table['RMSRATIO'][line_it] = mp.nanstd(diff_seg) / mean_rms
+                    # effective number of pixels in line
+                    ref_table['NPIXLINE'][line_it] = len(diff_seg)
+                    # Considering the number of pixels, expected and actual RMS, this
+                    #   is the likelihood that the line is actually valid from chi2
+                    #   point of view
+                    ref_table['CHI2'][line_it] = mp.nansum((diff_seg / mean_rms) ** 2)
+        # compute all lines at once (numpy or numba engine)
+        else:
+            # get the pixel span of all lines (updates mask_keep)
+            with timer.stage('WAVE2PIX'):
+                spans = get_line_spans(ref_table, nwavegrid, wave2pix,
+                                       -sys_rv, mask_keep, iteration,
+                                       min_line_width,
+                                       flatten=compute_engine == 'numpy')
+            # only give the last iteration models if on the last iteration
+            if flag_last_iter and resproj_flag:
+                proj_models = dict()
+                for key in inst.params['RESPROJ_TABLES']:
+                    proj_models[key] = proj_model[key]['model']
+            else:
+                proj_models = None
+            # compute the line-by-line velocities for all lines
+            if compute_engine == 'numba':
+                lout = compute_line_rvs_numba(spans, nwavegrid, sci_data,
+                                              model, dmodel, rms, blaze,
+                                              d2model, d3model,
+                                              proj_models=proj_models,
+                                              last_iter=flag_last_iter)
+            else:
+                lout = compute_line_rvs(spans, sci_data, model, dmodel, rms,
+                                        blaze, d2model=d2model,
+                                        d3model=d3model,
+                                        proj_models=proj_models,
+                                        last_iter=flag_last_iter)
+            # push the per-line values into the storage arrays
+            lines = spans['LINES']
+            if len(lines) > 0:
+                ref_table['MEANXPIX'][lines] = lout['MEANXPIX']
+                ref_table['MEANBLAZE'][lines] = lout['MEANBLAZE']
+                frac_line_valid[lines] = lout['FRAC_LINE_VALID']
+                dv[lines], sdv[lines] = lout['DV'], lout['SDV']
+            # add to the plots dictionary (for plotting later)
+            if iteration == 1:
+                for it in range(len(lines)):
+                    order_num = spans['ORDER'][it]
+                    pslice = slice(spans['X_START'][it], spans['X_END'][it] + 1)
+                    plot_dict['LINE_ORDERS'] += [order_num]
+                    plot_dict['WW_ORD_LINE'] += [nwavegrid[order_num][pslice]]
+                    plot_dict['SPEC_ORD_LINE'] += [sci_data[order_num][pslice]]
+                    plot_dict['MODEL_ORD_LINE'] += [model[order_num][pslice]]
+            # only add stuff to the ref_table if on last iteration
+            if flag_last_iter and len(lines) > 0:
+                # the 0th derivative needs at least 2 finite model values
+                d0_lines = lines[lout['D0V_VALID']]
+                d0v[d0_lines] = lout['D0V'][lout['D0V_VALID']]
+                sd0v[d0_lines] = lout['SD0V'][lout['D0V_VALID']]
+                # the 2nd and 3rd derivatives
+                d2v[lines], sd2v[lines] = lout['D2V'], lout['SD2V']
+                d3v[lines], sd3v[lines] = lout['D3V'], lout['SD3V']
                 # deal with residual projection tables if required
                 if resproj_flag:
-                    # loop around residual project tables
                     for key in inst.params['RESPROJ_TABLES']:
-                        # get d_seg
-                        pd_seg = proj_model[key]['d_seg']
-                        # calculate the bouchy equation
-                        pbout = bouchy_equation_line(pd_seg, diff_seg, mean_rms)
-                        # push into the projection model
-                        pd_key, psd_key = pbout
-                        if np.isfinite(pd_key) and np.isfinite(psd_key):
-                            # only update if both finite
-                            proj_model[key]['proj'][line_it] = pd_key
-                            proj_model[key]['sproj'][line_it] = psd_key
-
-            # only add stuff to the ref_table if on last iteration
-            if flag_last_iter:
-                # -----------------------------------------------------------------
-                # ratio of expected VS actual RMS in difference of model vs line
-                ref_table['RMSRATIO'][line_it] = mp.nanstd(diff_seg) / mean_rms
-                # effective number of pixels in line
-                ref_table['NPIXLINE'][line_it] = len(diff_seg)
-                # Considering the number of pixels, expected and actual RMS, this
-                #   is the likelihood that the line is actually valid from chi2
-                #   point of view
-                ref_table['CHI2'][line_it] = mp.nansum((diff_seg / mean_rms) ** 2)
+                        pd_key, psd_key = lout['PROJ'][key]
+                        # only update if both finite
+                        good = np.isfinite(pd_key) & np.isfinite(psd_key)
+                        proj_model[key]['proj'][lines[good]] = pd_key[good]
+                        proj_model[key]['sproj'][lines[good]] = psd_key[good]
+                # line statistics
+                ref_table['RMSRATIO'][lines] = lout['RMSRATIO']
+                ref_table['NPIXLINE'][lines] = lout['NPIXLINE']
+                ref_table['CHI2'][lines] = lout['CHI2']
+        timer.stop('LINE_LOOP', tstart)
         # ---------------------------------------------------------------------
         # get the best etimate of the velocity and update sline
-        rv_mean, bulk_error = mp.odd_ratio_mean(dv, sdv)
+        with timer.stage('ODD_RATIO_MEAN'):
+            rv_mean, bulk_error = mp.odd_ratio_mean(dv, sdv)
 
         # update rv_mean value with the response curve from template.
         #    An rv_mean value is always under-estimated in absolute value but
@@ -1725,6 +2819,16 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
     outputs['HP_WIDTH'] = hp_width
     outputs['TOTAL_DURATION'] = total_time
     outputs['MODEL_VELOCITY'] = model_velocity
+    outputs['STAGE_TIMINGS'] = timer.as_dict()
+    outputs['WARM_STARTED'] = warm_started
+    outputs['WARM_START_FAILED'] = False
+    # the warm start for the next file (only if this file converged)
+    if inst.params['COMPUTE_WARM_START'] and not reset_rv:
+        outputs['WARM_START'] = dict(SYSTEMIC_VELOCITY=sys_rv - berv,
+                                     RATIO=np.array(ratio),
+                                     WAVE_KEY=wave_key, BLAZE_KEY=blaze_key)
+    else:
+        outputs['WARM_START'] = None
     # -------------------------------------------------------------------------
     # return reference table and outputs
     return ref_table, outputs
@@ -1756,6 +2860,134 @@ def smart_timing(durations: List[float], left: int) -> Tuple[float, float, str]:
     return mean_time, std_time, time_left
 
 
+def write_stage_timings(filename: str, science_file: str,
+                        outputs: Dict[str, Any]):
+    """
+    Append the compute rv stage timings of one science file to a JSON-lines
+    file (one record per science file)
+
+    :param filename: str, the JSON-lines file to append to
+    :param science_file: str, the science file the timings are for
+    :param outputs: dict, the outputs of compute_rv
+
+    :return: None, appends to filename
+    """
+    # construct the record
+    record = dict(SCIENCE_FILE=os.path.basename(science_file),
+                  NUM_ITERATIONS=int(outputs['NUM_ITERATIONS']),
+                  TOTAL_DURATION=float(outputs['TOTAL_DURATION']),
+                  STAGES=outputs['STAGE_TIMINGS'])
+    # append to the file (a single write per record so records written by
+    #    parallel workers are not mixed)
+    with open(filename, 'a') as jfile:
+        jfile.write(json.dumps(record) + '\n')
+
+
+def log_stage_timings(timings: List[Dict[str, float]],
+                      durations: List[float]):
+    """
+    Log a summary table of the compute rv stage timings of all files. The
+    stages are exclusive (see StageTimer) and the time outside any stage is
+    reported as OTHER, so the fractions add up to 1
+
+    :param timings: list of dicts, the stage timings of each file
+                    (outputs['STAGE_TIMINGS'] of compute_rv)
+    :param durations: list of floats, the total duration of each file
+
+    :return: None, logs the table
+    """
+    # deal with no timings
+    if len(timings) == 0:
+        return
+    # get the total time over all files
+    total = np.sum(durations)
+    # get all stages (in the order they were first timed)
+    stages = []
+    for timing in timings:
+        stages += [stage for stage in timing if stage not in stages]
+    # log the table
+    log.info('Compute RV stage timings ({0} files)'.format(len(timings)))
+    msg = '\t{0:16s} {1:>10s} {2:>12s} {3:>8s}'
+    log.info(msg.format('STAGE', 'TOTAL[s]', 'PER FILE[s]', 'FRAC'))
+    msg = '\t{0:16s} {1:10.2f} {2:12.4f} {3:8.3f}'
+    timed = 0.0
+    for stage in stages:
+        stage_total = np.sum([timing.get(stage, 0.0) for timing in timings])
+        timed += stage_total
+        margs = [stage, stage_total, stage_total / len(timings),
+                 stage_total / total]
+        log.info(msg.format(*margs))
+    # the time outside any stage
+    other = total - timed
+    margs = ['OTHER', other, other / len(timings), other / total]
+    log.info(msg.format(*margs))
+    margs = ['TOTAL', total, total / len(timings), 1.0]
+    log.info(msg.format(*margs))
+
+
+def add_failed_warm_start(outputs: Dict[str, Any],
+                          warm_outputs: Dict[str, Any]):
+    """
+    Add the cost of a failed warm start (one that did not converge) to the
+    outputs of the cold start that replaced it, so the iterations and time
+    spent on the warm start are not lost
+
+    :param outputs: dict, the outputs of the cold start compute rv (updated
+                    in place)
+    :param warm_outputs: dict, the outputs of the failed warm start
+
+    :return: None, updates outputs in place
+    """
+    # flag that this file was recomputed after a failed warm start
+    outputs['WARM_START_FAILED'] = True
+    # add the iterations and time of the failed warm start
+    outputs['NUM_ITERATIONS'] += warm_outputs['NUM_ITERATIONS']
+    outputs['TOTAL_DURATION'] += warm_outputs['TOTAL_DURATION']
+    # add the stage timings of the failed warm start
+    timings = dict(outputs['STAGE_TIMINGS'])
+    for stage, value in warm_outputs['STAGE_TIMINGS'].items():
+        timings[stage] = timings.get(stage, 0.0) + value
+    outputs['STAGE_TIMINGS'] = timings
+
+
+def log_warm_start(stats: List[Dict[str, Any]]):
+    """
+    Log how many compute rv iterations the warm start saved (compared to the
+    mean number of iterations of the files that were not warm started).
+    Files where the warm start failed count as warm started files (with the
+    iterations of both the failed warm start and the cold start)
+
+    :param stats: list of dicts, for each file the number of iterations
+                  (NUM_ITERATIONS), whether it was warm started
+                  (WARM_STARTED) and whether the warm start failed
+                  (WARM_START_FAILED)
+
+    :return: None, logs the summary
+    """
+    # get the number of iterations for warm and cold started files
+    warm, cold, failed = [], [], 0
+    for fstats in stats:
+        if fstats['WARM_STARTED'] or fstats['WARM_START_FAILED']:
+            warm.append(fstats['NUM_ITERATIONS'])
+        else:
+            cold.append(fstats['NUM_ITERATIONS'])
+        # count the failed warm starts
+        if fstats['WARM_START_FAILED']:
+            failed += 1
+    # log the number of files warm started (and the number that failed)
+    msg = 'Warm start used for {0}/{1} files ({2} failed and were recomputed'
+    msg += ' from a cold start)'
+    log.info(msg.format(len(warm), len(stats), failed))
+    # we need both to estimate the iterations saved
+    if len(warm) == 0 or len(cold) == 0:
+        return
+    # log the mean number of iterations and the iterations saved
+    saved = len(warm) * (np.mean(cold) - np.mean(warm))
+    msg = ('\tMean iterations: warm={0:.2f} cold={1:.2f} '
+           '(~{2:.0f} iterations saved)')
+    log.info(msg.format(np.mean(warm), np.mean(cold), saved))
+
+
 # =============================================================================
 # Define compil functions
 # =============================================================================
@@ -1895,6 +3127,8 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
     d2v_arr, sd2v_arr = np.zeros([nby, nbx]), np.zeros([nby, nbx])
     d3v_arr, sd3v_arr = np.zeros([nby, nbx]), np.zeros([nby, nbx])
     contrast_arr, scontrast_arr = np.zeros([nby, nbx]), np.zeros([nby, nbx])
+    # set up the calibration rv and dvrms (only used for calibrations)
+    cal_arr, scal_arr = np.zeros([nby, nbx]), np.zeros([nby, nbx])
 
     # projection model for the rdb_dict
     proj_model = dict()
@@ -1974,13 +3208,8 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
             sdv_arr[row] = rvtable[good]['sdv']
         # else we calculate it using odd ratio mean
         else:
-            cal_rv = np.array(rvtable[good]['dv'], dtype=float)
-            cal_dvrms = np.array(rvtable[good]['sdv'], dtype=float)
-            # estimate using odd ratio mean
-            cal_guess, cal_bulk_error = mp.odd_ratio_mean(cal_rv, cal_dvrms)
-            # push into rdb_dict
-            rdb_dict['vrad'][row] = cal_guess
-            rdb_dict['svrad'][row] = cal_bulk_error
+            cal_arr[row] = np.array(rvtable[good]['dv'], dtype=float)
+            scal_arr[row] = np.array(rvtable[good]['sdv'], dtype=float)
         # deal with residual projection tables
         if resproj_flag:
             # loop around keys in residual projection tables
@@ -1996,11 +3225,9 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
                 arr = np.array(rvtable[good][key], dtype=float)
                 # copy the rvtable error array for this residual projection
                 sarr = np.array(rvtable[good]['s' + key], dtype=float)
-                # get the guess and bulk error
-                val_guess, val_bulk_error = mp.odd_ratio_mean(arr, sarr)
-                # push into the rdb dictioanry
-                rdb_dict[key][row] = val_guess
-                rdb_dict['s' + key][row] = val_bulk_error
+                # push into the projection arrays
+                proj_model[key]['proj_arr'][row] = arr
+                proj_model[key]['sproj_arr'][row] = sarr
         # get the d2v, sd2v, d3v and sd3v values from table
         wave_vec = np.array(rvtable[good]['WAVE_START'], dtype=float)
         contrast = np.array(rvtable[good]['contrast'], dtype=float)
@@ -2014,23 +3241,6 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
         d2v_arr[row], sd2v_arr[row] = d2v, sd2v
         d3v_arr[row], sd3v_arr[row] = d3v, sd3v
         contrast_arr[row], scontrast_arr[row] = contrast, scontrast
-        # use the odd mean ratio to calculate d2v and sd2v
-        contrast_guess, contrast_bulk_error = mp.odd_ratio_mean(contrast,
-                                                                scontrast)
-        # push into rdb_dict
-        rdb_dict['contrast'][row] = contrast_guess
-        rdb_dict['sig_contrast'][row] = contrast_bulk_error
-
-        # use the odd mean ratio to calculate d2v and sd2v
-        d2v_guess, d2v_bulk_error = mp.odd_ratio_mean(d2v, sd2v)
-        # push into rdb_dict
-        rdb_dict['d2v'][row] = d2v_guess
-        rdb_dict['sd2v'][row] = d2v_bulk_error
-        # use the odd mean ratio to calculate d3v and sd3v
-        d3v_guess, d3v_bulk_error = mp.odd_ratio_mean(d3v, sd3v)
-        # push into rdb_dict
-        rdb_dict['d3v'][row] = d3v_guess
-        rdb_dict['sd3v'][row] = d3v_bulk_error
         # ---------------------------------------------------------------------
         # if we don't have a calibration add plot values
         if not flag_calib:
@@ -2080,6 +3290,31 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
             pdf_all.append(pdf)
             pdf_fit_all.append(pdf_fit)
     # -------------------------------------------------------------------------
+    # odd ratio means of all files at once
+    # -------------------------------------------------------------------------
+    # if we have a calibration we use the odd ratio mean for vrad and svrad
+    if flag_calib:
+        cal_out = mp.odd_ratio_mean_nd(cal_arr, scal_arr, axis=1)
+        rdb_dict['vrad'][:], rdb_dict['svrad'][:] = cal_out
+    # deal with residual projection tables
+    if resproj_flag:
+        # loop around keys in residual projection tables
+        for key in inst.params['RESPROJ_TABLES']:
+            # get the guess and bulk error
+            val_out = mp.odd_ratio_mean_nd(proj_model[key]['proj_arr'],
+                                           proj_model[key]['sproj_arr'], axis=1)
+            # push into the rdb dictionary
+            rdb_dict[key][:], rdb_dict['s' + key][:] = val_out
+    # use the odd mean ratio to calculate contrast and sig_contrast
+    contrast_out = mp.odd_ratio_mean_nd(contrast_arr, scontrast_arr, axis=1)
+    rdb_dict['contrast'][:], rdb_dict['sig_contrast'][:] = contrast_out
+    # use the odd mean ratio to calculate d2v and sd2v
+    d2v_out = mp.odd_ratio_mean_nd(d2v_arr, sd2v_arr, axis=1)
+    rdb_dict['d2v'][:], rdb_dict['sd2v'][:] = d2v_out
+    # use the odd mean ratio to calculate d3v and sd3v
+    d3v_out = mp.odd_ratio_mean_nd(d3v_arr, sd3v_arr, axis=1)
+    rdb_dict['d3v'][:], rdb_dict['sd3v'][:] = d3v_out
+    # -------------------------------------------------------------------------
     # display missing keys
     if len(missing_keys) > 0:
         wmsg = ('The following header keys were not present in some files. '
@@ -2109,13 +3344,10 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
         # log progress
         msg = 'Constructing a per-epoch mean velocity'
         log.general(msg)
-        # loop around files and generate a first guess for vrad and svrad
-        for file_it in tqdm(range(dv_arr.shape[0])):
-            # use the odd ratio mean to guess vrad and svrad
-            orout1 = mp.odd_ratio_mean(dv_arr[file_it], sdv_arr[file_it])
-            # add to output table
-            rdb_dict['vrad'][file_it] = orout1[0]
-            rdb_dict['svrad'][file_it] = orout1[1]
+        # use the odd ratio mean to guess vrad and svrad (all files at once)
+        orout1 = mp.odd_ratio_mean_nd(dv_arr, sdv_arr, axis=1)
+        # add to output table
+        rdb_dict['vrad'][:], rdb_dict['svrad'][:] = orout1
         # ---------------------------------------------------------------------
         # Model per epoch
         # ---------------------------------------------------------------------
@@ -2149,6 +3381,9 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
         # p=1e-4 value, we would reject 1 or 2 lines for a typical
         # target in the absence of a True correlation.
         prob_pearsonr = np.zeros(len(per_line_mean))
+        # flag the lines that need an odd ratio mean (done for all lines at
+        #    once after the loop)
+        odd_lines = np.zeros(len(per_line_mean), dtype=bool)
         # compute the per-line bias
         for line_it in tqdm(range(len(per_line_mean))):
             # We should have a threshold in the fraction of 'valid' times the
@@ -2191,22 +3426,24 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
                 per_line_mean[line_it] = np.nan
                 per_line_error[line_it] = np.nan
                 continue
-            # get the difference and error for each line
-            with warnings.catch_warnings(record=True) as _:
-                diff1 = dv_arr[:, line_it] - np.nanmedian(dv_arr[:, line_it])
-            # here we avoid having a shallow copy
-            err1 = np.array(sdv_arr[:, line_it])
-            # try to guess the odd ratio mean
-            # noinspection PyBroadException
-            try:
-                # also updates dvrms[:,line_it]
-                guess2, bulk_error2 = mp.odd_ratio_mean(diff1, err1)
-                per_line_mean[line_it] = guess2
-                per_line_error[line_it] = bulk_error2
-            # if odd ratio mean fails push NaNs into arrays
-            except Exception as _:
-                per_line_mean[line_it] = np.nan
-                per_line_error[line_it] = np.nan
+            # flag this line for the odd ratio mean
+            odd_lines[line_it] = True
+        # get the difference and error for each flagged line
+        lines = np.where(odd_lines)[0]
+        with warnings.catch_warnings(record=True) as _:
+            diff1 = dv_arr[:, lines] - np.nanmedian(dv_arr[:, lines], axis=0)
+        # here we avoid having a shallow copy
+        err1 = np.array(sdv_arr[:, lines])
+        # try to guess the odd ratio mean (of each line)
+        # noinspection PyBroadException
+        try:
+            guess2, bulk_error2 = mp.odd_ratio_mean_nd(diff1, err1, axis=0)
+            per_line_mean[lines] = guess2
+            per_line_error[lines] = bulk_error2
+        # if odd ratio mean fails push NaNs into arrays
+        except Exception as _:
+            per_line_mean[lines] = np.nan
+            per_line_error[lines] = np.nan
 
         # normalize the per-line mean to zero
         guess3, bulk_error3 = mp.odd_ratio_mean(per_line_mean, per_line_error)
@@ -2239,6 +3476,15 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
     log.info('Computing chromatic slope and per-bandpass statistics')
     # zero filled array
     lblrv_zeros = np.zeros_like(lblrvfiles, dtype=float)
+    # storage for the residuals and dvrms of each file (for the per-band
+    #    per region RV measurements)
+    tmp_rv_arr, tmp_err_arr = np.zeros([nby, nbx]), np.zeros([nby, nbx])
+    # recompute the guess at the vrad / svrad from the residuals of the rvs to
+    #    the rv per line model (all files at once)
+    if not flag_calib:
+        orout4 = mp.odd_ratio_mean_nd(dv_arr - rv_per_line_model, sdv_arr,
+                                      axis=1)
+        rdb_dict['vrad'][:], rdb_dict['svrad'][:] = orout4
     # ---------------------------------------------------------------------
     # Update table with vrad/svrad, per epoch values and fwhm/sig_fwhm
     # ---------------------------------------------------------------------
@@ -2256,10 +3502,6 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
             rvs_row = dv_arr[row]
             residuals = dv_arr[row] - rv_per_line_model[row]
             err = sdv_arr[row]
-            # recompute the guess at the vrad / svrad
-            guess4, bulk_error4 = mp.odd_ratio_mean(residuals, err)
-            rdb_dict['vrad'][row] = guess4
-            rdb_dict['svrad'][row] = bulk_error4
 
         # ---------------------------------------------------------------------
         # fit a slope to the rv
@@ -2372,104 +3614,100 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
         rdb_dict['svrad_chromatic_slope'][row] = sig_chromatic_slope
 
         # ---------------------------------------------------------------------
-        # Per-band per region RV measurements
-        # ---------------------------------------------------------------------
-        # get the instrument specific binned parameters
-        binned_dict = inst.get_binned_parameters()
-        binned_dict = inst.get_uniform_binned_parameters(binned_dict)
-        # get info from binned dictionary
-        bands = binned_dict['bands']
-        blue_end = binned_dict['blue_end']
-        red_end = binned_dict['red_end']
-        region_names = binned_dict['region_names']
-        region_low = binned_dict['region_low']
-        region_high = binned_dict['region_high']
-        use_regions = binned_dict['use_regions']
-        # get the shape of the binned parameters
-        # bshape = (len(lblrvfiles), len(bands), len(region_names))
-        # make a rv and error matrix based on these binned params
-        # rvs_matrix = np.full(bshape, np.nan)
-        # err_matrix = np.full(bshape, np.nan)
-        # loop around files
-        # for row in range(len(lblrvfiles)):
-        # get the residuals and dvrms for this rv file
+        # get the residuals and dvrms for this rv file (for the per-band per
+        #    region RV measurements)
         if flag_calib:
             # rvs[row] - rv_per_line_model[row]
-            tmp_rv = np.array(rvs_row, dtype=float)
+            tmp_rv_arr[row] = np.array(rvs_row, dtype=float)
             # dvrms[row]
-            tmp_err = np.array(err, dtype=float)
+            tmp_err_arr[row] = np.array(err, dtype=float)
         else:
-            tmp_rv = dv_arr[row] - rv_per_line_model[row]
-            tmp_err = sdv_arr[row]
-        # ---------------------------------------------------------------------
-        # populate columns with zeros (if not present)
-        # ---------------------------------------------------------------------
-        # loop around the bands
-        for iband in range(len(bands)):
-            # decide whether to use regions
-            if use_regions[iband]:
-                band_regions = list(region_names)
-            # if not use just the full domain
-            else:
-                band_regions = ['']
-            # loop around the regions
-            for iregion in range(len(band_regions)):
-                cargs = [bands[iband], band_regions[iregion]]
-                vrad_colname = 'vrad_{0}{1}'.format(*cargs)
-                svrad_colname = 'svrad_{0}{1}'.format(*cargs)
-                # add new column if not present
-                if vrad_colname not in rdb_dict:
-                    rdb_dict[vrad_colname] = lblrv_zeros.copy()
-                if svrad_colname not in rdb_dict:
-                    rdb_dict[svrad_colname] = lblrv_zeros.copy()
-        # ---------------------------------------------------------------------
-        # loop around the bands
-        for iband in range(len(bands)):
-            # make a mask based on the band (can use rvtable0 as wave start
-            #   is the same for all rvtables)
-            band_mask = rvtable0['WAVE_START'] > blue_end[iband]
-            band_mask &= rvtable0['WAVE_START'] < red_end[iband]
-            # decide whether to use regions
-            if use_regions[iband]:
-                band_regions = list(region_names)
-                band_region_low = list(region_low)
-                band_region_high = list(region_high)
-            # if not use just the full domain
-            else:
-                band_regions = ['']
-                band_region_low = [-np.inf]
-                band_region_high = [np.inf]
-            # loop around the regions
-            for iregion in range(len(band_regions)):
-                # mask based on region
-                region_mask = rvtable0['XPIX'] > band_region_low[iregion]
-                region_mask &= rvtable0['XPIX'] < band_region_high[iregion]
-                # -------------------------------------------------------------
-                # get combined mask for band and region
-                comb_mask = band_mask & region_mask
-                # -------------------------------------------------------------
-                # get the finite points
-                finite_mask = np.isfinite(tmp_err[comb_mask])
-                finite_mask &= np.isfinite(tmp_rv[comb_mask])
-                # deal with not having enough values (half of total being
-                #    non finite)
-                if np.sum(finite_mask) < np.sum(comb_mask) / 10:
-                    continue
-                # deal with not having enough points in general (min = 5)
-                if np.sum(comb_mask) < 5:
-                    continue
-                # -------------------------------------------------------------
-                # make a guess on the vrad and svrad via odd ratio mean
-                guess7, bulk_error7 = mp.odd_ratio_mean(tmp_rv[comb_mask],
-                                                        tmp_err[comb_mask])
-                # -------------------------------------------------------------
-                # get column names to add these bands/regions
-                cargs = [bands[iband], band_regions[iregion]]
-                vrad_colname = 'vrad_{0}{1}'.format(*cargs)
-                svrad_colname = 'svrad_{0}{1}'.format(*cargs)
-                # add to rdb_dict
-                rdb_dict[vrad_colname][row] = guess7
-                rdb_dict[svrad_colname][row] = bulk_error7
+            tmp_rv_arr[row] = dv_arr[row] - rv_per_line_model[row]
+            tmp_err_arr[row] = sdv_arr[row]
+    # ---------------------------------------------------------------------
+    # Per-band per region RV measurements
+    # ---------------------------------------------------------------------
+    # get the instrument specific binned parameters
+    binned_dict = inst.get_binned_parameters()
+    binned_dict = inst.get_uniform_binned_parameters(binned_dict)
+    # get info from binned dictionary
+    bands = binned_dict['bands']
+    blue_end = binned_dict['blue_end']
+    red_end = binned_dict['red_end']
+    region_names = binned_dict['region_names']
+    region_low = binned_dict['region_low']
+    region_high = binned_dict['region_high']
+    use_regions = binned_dict['use_regions']
+    # ---------------------------------------------------------------------
+    # populate columns with zeros (if not present)
+    # ---------------------------------------------------------------------
+    # loop around the bands
+    for iband in range(len(bands)):
+        # decide whether to use regions
+        if use_regions[iband]:
+            band_regions = list(region_names)
+        # if not use just the full domain
+        else:
+            band_regions = ['']
+        # loop around the regions
+        for iregion in range(len(band_regions)):
+            cargs = [bands[iband], band_regions[iregion]]
+            vrad_colname = 'vrad_{0}{1}'.format(*cargs)
+            svrad_colname = 'svrad_{0}{1}'.format(*cargs)
+            # add new column if not present
+            if vrad_colname not in rdb_dict:
+                rdb_dict[vrad_colname] = lblrv_zeros.copy()
+            if svrad_colname not in rdb_dict:
+                rdb_dict[svrad_colname] = lblrv_zeros.copy()
+    # ---------------------------------------------------------------------
+    # loop around the bands
+    for iband in range(len(bands)):
+        # make a mask based on the band (can use rvtable0 as wave start
+        #   is the same for all rvtables)
+        band_mask = rvtable0['WAVE_START'] > blue_end[iband]
+        band_mask &= rvtable0['WAVE_START'] < red_end[iband]
+        # decide whether to use regions
+        if use_regions[iband]:
+            band_regions = list(region_names)
+            band_region_low = list(region_low)
+            band_region_high = list(region_high)
+        # if not use just the full domain
+        else:
+            band_regions = ['']
+            band_region_low = [-np.inf]
+            band_region_high = [np.inf]
+        # loop around the regions
+        for iregion in range(len(band_regions)):
+            # mask based on region
+            region_mask = rvtable0['XPIX'] > band_region_low[iregion]
+            region_mask &= rvtable0['XPIX'] < band_region_high[iregion]
+            # -------------------------------------------------------------
+            # get combined mask for band and region
+            comb_mask = np.array(band_mask & region_mask)
+            # deal with not having enough points in general (min = 5)
+            if np.sum(comb_mask) < 5:
+                continue
+            # -------------------------------------------------------------
+            # get the band / region values for all files
+            tmp_rv = tmp_rv_arr[:, comb_mask]
+            tmp_err = tmp_err_arr[:, comb_mask]
+            # get the finite points
+            finite_mask = np.isfinite(tmp_err) & np.isfinite(tmp_rv)
+            # deal with not having enough values (half of total being
+            #    non finite) - these files are not updated
+            rows = np.sum(finite_mask, axis=1) >= np.sum(comb_mask) / 10
+            # -------------------------------------------------------------
+            # make a guess on the vrad and svrad via odd ratio mean
+            guess7, bulk_error7 = mp.odd_ratio_mean_nd(tmp_rv[rows],
+                                                       tmp_err[rows], axis=1)
+            # -------------------------------------------------------------
+            # get column names to add these bands/regions
+            cargs = [bands[iband], band_regions[iregion]]
+            vrad_colname = 'vrad_{0}{1}'.format(*cargs)
+            svrad_colname = 'svrad_{0}{1}'.format(*cargs)
+            # add to rdb_dict
+            rdb_dict[vrad_colname][rows] = guess7
+            rdb_dict[svrad_colname][rows] = bulk_error7
     # ---------------------------------------------------------------------
     # convert rdb_dict to table
     # ---------------------------------------------------------------------
@@ -2522,14 +3760,19 @@ def make_rdb_table2(inst: InstrumentsType, rdb_table: Table) -> Table:
     # -------------------------------------------------------------------------
     # log progress
     log.info('Producing LBL RDB 2 table')
+    # sort the observations into epochs (once)
+    uepochs, epoch_order, epoch_bounds = mp.group_index(epoch_values)
+    epoch_rows = dict()
+    for it, uepoch in enumerate(uepochs):
+        epoch_rows[uepoch] = epoch_order[epoch_bounds[it]:epoch_bounds[it + 1]]
     # loop around unique dates
     for idate in tqdm(range(len(epoch_groups))):
         # get the date of this iteration
         epoch = epoch_groups[idate]
         # find all observations for this date
-        epoch_mask = epoch_values == epoch
+        rows = epoch_rows.get(epoch, np.array([], dtype=int))
         # get masked table for this epoch (only rows for this epoch)
-        itable = rdb_table[epoch_mask]
+        itable = rdb_table[rows]
         # loop around all keys in rdb_table and populate rdb_dict
         for colname in rdb_table.colnames:
             # -----------------------------------------------------------------
@@ -2940,8 +4183,6 @@ def find_mask_lines(inst: InstrumentsType, template_table: Table) -> Table:
     :param template_table:
     :return:
     """
-    # get tqdm
-    tqdm = base.tqdm_module(inst.params['USE_TQDM'], log.console_verbosity)
     # get the wave and flux vectors for the tempalte
     t_wave = np.array(template_table['wavelength'])
     t_flux = np.array(template_table['flux'])
@@ -2951,12 +4192,12 @@ def find_mask_lines(inst: InstrumentsType, template_table: Table) -> Table:
         t_snr[np.isinf(t_snr)] = np.nan
     # -------------------------------------------------------------------------
     # smooth the spectrum to avoid lines that coincide with small-scale noise
-    #   excursion
-    t_flux_tmp = np.zeros_like(t_flux)
-    for offset in range(-2, 3):
-        t_flux_tmp += np.roll(t_flux, offset)
-    # copy over original vector
-    t_flux = np.array(t_flux_tmp)
+    #   excursion (a 5 pixel box sum, wrapping around the edges). The sum
+    #   is done over a sliding window in the order of the original sum of
+    #   rolled vectors so the result is the same
+    t_flux_wrap = np.concatenate([t_flux[-2:], t_flux, t_flux[:2]])
+    windows = np.lib.stride_tricks.sliding_window_view(t_flux_wrap, 5)
+    t_flux = windows[:, ::-1].sum(axis=1)
     # -------------------------------------------------------------------------
     # find the first and second derivative of the flux
     dflux = np.gradient(t_flux)
@@ -2993,22 +4234,16 @@ def find_mask_lines(inst: InstrumentsType, template_table: Table) -> Table:
     # -------------------------------------------------------------------------
     # print progress
     log.general('Finding mask lines')
-    # loop around each line and populate the start and ends of the line
-    for it in tqdm(range(len(line))):
-        # get pixel start and end
-        start, end = line[it], line[it] + 2
-        # ---------------------------------------------------------------------
-        # we perform a linear interpolation to find the exact wavelength
-        # where the derivatives goes to zero
-        coeffs = np.polyfit(dflux[start:end], t_wave[start:end], 1)
-        # we only want the center
-        wave_cent = coeffs[1]
-        # ---------------------------------------------------------------------
-        # set the start equal to the center of the line
-        ll_mask_s[it] = wave_cent
-        # ---------------------------------------------------------------------
-        # set the end equal to the center of the line
-        ll_mask_e[it] = wave_cent
+    # we perform a linear interpolation (between the two pixels either side
+    # of the sign change) to find the exact wavelength where the derivative
+    # goes to zero, for all lines at once
+    dflux0, dflux1 = dflux[line], dflux[line + 1]
+    wave0, wave1 = t_wave[line], t_wave[line + 1]
+    wave_cent = wave0 - dflux0 * (wave1 - wave0) / (dflux1 - dflux0)
+    # -------------------------------------------------------------------------
+    # set the start and end equal to the center of the line
+    ll_mask_s[:] = wave_cent
+    ll_mask_e[:] = wave_cent
     # -------------------------------------------------------------------------
     # store in a table for on going use
     table = Table()
@@ -3035,8 +4270,6 @@ def mask_systemic_velocity(inst: InstrumentsType, line_table: Table,
 
     :return: float, the systemic velocity
     """
-    # get tqdm
-    tqdm = base.tqdm_module(inst.params['USE_TQDM'], log.console_verbosity)
     # create a spline of the model spectrum
     smodel = mp.iuv_spline(m_wavemap, m_spectrum)
     # get the center of the lines
@@ -3051,16 +4284,20 @@ def mask_systemic_velocity(inst: InstrumentsType, line_table: Table,
     # -------------------------------------------------------------------------
     # print progress
     log.general('Calculating CCF for each DV element')
-    # storage for the CCF outputs
-    ccf = np.zeros_like(dvs)
-    # calculate the CCF for each dv element
-    for it in tqdm(range(len(dvs))):
-        # get the wave grid at this rv element
-        wave_it = mp.doppler_shift(wave_tmp, dvs[it] * 1000)
-        # get the model on this wave grid
-        model_it = smodel(wave_it)
-        # calculate the ccf (just the sum of weights * model)
-        ccf[it] = np.sum(weight_tmp * model_it)
+    # put the model on a magic grid covering the lines at all dv elements
+    #    (oversampled so that the linear interpolation follows the spline)
+    grid_step = get_velocity_step(m_wavemap, rounding=False)
+    grid_step = grid_step / CCF_MODEL_OVERSAMPLING
+    wave0 = mp.doppler_shift(np.min(wave_tmp), np.max(dvs) * 1000)
+    wave1 = mp.doppler_shift(np.max(wave_tmp), np.min(dvs) * 1000)
+    # pad the grid by a grid step below and two grid steps above
+    wave0 = wave0 * (1 - grid_step / speed_of_light_ms)
+    wave1 = wave1 * (1 + 2 * grid_step / speed_of_light_ms)
+    magic_grid = get_magic_grid(wave0, wave1, dv_grid=grid_step)
+    # calculate the CCF for all dv elements (just the sum of weights * model)
+    wave_index = get_magic_index(np.array(wave_tmp), magic_grid[0], grid_step)
+    ccf = compute_ccf(smodel(magic_grid), wave_index, np.array(weight_tmp),
+                      get_magic_shift(dvs * 1000, grid_step))
     # robust polyfit on the ccf
     ccf_coeffs = mp.robust_polyfit(dvs, ccf, 3, 5)
     # remove gradients in the ccf